@@ -0,0 +1,74 @@
+"""Import time benchmark
+
+Measures the cost of importing `fhir_migrations.commands` and registering the
+migration blueprint with a Flask app, on top of importing Flask itself. Each
+sample runs in a fresh interpreter so module caches do not hide the cost.
+
+    python benchmarks/import_time.py --runs 10 --max-overhead-ms 50
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE_SNIPPET = """
+import time
+start = time.perf_counter()
+from flask import Flask
+app = Flask('benchmark')
+print(time.perf_counter() - start)
+"""
+
+BLUEPRINT_SNIPPET = """
+import time
+start = time.perf_counter()
+from flask import Flask
+from fhir_migrations.commands import migration_blueprint
+app = Flask('benchmark')
+app.register_blueprint(migration_blueprint)
+print(time.perf_counter() - start)
+"""
+
+
+def time_snippet(snippet: str, runs: int) -> float:
+    """Return the median duration in seconds of the snippet over fresh interpreters."""
+    environment = dict(os.environ, PYTHONPATH=REPO_DIR)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", snippet], env=environment, cwd=REPO_DIR)
+        samples.append(float(output.decode().strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def measure_import_overhead(runs: int = 5) -> dict:
+    """Return the median import durations and the overhead of the blueprint in ms."""
+    baseline = time_snippet(BASELINE_SNIPPET, runs)
+    blueprint = time_snippet(BLUEPRINT_SNIPPET, runs)
+    return {
+        "flask_ms": baseline * 1000,
+        "blueprint_ms": blueprint * 1000,
+        "overhead_ms": (blueprint - baseline) * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-overhead-ms", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    result = measure_import_overhead(args.runs)
+    for name, value in result.items():
+        print(f"{name}: {value:.1f}")
+
+    if args.max_overhead_ms is not None and result["overhead_ms"] > args.max_overhead_ms:
+        print(f"Blueprint import overhead exceeds {args.max_overhead_ms} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
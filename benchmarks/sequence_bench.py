@@ -0,0 +1,244 @@
+"""Discovery and sequencing benchmarks
+
+Generates synthetic migration directories and times migration discovery and
+sequencing at increasing sizes, tracking peak memory with tracemalloc:
+
+- Migration.get_migrations, cold (no manifest) and with a compiled manifest
+- Migration.build_migration_sequence
+- LinkedList.build_list_from_dictionary, check_consistency and get_sublist
+- validate_sequence on broken (cycle, dangling) and branched histories
+- Migration discovery and sequencing of broken and branched migration directories
+
+Results are compared to the stored baseline (benchmarks/baseline.json); the run fails
+when a benchmark is slower than `--tolerance` times its baseline. Independently of the
+baseline, it fails when the time per migration grows faster than `--max-growth` between
+the smallest and the largest size, which catches quadratic paths on any machine.
+
+    python benchmarks/sequence_bench.py
+    python benchmarks/sequence_bench.py --sizes 100 1000 10000
+    python benchmarks/sequence_bench.py --update-baseline
+    python benchmarks/sequence_bench.py --skip-baseline
+
+`tox -e benchmark` runs the comparison against the baseline. CI runs it with
+`--skip-baseline`: its runners differ from the machine the baseline was recorded on.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fhir_migrations.discovery import scan_migrations, write_manifest  # noqa: E402
+from fhir_migrations.migration import Migration  # noqa: E402
+from fhir_migrations.utils import LinkedList, SequenceError, validate_sequence  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+# Benchmarks below this duration are dominated by noise and not compared
+MIN_COMPARED_SECONDS = 0.005
+
+MIGRATION_TEMPLATE = """import logging
+import requests
+
+# Migration script generated for {name}
+revision = '{revision}'
+down_revision = '{down_revision}'
+
+logging.basicConfig(level=logging.INFO)
+mapping = {{"key-{index}-%d" % i: i for i in range(1000)}}
+
+def upgrade():
+    pass
+
+def downgrade():
+    pass
+"""
+
+
+def generate_history(size: int, shape: str = "linear") -> list:
+    """Return (revision, down_revision) pairs of a synthetic history.
+    Shapes: linear, branched (a fork in the middle), broken (a cycle and a dangling revision)."""
+    revisions = [str(uuid.UUID(int=index + 1)) for index in range(size)]
+    pairs = [(revision, revisions[index - 1] if index else 'None') for index, revision in enumerate(revisions)]
+
+    if shape == "branched":
+        middle = size // 2
+        pairs.append((str(uuid.UUID(int=size + 1)), revisions[middle]))
+    elif shape == "broken":
+        quarter = size // 4
+        pairs[quarter] = (revisions[quarter], revisions[quarter * 3])
+        pairs.append((str(uuid.UUID(int=size + 1)), "missing-revision"))
+    return pairs
+
+
+def write_history(directory: str, pairs: list):
+    """Write a migration file for every (revision, down_revision) pair."""
+    for index, (revision, down_revision) in enumerate(pairs):
+        name = f"migration_{index:06d}"
+        with open(os.path.join(directory, f"{name}.py"), "w") as migration_file:
+            migration_file.write(MIGRATION_TEMPLATE.format(
+                name=name, revision=revision, down_revision=down_revision, index=index))
+
+
+def measure(function, repeat: int = 3) -> dict:
+    """Best wall time of `repeat` calls and the peak traced memory of the first call."""
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {"seconds": min(durations), "peak_kb": peak // 1024}
+
+
+def expect_sequence_error(function):
+    """Wrap a function expected to reject a broken history."""
+    def run():
+        try:
+            function()
+        except SequenceError:
+            return
+        raise AssertionError("broken history was accepted")
+    return run
+
+
+def run_size(size: int, repeat: int) -> dict:
+    """Run every benchmark for a history of `size` migrations."""
+    results = {}
+    pairs = generate_history(size)
+    previous_nodes = dict(pairs)
+    revisions = [revision for revision, _ in pairs]
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_history(directory, pairs)
+        migration = Migration(directory)
+
+        def cold_get_migrations():
+            migration.manifest = None
+            migration.get_migrations()
+        results["get_migrations_cold"] = measure(cold_get_migrations, repeat)
+
+        migration.compile_manifest()
+
+        def manifest_get_migrations():
+            migration.manifest = None
+            migration.get_migrations()
+        results["get_migrations_manifest"] = measure(manifest_get_migrations, repeat)
+        results["build_migration_sequence"] = measure(migration.build_migration_sequence, repeat)
+
+    linked_list = LinkedList()
+    results["build_list_from_dictionary"] = measure(
+        lambda: linked_list.build_list_from_dictionary(previous_nodes), repeat)
+    results["check_consistency"] = measure(linked_list.check_consistency, repeat)
+    results["get_sublist"] = measure(lambda: linked_list.get_sublist(revisions[size // 2]), repeat)
+    results["get_sublist_bounded"] = measure(
+        lambda: linked_list.get_sublist(revisions[size // 4], revisions[size * 3 // 4]), repeat)
+
+    for shape in ("branched", "broken"):
+        shaped_pairs = generate_history(size, shape)
+        results[f"validate_{shape}"] = measure(lambda: validate_sequence(shaped_pairs), repeat)
+        results[f"build_{shape}"] = measure(
+            expect_sequence_error(lambda: LinkedList().build_list_from_dictionary(dict(shaped_pairs))), repeat)
+
+        with tempfile.TemporaryDirectory() as directory:
+            write_history(directory, shaped_pairs)
+            # A broken directory cannot be compiled by Migration, write its manifest directly
+            write_manifest(directory, scan_migrations(directory))
+            # Branched histories are sequenced as a RevisionGraph, broken ones are rejected
+            def create_migration():
+                Migration(directory)
+            if shape == "broken":
+                create_migration = expect_sequence_error(create_migration)
+            results[f"migration_{shape}"] = measure(create_migration, repeat)
+
+    return results
+
+
+def run_benchmarks(sizes: list, repeat: int) -> dict:
+    """Return {size: {benchmark: measurement}} as strings keyed JSON friendly dict."""
+    results = {}
+    for size in sizes:
+        results[str(size)] = run_size(size, repeat)
+        for name, measurement in sorted(results[str(size)].items()):
+            print(f"{size:>6} {name:<28} {measurement['seconds'] * 1000:10.2f} ms {measurement['peak_kb']:>8} KiB")
+    return results
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """Benchmarks slower than tolerance times their baseline."""
+    regressions = []
+    for size, measurements in results.items():
+        for name, measurement in measurements.items():
+            expected = baseline.get(size, {}).get(name)
+            if expected is None or expected["seconds"] < MIN_COMPARED_SECONDS:
+                continue
+            if measurement["seconds"] > expected["seconds"] * tolerance:
+                regressions.append(
+                    f"{name} at {size}: {measurement['seconds']:.4f}s, baseline {expected['seconds']:.4f}s")
+    return regressions
+
+
+def check_growth(results: dict, max_growth: float) -> list:
+    """Benchmarks whose time per migration grows more than max_growth from the smallest to the largest size."""
+    sizes = sorted(int(size) for size in results)
+    if len(sizes) < 2:
+        return []
+    smallest, largest = str(sizes[0]), str(sizes[-1])
+
+    regressions = []
+    for name, measurement in results[largest].items():
+        small = results[smallest][name]["seconds"]
+        if measurement["seconds"] < MIN_COMPARED_SECONDS or small <= 0:
+            continue
+        growth = (measurement["seconds"] / sizes[-1]) / (small / sizes[0])
+        if growth > max_growth:
+            regressions.append(f"{name}: time per migration grew {growth:.1f}x from {smallest} to {largest}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="Allowed slowdown factor against the baseline")
+    parser.add_argument("--max-growth", type=float, default=4.0,
+                        help="Allowed growth of the time per migration between the smallest and largest size")
+    parser.add_argument("--skip-baseline", action="store_true",
+                        help="Only check the growth, for machines the baseline was not recorded on")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    results = run_benchmarks(args.sizes, args.repeat)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=1, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    regressions = check_growth(results, args.max_growth)
+    if not args.skip_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions += compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
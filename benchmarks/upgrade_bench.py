@@ -0,0 +1,138 @@
+"""End to end upgrade benchmark
+
+Runs `flask upgrade` in a fresh interpreter against the bundled stub FHIR server
+(fhir_migrations.stub_server) seeded with N synthetic patients. The migration
+follows examples/add_mrn.py: every patient is searched by identifier and updated
+with an MRN, either one PUT per patient or through the BundleWriter (`--bundle`).
+Reports the wall time, the requests per second seen by the server and the
+response statuses.
+
+    python benchmarks/upgrade_bench.py --patients 2000 --latency 0.002 --throttle-rate 0.01
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fhir_migrations.stub_server import StubFHIRServer  # noqa: E402
+
+IDENTIFIER_SYSTEM = "uwDAL_Clarity"
+MRN_SYSTEM = "urn:oid:1.2.3.4.5.6.7.8.9.10.11.12.13"
+
+APP_SOURCE = """from flask import Flask
+from fhir_migrations.commands import migration_blueprint
+
+app = Flask(__name__)
+app.register_blueprint(migration_blueprint)
+"""
+
+MIGRATION_SOURCE = """import json
+import os
+
+from fhir_migrations.client import get_client
+from fhir_migrations.executor import run_concurrently
+from fhir_migrations.writer import BundleWriter
+
+# Migration script generated for the upgrade benchmark
+revision = 'a0e5b1d2-7f4e-4f0e-9a53-5c1f1b0b6a01'
+down_revision = 'None'
+
+PATIENT_COUNT = int(os.environ["BENCHMARK_PATIENTS"])
+USE_BUNDLES = os.environ.get("BENCHMARK_BUNDLES") == "1"
+client = get_client()
+
+def with_mrn(pat_id):
+    patients = list(client.search('Patient', {{"identifier": f'{identifier_system}|{{pat_id}}'}}))
+    patient_resource = patients[0]
+    patient_resource['identifier'].append({{"system": "{mrn_system}", "value": f"U{{pat_id}}"}})
+    return patient_resource
+
+def upgrade():
+    if USE_BUNDLES:
+        with BundleWriter() as writer:
+            for pat_id in range(PATIENT_COUNT):
+                writer.update(with_mrn(pat_id))
+        return
+
+    def add_mrn(pat_id):
+        patient_resource = with_mrn(pat_id)
+        client.put(f"Patient/{{patient_resource['id']}}", data=json.dumps(patient_resource)).raise_for_status()
+    run_concurrently(range(PATIENT_COUNT), add_mrn)
+
+def downgrade():
+    pass
+"""
+
+
+def seed_patients(server: StubFHIRServer, count: int):
+    """Store the synthetic patients directly, without going through HTTP."""
+    for index in range(count):
+        server.store.write("Patient", {
+            "resourceType": "Patient",
+            "id": f"bench-{index}",
+            "identifier": [{"system": IDENTIFIER_SYSTEM, "value": str(index)}],
+        })
+
+
+def run_upgrade(server: StubFHIRServer, patients: int, bundles: bool, pool_size: int) -> float:
+    """Run `flask upgrade` in a subprocess, returns the wall time in seconds."""
+    with tempfile.TemporaryDirectory() as directory:
+        migrations_dir = os.path.join(directory, "migrations")
+        os.mkdir(migrations_dir)
+        with open(os.path.join(directory, "benchmark_app.py"), "w") as app_file:
+            app_file.write(APP_SOURCE)
+        with open(os.path.join(migrations_dir, "add_mrn.py"), "w") as migration_file:
+            migration_file.write(MIGRATION_SOURCE.format(identifier_system=IDENTIFIER_SYSTEM, mrn_system=MRN_SYSTEM))
+
+        environment = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join([REPO_DIR, directory]),
+            FLASK_APP="benchmark_app",
+            FHIR_URL=server.base_url,
+            FHIR_POOL_SIZE=str(pool_size),
+            MIGRATION_SCRIPTS_DIR=migrations_dir,
+            BENCHMARK_PATIENTS=str(patients),
+            BENCHMARK_BUNDLES="1" if bundles else "0",
+        )
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "flask", "upgrade"], env=environment, cwd=directory,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--bundle", action="store_true", help="Write through the BundleWriter")
+    parser.add_argument("--pool-size", type=int, default=10, help="FHIR_POOL_SIZE of the upgrade")
+    parser.add_argument("--latency", type=float, default=0.0, help="Server latency per request in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with StubFHIRServer(latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                        seed=args.seed) as server:
+        seed_patients(server, args.patients)
+        seconds = run_upgrade(server, args.patients, args.bundle, args.pool_size)
+
+        updated = sum(
+            any(identifier["system"] == MRN_SYSTEM for identifier in patient["identifier"])
+            for patient in server.store.all("Patient")
+        )
+        print(f"patients: {args.patients} (updated {updated})")
+        print(f"wall time: {seconds:.2f}s")
+        print(f"requests: {server.request_count} ({server.request_count / seconds:.0f}/s)")
+        for (method, status), count in sorted(server.request_counts.items()):
+            print(f"    {method} {status}: {count}")
+
+    return 0 if updated == args.patients else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
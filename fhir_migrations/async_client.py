@@ -0,0 +1,134 @@
+"""Async FHIR Client
+
+Defines an asyncio FHIR client for migrations declaring `async def upgrade()` and
+`async def downgrade()`. Requests share a pooled `httpx.AsyncClient`, and a
+semaphore caps the number of requests in flight, so a single thread can keep many
+requests open against the FHIR store:
+
+    import asyncio
+    from fhir_migrations.async_client import AsyncFHIRClient
+
+    async def upgrade():
+        async with AsyncFHIRClient() as client:
+            await asyncio.gather(*(client.put(f"Patient/{p['id']}", json=p) for p in patients))
+
+Requires the optional `httpx` dependency (`pip install fhir_migrations[async]`).
+The concurrency limit defaults to FHIR_ASYNC_CONCURRENCY. Create the client inside
+the migration coroutine, each migration runs on its own event loop. Clients created
+during a dry run (see fhir_migrations.dry_run) send their writes to a DryRunTransport,
+which records them in the plan instead of sending them.
+"""
+import asyncio
+import logging
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - optional dependency
+    httpx = None
+
+from fhir_migrations import dry_run
+from fhir_migrations.client import DEFAULT_HEADERS, default_base_url, next_link, resolve_url
+from fhir_migrations.config import FHIR_ASYNC_CONCURRENCY, FHIR_TIMEOUT
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class AsyncFHIRClient:
+    """Pooled asyncio HTTP client bound to a FHIR base URL."""
+
+    def __init__(self, base_url=None, concurrency=None, timeout=None, headers=None, **kwargs):
+        if httpx is None:
+            raise ImportError("AsyncFHIRClient requires httpx, install fhir_migrations[async]")
+
+        self.base_url = base_url or default_base_url()
+        self.concurrency = concurrency or FHIR_ASYNC_CONCURRENCY
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        if dry_run.active_dry_run is not None:
+            transport = kwargs.pop("transport", None) or httpx.AsyncHTTPTransport(limits=limits)
+            kwargs["transport"] = DryRunTransport(dry_run.active_dry_run, transport)
+        self.http = httpx.AsyncClient(
+            headers={**DEFAULT_HEADERS, **(headers or {})},
+            timeout=FHIR_TIMEOUT if timeout is None else timeout,
+            limits=limits,
+            **kwargs
+        )
+
+    def __repr__(self):
+        return f"AsyncFHIRClient({self.base_url})"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def url(self, path: str) -> str:
+        """Resolve a path relative to the base URL, absolute URLs are kept."""
+        return resolve_url(self.base_url, path)
+
+    async def request(self, method: str, path: str, **kwargs) -> 'httpx.Response':
+        """Send a request once a concurrency slot is free."""
+        async with self.semaphore:
+            return await self.http.request(method, self.url(path), **kwargs)
+
+    async def get(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request("GET", path, **kwargs)
+
+    async def put(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request("PUT", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request("POST", path, **kwargs)
+
+    async def patch(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request("PATCH", path, **kwargs)
+
+    async def delete(self, path: str, **kwargs) -> 'httpx.Response':
+        return await self.request("DELETE", path, **kwargs)
+
+    async def search(self, resource_type: str, params: dict = None, count: int = None):
+        """Async generator over the resources matching the search, following Bundle `next` links."""
+        params = dict(params or {})
+        if count is not None:
+            params["_count"] = count
+
+        next_url, request_params = resource_type, params
+        while next_url:
+            response = await self.get(next_url, params=request_params)
+            response.raise_for_status()
+            bundle = response.json()
+
+            for entry in bundle.get("entry", []):
+                if entry.get("search", {}).get("mode", "match") == "match":
+                    yield entry["resource"]
+
+            next_url, request_params = next_link(bundle), None
+
+    async def aclose(self):
+        """Close the pooled connections."""
+        await self.http.aclose()
+
+
+class DryRunTransport(httpx.AsyncBaseTransport if httpx is not None else object):
+    """Transport passing reads to the wrapped transport and answering writes locally,
+    the asyncio counterpart of the DryRunAdapter."""
+
+    def __init__(self, planner: 'dry_run.DryRun', transport: 'httpx.AsyncBaseTransport'):
+        self.planner = planner
+        self.transport = transport
+
+    async def handle_async_request(self, request: 'httpx.Request') -> 'httpx.Response':
+        body = await request.aread()
+        bundle = self.planner.account(request.method, str(request.url), body, len(body))
+        if request.method not in dry_run.WRITE_METHODS:
+            return await self.transport.handle_async_request(request)
+
+        logger.debug(f"Dry run: not sending {request.method} {request.url}")
+        status_code, _, content = dry_run.simulated_content(request.method, body, bundle)
+        return httpx.Response(status_code, headers={"Content-Type": "application/fhir+json"},
+                              content=content, request=request)
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,237 @@
+"""Bulk Export Reader
+
+Reads all resources of one or more types through a FHIR Bulk Data `$export`
+instead of paging through searches. The export is started at the system level
+(or `Patient`, `Group/<id>`), its status is polled with backoff, and the NDJSON
+output files are downloaded into a local spool directory. Resources are then
+streamed from the spool line by line over a memory map, so memory use does not
+depend on the export size:
+
+    from fhir_migrations.bulk_export import BulkExport
+
+    def upgrade():
+        export = BulkExport(["Patient"])
+        for patient in export.resources("Patient"):
+            ...
+
+The spool directory is derived from the export parameters under
+FHIR_EXPORT_SPOOL_DIR. A completed spool is reused by later runs with the same
+parameters (e.g. the rerun of a failed migration) unless `reuse` is False; call
+`clear()` to remove it. `transaction_time` can be passed as `since` of a later,
+incremental export.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import time
+
+from fhir_migrations.client import get_client
+from fhir_migrations.config import FHIR_EXPORT_SPOOL_DIR
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+SPOOL_MANIFEST_FILE_NAME = "spool.json"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class BulkDataError(RuntimeError):
+    """Raised when a Bulk Data operation could not be started or failed on the server."""
+
+    def __init__(self, message: str, outcome: dict = None):
+        super().__init__(message)
+        self.outcome = outcome
+
+
+class BulkExportError(BulkDataError):
+    """Raised when the export could not be started or failed on the server."""
+
+
+def read_ndjson(path: str):
+    """Generator over the JSON lines of a file, read through a memory map."""
+    with open(path, "rb") as ndjson_file:
+        if os.fstat(ndjson_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(ndjson_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for line in iter(mapped.readline, b""):
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def response_outcome(response):
+    """The OperationOutcome of an error response, None when the body is not JSON."""
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+def poll_status(client, status_url: str, description: str, poll_interval: float = 1.0,
+                max_poll_interval: float = 60.0, timeout: float = None, error_class=BulkDataError) -> dict:
+    """Poll the status URL of an asynchronous request until it completed, returns the completion body.
+    Waits for Retry-After when given, otherwise for an interval doubling up to max_poll_interval."""
+    started = time.monotonic()
+    interval = poll_interval
+    while True:
+        response = client.get(status_url)
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code != 202:
+            raise error_class(f"{description} failed: {response.status_code}", response_outcome(response))
+
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise error_class(f"{description} did not complete within {timeout}s")
+
+        retry_after = response.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else interval
+        logger.debug(f"{description} in progress ({response.headers.get('X-Progress', '')}), polling in {delay}s")
+        time.sleep(min(delay, max_poll_interval))
+        interval = min(interval * 2, max_poll_interval)
+
+
+class BulkExport:
+    """A Bulk Data export of the given resource types, spooled to a local directory."""
+
+    def __init__(self, resource_types: list = None, level: str = "", since: str = None, type_filters: list = None,
+                 client=None, spool_dir: str = None, poll_interval: float = 1.0, max_poll_interval: float = 60.0,
+                 timeout: float = None, reuse: bool = True):
+        self.resource_types = list(resource_types or [])
+        self.level = level.strip("/")
+        self.since = since
+        self.type_filters = list(type_filters or [])
+        self.client = client
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.reuse = reuse
+
+        # Exports of different servers or tenants with the same parameters get their own spool
+        key = json.dumps([self.get_client().base_url, self.level, self.resource_types, self.since,
+                          self.type_filters])
+        self.directory = os.path.join(spool_dir or FHIR_EXPORT_SPOOL_DIR, hashlib.sha1(key.encode()).hexdigest()[:16])
+        self.manifest = None
+
+    def __repr__(self):
+        return f"BulkExport({self.level or 'system'} {','.join(self.resource_types) or 'all types'})"
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, SPOOL_MANIFEST_FILE_NAME)
+
+    @property
+    def transaction_time(self):
+        """Server time the exported data reflects."""
+        return self.run()["transactionTime"]
+
+    def get_client(self):
+        return self.client or get_client()
+
+    def load_spool(self):
+        """The manifest of a completed spool, None when there is none."""
+        try:
+            with open(self.manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+    def run(self) -> dict:
+        """Export and download into the spool, unless a completed spool is reused. Returns the spool manifest."""
+        if self.manifest is not None:
+            return self.manifest
+        if self.reuse:
+            self.manifest = self.load_spool()
+            if self.manifest is not None:
+                logger.info(f"Reusing spooled {self} from {self.directory}")
+                return self.manifest
+
+        status_url = self.kick_off()
+        export_manifest = self.poll(status_url)
+        self.manifest = self.download(export_manifest)
+
+        try:
+            # Tell the server the output files can be removed
+            self.get_client().delete(status_url)
+        except Exception as e:
+            logger.warning(f"Failed to delete export job {status_url}: {e}")
+        return self.manifest
+
+    def kick_off(self) -> str:
+        """Start the export, returns the status URL."""
+        params = {}
+        if self.resource_types:
+            params["_type"] = ",".join(self.resource_types)
+        if self.since:
+            params["_since"] = self.since
+        if self.type_filters:
+            params["_typeFilter"] = ",".join(self.type_filters)
+
+        path = f"{self.level}/$export" if self.level else "$export"
+        response = self.get_client().get(path, params=params, headers={"Prefer": "respond-async"})
+        if response.status_code != 202 or "Content-Location" not in response.headers:
+            raise BulkExportError(f"Failed to start {self}: {response.status_code}", response_outcome(response))
+
+        logger.info(f"Started {self}")
+        return response.headers["Content-Location"]
+
+    def poll(self, status_url: str) -> dict:
+        """Poll the status URL until the export completed, returns the export manifest."""
+        return poll_status(self.get_client(), status_url, str(self), self.poll_interval, self.max_poll_interval,
+                           self.timeout, BulkExportError)
+
+    def download(self, export_manifest: dict) -> dict:
+        """Download the output and error files into the spool and write the spool manifest."""
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+        files = [self.download_file(output, f"{output['type']}.{index:04d}.ndjson")
+                 for index, output in enumerate(export_manifest.get("output", []))]
+        errors = [self.download_file(output, f"error.{index:04d}.ndjson")
+                  for index, output in enumerate(export_manifest.get("error", []))]
+        if errors:
+            logger.warning(f"{self} reported {len(errors)} error file(s) in {self.directory}")
+
+        manifest = {
+            "transactionTime": export_manifest.get("transactionTime"),
+            "request": export_manifest.get("request"),
+            "files": files,
+            "errors": errors,
+        }
+        temporary_path = f"{self.manifest_path}.tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        os.replace(temporary_path, self.manifest_path)
+        return manifest
+
+    def download_file(self, output: dict, file_name: str) -> dict:
+        """Stream one output file into the spool."""
+        path = os.path.join(self.directory, file_name)
+        response = self.get_client().get(output["url"], stream=True, headers={"Accept": "application/fhir+ndjson"})
+        response.raise_for_status()
+        with open(f"{path}.part", "wb") as spool_file:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                spool_file.write(chunk)
+        os.replace(f"{path}.part", path)
+        return {"type": output.get("type"), "file": file_name, "count": output.get("count")}
+
+    def files(self, resource_type: str = None) -> list:
+        """Paths of the spooled files, of the resource type when given."""
+        return [
+            os.path.join(self.directory, entry["file"])
+            for entry in self.run()["files"]
+            if resource_type is None or entry["type"] == resource_type
+        ]
+
+    def resources(self, resource_type: str = None):
+        """Generator over the exported resources, of the resource type when given."""
+        for path in self.files(resource_type):
+            yield from read_ndjson(path)
+
+    def clear(self):
+        """Remove the spool."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.manifest = None
@@ -0,0 +1,318 @@
+"""Bulk Import Writer
+
+A writer backend sending created and updated resources through FHIR Bulk Data
+`$import` instead of Bundles, for migrations writing millions of resources. It
+keeps the BundleWriter API, so a migration switches backends with a setting:
+
+    from fhir_migrations.writer import open_writer
+
+    with open_writer(on_result=log_failure) as writer:  # FHIR_WRITER_BACKEND=import
+        for patient in patients:
+            writer.update(patient, record=patient["id"])
+
+Resources are streamed into one NDJSON file per resource type in a local
+directory. On `flush()` (every `max_entries` resources and on close) the files
+are uploaded, as Binary resources or with PUT below FHIR_IMPORT_UPLOAD_URL, the
+`$import` is submitted and polled until it completes. Errors reported by the
+server (OperationOutcomes naming the input line or the resource) are mapped back
+to the `record` of the operation; the other operations are reported as imported,
+unless the server imported fewer resources of an input than were sent. Uploads go
+through the pooled FHIR client, so retries, dry runs and metrics apply to them.
+In a dry run the uploads and the `$import` are planned, but not polled: the
+operations are reported as imported.
+
+`$import` has no conditional or delete semantics: conditional creates and updates
+raise ValueError, deletes are sent in Bundles through a BundleWriter.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from fhir_migrations.bulk_export import BulkDataError, poll_status, response_outcome
+from fhir_migrations.client import get_client
+from fhir_migrations.config import FHIR_IMPORT_UPLOAD_URL
+from fhir_migrations.dry_run import dry_run_adapter
+from fhir_migrations.writer import DEFAULT_MAX_BYTES, BundleWriter, WriteResult
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_IMPORT_MAX_ENTRIES = 100000
+NDJSON_CONTENT_TYPE = "application/fhir+ndjson"
+LINE_PATTERN = re.compile(r"line\s*\[?(\d+)", re.IGNORECASE)
+REFERENCE_PATTERN = re.compile(r"\b([A-Z][A-Za-z]+/[A-Za-z0-9\-.]{1,64})\b")
+
+
+class BulkImportError(BulkDataError):
+    """Raised when the import could not be started or failed on the server."""
+
+
+def outcome_line(outcome: dict):
+    """Input line number (1-based) named by an error OperationOutcome, None when not given."""
+    for issue in outcome.get("issue", []):
+        for text in issue.get("location", []) + [issue.get("diagnostics") or ""]:
+            match = LINE_PATTERN.search(text)
+            if match:
+                return int(match.group(1))
+    return None
+
+
+def outcome_reference(outcome: dict):
+    """Resource reference, e.g. Patient/123, named by an error OperationOutcome."""
+    for issue in outcome.get("issue", []):
+        for text in issue.get("expression", []) + [issue.get("diagnostics") or ""]:
+            match = REFERENCE_PATTERN.search(text)
+            if match:
+                return match.group(1)
+    return None
+
+
+class ImportFile:
+    """NDJSON input file of one resource type, with the operation of every line."""
+
+    def __init__(self, resource_type: str, path: str):
+        self.resource_type = resource_type
+        self.path = path
+        self.file = open(path, "w")
+        self.operations = []
+        self.references = {}
+        self.url = None
+
+    def write(self, resource: dict, method: str, url: str, record):
+        self.file.write(json.dumps(resource, separators=(",", ":")) + "\n")
+        if resource.get("id"):
+            self.references.setdefault(f"{self.resource_type}/{resource['id']}", len(self.operations))
+        self.operations.append((method, url, record))
+
+    def position(self, line: int = None, reference: str = None):
+        """Index of the operation at the 1-based input line, or of the referenced resource."""
+        if line is not None and 0 < line <= len(self.operations):
+            return line - 1
+        return self.references.get(reference)
+
+    def close(self):
+        self.file.close()
+
+
+class ImportWriter(BundleWriter):
+    """Writes created and updated resources through $import, deletes through Bundles."""
+
+    def __init__(self, client=None, bundle_type: str = "batch", max_entries: int = DEFAULT_IMPORT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES, on_result=None, upload_url: str = None, directory: str = None,
+                 poll_interval: float = 1.0, max_poll_interval: float = 60.0, timeout: float = None):
+        super().__init__(client, bundle_type, max_entries, max_bytes, on_result)
+        self.upload_url = upload_url or FHIR_IMPORT_UPLOAD_URL
+        self.base_directory = directory
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.files = {}
+        self.directory = None
+        self.pending_count = 0
+        self.imports = 0
+        self.uploads = 0
+        # Deletes have no $import equivalent
+        self.delete_writer = BundleWriter(client, bundle_type, max_entries=min(max_entries, 100),
+                                          max_bytes=max_bytes, on_result=self.report)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # Do not import the operations of a failed block, remove their input files
+        self.delete_writer.__exit__(exc_type, exc_value, traceback)
+        if self.files:
+            logger.warning(f"Discarding {self.pending_count} buffered operations after {exc_type.__name__}")
+            self.discard()
+
+    def get_client(self):
+        return self.client or get_client()
+
+    def discard(self):
+        """Drop the pending operations and remove their input files."""
+        for import_file in self.files.values():
+            import_file.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.files = {}
+        self.directory = None
+        self.pending_count = 0
+
+    def add(self, entry: dict, record=None) -> list:
+        """Queue a Bundle entry style operation. Returns the results of a flush triggered by max_entries."""
+        request = entry["request"]
+        if request["method"] == "DELETE":
+            return self.delete_writer.add(entry, record)
+        if request["method"] not in ("POST", "PUT"):
+            raise ValueError(f"{request['method']} is not supported by $import")
+        if request.get("ifMatch") or request.get("ifNoneExist"):
+            raise ValueError("Conditional writes are not supported by $import")
+
+        resource = entry["resource"]
+        resource_type = resource["resourceType"]
+        if resource_type not in self.files:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="fhir_import_", dir=self.base_directory)
+            self.files[resource_type] = ImportFile(
+                resource_type, os.path.join(self.directory, f"{resource_type}.ndjson"))
+        self.files[resource_type].write(resource, request["method"], request["url"], record)
+        self.pending_count += 1
+
+        if self.pending_count >= self.max_entries:
+            return self.flush()
+        return []
+
+    def flush(self) -> list:
+        """Upload the pending files, run the $import and return the WriteResults of its operations."""
+        results = self.delete_writer.flush()
+        if not self.files:
+            return results
+
+        files = list(self.files.values())
+        directory = self.directory
+        self.files = {}
+        self.directory = None
+        self.pending_count = 0
+
+        try:
+            for import_file in files:
+                import_file.close()
+                import_file.url = self.upload(import_file)
+            manifest = self.run_import(files)
+            results.extend(self.map_results(files, manifest))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        return results
+
+    def upload(self, import_file: ImportFile) -> str:
+        """Upload an input file, returns the URL the server reads it from."""
+        with open(import_file.path, "rb") as ndjson_file:
+            if self.upload_url:
+                url = f"{self.upload_url.rstrip('/')}/{self.upload_name(import_file)}"
+                response = self.get_client().put(url, data=ndjson_file,
+                                                 headers={"Content-Type": NDJSON_CONTENT_TYPE})
+                response.raise_for_status()
+                self.uploads += 1
+                return url
+
+            response = self.get_client().post("Binary", data=ndjson_file,
+                                              headers={"Content-Type": NDJSON_CONTENT_TYPE})
+            response.raise_for_status()
+            self.uploads += 1
+            if self.dry_run:
+                # The simulated response does not assign an id
+                return self.get_client().url(f"Binary/{self.upload_name(import_file)}")
+            return self.get_client().url(f"Binary/{response.json()['id']}")
+
+    @property
+    def dry_run(self) -> bool:
+        """Whether the writes of the client are intercepted by a dry run."""
+        return dry_run_adapter(self.get_client()) is not None
+
+    @staticmethod
+    def upload_name(import_file: ImportFile) -> str:
+        """Upload name unique per import, e.g. fhir_import_x1y2-Patient.ndjson"""
+        directory, file_name = os.path.split(import_file.path)
+        return f"{os.path.basename(directory)}-{file_name}"
+
+    def run_import(self, files: list) -> dict:
+        """Submit the $import of the uploaded files and wait for its completion manifest."""
+        parameters = {
+            "resourceType": "Parameters",
+            "parameter": [{"name": "inputFormat", "valueCode": NDJSON_CONTENT_TYPE}] + [
+                {"name": "input", "part": [
+                    {"name": "type", "valueCode": import_file.resource_type},
+                    {"name": "url", "valueUri": import_file.url},
+                ]}
+                for import_file in files
+            ],
+        }
+        description = f"$import of {sum(len(import_file.operations) for import_file in files)} resources"
+        response = self.get_client().post("$import", data=json.dumps(parameters),
+                                          headers={"Prefer": "respond-async"})
+        if self.dry_run:
+            logger.info(f"Dry run: planned {description}")
+            return {}
+        if response.status_code != 202 or "Content-Location" not in response.headers:
+            raise BulkImportError(f"Failed to start {description}: {response.status_code}",
+                                  response_outcome(response))
+
+        status_url = response.headers["Content-Location"]
+        logger.info(f"Started {description}")
+        manifest = poll_status(self.get_client(), status_url, description, self.poll_interval,
+                               self.max_poll_interval, self.timeout, BulkImportError)
+        self.imports += 1
+        return manifest
+
+    def error_outcomes(self, manifest: dict):
+        """Generator over (input URL, OperationOutcome) of the error files of an import."""
+        for error in manifest.get("error", []):
+            if not error.get("url"):
+                continue
+            response = self.get_client().get(error["url"], headers={"Accept": NDJSON_CONTENT_TYPE})
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line.strip():
+                    yield error.get("inputUrl"), json.loads(line)
+
+    @staticmethod
+    def imported_counts(files: list, manifest: dict) -> dict:
+        """Number of resources imported per input URL according to the manifest `output`, where given."""
+        types = {import_file.resource_type: import_file.url for import_file in files}
+        counts = {}
+        for output in manifest.get("output", []):
+            url = output.get("inputUrl") or types.get(output.get("type"))
+            if url is not None and "count" in output:
+                counts[url] = counts.get(url, 0) + int(output["count"])
+        return counts
+
+    def map_results(self, files: list, manifest: dict) -> list:
+        """WriteResults of every operation, failed where an error names its line or resource.
+        When the server imported fewer resources of an input than were sent without an error,
+        the operations of the input not reported failed cannot be confirmed and fail as well."""
+        by_url = {import_file.url: import_file for import_file in files}
+        failures = {}
+        for input_url, outcome in self.error_outcomes(manifest):
+            candidates = [by_url[input_url]] if input_url in by_url else files
+            line = outcome_line(outcome)
+            reference = outcome_reference(outcome)
+            for import_file in candidates:
+                position = import_file.position(line, reference)
+                if position is not None:
+                    failures[(import_file.resource_type, position)] = outcome
+                    break
+            else:
+                logger.error(f"Import error not matching an input line: {outcome}")
+
+        counts = self.imported_counts(files, manifest)
+        results = []
+        for import_file in files:
+            failed = sum(1 for resource_type, _ in failures if resource_type == import_file.resource_type)
+            expected = len(import_file.operations) - failed
+            unconfirmed = None
+            if counts.get(import_file.url, expected) < expected:
+                message = (f"$import of {import_file.resource_type} imported {counts[import_file.url]} "
+                           f"of {expected} resources")
+                logger.error(message)
+                unconfirmed = {"resourceType": "OperationOutcome",
+                               "issue": [{"severity": "error", "code": "incomplete", "diagnostics": message}]}
+
+            for index, (method, url, record) in enumerate(import_file.operations):
+                outcome = failures.get((import_file.resource_type, index))
+                if outcome:
+                    result = WriteResult(method, url, record, status="400 Bad Request", outcome=outcome)
+                elif unconfirmed:
+                    result = WriteResult(method, url, record, status="500 Internal Server Error",
+                                         outcome=unconfirmed)
+                else:
+                    result = WriteResult(method, url, record, status="200 OK")
+                self.report(result)
+                results.append(result)
+        return results
+
+    def close(self) -> list:
+        """Import the remaining operations."""
+        return self.flush()
@@ -0,0 +1,125 @@
+"""Migration Checkpoint
+
+Persists the progress of a long running migration, so a rerun of `flask upgrade`
+resumes where a failed run stopped instead of starting over. The cursor (a last
+processed id, page link, batch number or any JSON serializable value) is held in
+a Basic resource next to the MigrationManager, one per migration and direction,
+keyed by the `resource_id` of the migration state it belongs to.
+
+Migration functions taking a required first argument, or one named `checkpoint`,
+receive their Checkpoint:
+
+    def upgrade(checkpoint):
+        start = checkpoint.cursor or 0
+        for batch_number in range(start, len(batches)):
+            process(batches[batch_number])
+            checkpoint.save(batch_number + 1)
+
+The checkpoint is deleted once the migration completed successfully.
+"""
+import inspect
+import json
+import logging
+
+from fhir_migrations.client import get_client
+from fhir_migrations.migration_resource import MIGRATION_RESOURCE_ID, MIGRATION_SYSTEM, first_in_bundle
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+CHECKPOINT_SYSTEM = f"{MIGRATION_SYSTEM}/checkpoint"
+CHECKPOINT_EXTENSION_URL = f"{MIGRATION_SYSTEM}/checkpoint-cursor"
+
+
+class Checkpoint:
+    """Progress cursor of a migration run in one direction."""
+
+    def __init__(self, revision: str, direction: str, resource: dict = None, client=None,
+                 resource_id: str = None):
+        self.revision = revision
+        self.direction = direction
+        self.resource = resource
+        self.client = client
+        self.resource_id = resource_id
+
+    def __repr__(self):
+        return f"Checkpoint({self.direction} {self.revision}: {self.cursor!r})"
+
+    @property
+    def identifier(self) -> str:
+        return f"{self.resource_id or MIGRATION_RESOURCE_ID}/{self.direction}/{self.revision}"
+
+    @property
+    def search_params(self) -> dict:
+        return {"identifier": f"{CHECKPOINT_SYSTEM}|{self.identifier}"}
+
+    @property
+    def cursor(self):
+        """The saved cursor, None when the migration has not saved progress."""
+        if self.resource is None:
+            return None
+        for extension in self.resource.get("extension", []):
+            if extension.get("url") == CHECKPOINT_EXTENSION_URL:
+                return json.loads(extension["valueString"])
+        return None
+
+    @classmethod
+    def load(cls, revision: str, direction: str, client=None, resource_id: str = None) -> 'Checkpoint':
+        """Fetch the checkpoint of the migration from the FHIR store."""
+        checkpoint = cls(revision, direction, client=client, resource_id=resource_id)
+        response = (client or get_client()).get(
+            "Basic",
+            params=checkpoint.search_params,
+            headers={'Cache-Control': 'no-cache'}
+        )
+        response.raise_for_status()
+        checkpoint.resource = first_in_bundle(response.json())
+
+        return checkpoint
+
+    def save(self, cursor):
+        """Persist the cursor, it is handed back to the migration on the next run."""
+        resource = {
+            "resourceType": "Basic",
+            "identifier": [{"system": CHECKPOINT_SYSTEM, "value": self.identifier}],
+            "code": {"coding": [{"system": MIGRATION_SYSTEM, "code": "checkpoint"}]},
+            "extension": [{"url": CHECKPOINT_EXTENSION_URL, "valueString": json.dumps(cursor)}],
+        }
+        response = (self.client or get_client()).put(
+            "Basic",
+            params=self.search_params,
+            headers={'Prefer': 'return=representation'},
+            data=json.dumps(resource)
+        )
+        response.raise_for_status()
+        self.resource = response.json() if response.content else resource
+        logger.debug(f"Saved {self}")
+
+    def clear(self):
+        """Delete the checkpoint after the migration completed."""
+        if self.resource is None:
+            return
+        response = (self.client or get_client()).delete("Basic", params=self.search_params)
+        response.raise_for_status()
+        self.resource = None
+
+
+def accepts_checkpoint(function) -> bool:
+    """Whether the migration function takes the checkpoint argument.
+
+    Either its first parameter is required, or a parameter is named checkpoint;
+    optional parameters of helpers used as migration functions are left alone.
+    """
+    try:
+        parameters = list(inspect.signature(function).parameters.values())
+    except (TypeError, ValueError):
+        return False
+    if any(parameter.name == "checkpoint" for parameter in parameters):
+        return True
+    if not parameters:
+        return False
+    first = parameters[0]
+    return (
+        first.kind in (first.POSITIONAL_ONLY, first.POSITIONAL_OR_KEYWORD)
+        and first.default is first.empty
+    )
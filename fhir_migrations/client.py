@@ -0,0 +1,278 @@
+"""FHIR HTTP Client
+
+Defines a shared HTTP client for the FHIR store, backed by a single `requests.Session`
+with a pooled, keep-alive connection adapter. Reusing connections avoids a TCP (and
+TLS) handshake per request. The client is used by the MigrationManager and can be
+imported by migration scripts:
+
+    from fhir_migrations.client import get_client
+
+    client = get_client()
+    response = client.get("Patient", params={"identifier": "system|value"})
+
+    for patient in client.search("Patient", {"active": "true"}, count=500):
+        ...
+
+Searches are streamed page by page following the Bundle `next` links, and each page
+is decoded entry by entry as it arrives (BundleReader), so walking all resources of a
+type holds a single resource in memory rather than a page or the whole result. Relative paths are resolved
+against the FHIR_URL base, which `set_default_base_url` replaces for clients created
+without a base URL. Pool size, timeout and retries of idempotent requests are
+configured via the FHIR_POOL_SIZE, FHIR_TIMEOUT and FHIR_RETRIES environment
+variables, or by calling `configure_client`.
+"""
+import codecs
+import json
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from fhir_migrations.config import FHIR_POOL_SIZE, FHIR_RETRIES, FHIR_TIMEOUT, FHIR_URL
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_HEADERS = {
+    'Content-Type': 'application/fhir+json',
+    'Accept': 'application/fhir+json',
+}
+RETRY_STATUSES = (429, 502, 503, 504)
+# Bytes read from a streamed search page at a time
+SEARCH_CHUNK_SIZE = 64 * 1024
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = " \t\n\r"
+
+
+base_url_override = None
+
+
+def default_base_url() -> str:
+    """Base URL of clients created without one: FHIR_URL, unless replaced by set_default_base_url."""
+    return base_url_override or FHIR_URL
+
+
+def set_default_base_url(base_url: str = None):
+    """Point clients created without a base URL (sync and async) at base_url, FHIR_URL when None."""
+    global base_url_override
+    base_url_override = base_url
+
+
+class FHIRClient:
+    """Pooled HTTP client bound to a FHIR base URL."""
+
+    def __init__(self, base_url=None, pool_size=None, timeout=None, retries=None, headers=None):
+        self.base_url = base_url or default_base_url()
+        self.timeout = FHIR_TIMEOUT if timeout is None else timeout
+        pool_size = FHIR_POOL_SIZE if pool_size is None else pool_size
+        retries = FHIR_RETRIES if retries is None else retries
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUSES,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        self.session.headers.update(headers or {})
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __repr__(self):
+        return f"FHIRClient({self.base_url})"
+
+    def url(self, path: str) -> str:
+        """Resolve a path relative to the base URL, absolute URLs are kept."""
+        return resolve_url(self.base_url, path)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Send a request over the pooled session, applying the default timeout."""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, self.url(path), **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path: str, **kwargs) -> requests.Response:
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", path, **kwargs)
+
+    def search(self, resource_type: str, params: dict = None, count: int = None):
+        """Generator over the resources matching the search, following Bundle `next` links.
+        Pages are streamed and decoded one entry at a time; `count` sets the page size (_count)."""
+        params = dict(params or {})
+        if count is not None:
+            params["_count"] = count
+
+        response = self.get(resource_type, params=params, stream=True)
+        while response is not None:
+            with response:
+                response.raise_for_status()
+                bundle = BundleReader(response.iter_content(SEARCH_CHUNK_SIZE))
+                for entry in bundle:
+                    if entry.get("search", {}).get("mode", "match") == "match":
+                        yield entry["resource"]
+                next_url = next_link(bundle.members)
+
+            response = self.get(next_url, stream=True) if next_url else None
+
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
+
+
+class BundleReader:
+    """Incremental reader of a JSON Bundle arriving in byte chunks.
+    Iterating yields the items of the `entry` array one at a time, decoding each as
+    soon as its text is complete; only the current entry and the unread rest of a
+    chunk are buffered. The other members (link, total, ...) are collected in
+    `members` on the way."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.position = 0
+        self.exhausted = False
+        self.members = {}
+
+    def __iter__(self):
+        self.expect("{")
+        while self.skip(JSON_WHITESPACE + ",") not in ("}", ""):
+            key = self.value()
+            self.expect(":")
+            if key == "entry" and self.skip() == "[":
+                self.position += 1
+                while self.skip(JSON_WHITESPACE + ",") not in ("]", ""):
+                    yield self.value()
+                self.expect("]")
+            else:
+                self.members[key] = self.value()
+        self.expect("}")
+
+    def read_more(self) -> bool:
+        """Append the next chunk to the buffer, dropping the text already decoded.
+        Returns False once the stream is exhausted."""
+        if self.exhausted:
+            return False
+        self.text = self.text[self.position:]
+        self.position = 0
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                self.text += text
+                return True
+        self.text += self.decoder.decode(b"", final=True)
+        self.exhausted = True
+        return False
+
+    def skip(self, characters: str = JSON_WHITESPACE) -> str:
+        """Skip the characters, return the next one ('' at the end of the stream)."""
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in characters:
+                self.position += 1
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self.read_more():
+                return ""
+
+    def expect(self, character: str):
+        found = self.skip()
+        if found != character:
+            raise ValueError(f"Malformed Bundle: expected {character!r}, found {found!r}")
+        self.position += 1
+
+    def value(self):
+        """Decode the JSON value starting at the position, reading chunks until it is complete."""
+        self.skip()
+        while True:
+            try:
+                value, end = JSON_DECODER.raw_decode(self.text, self.position)
+            except json.JSONDecodeError:
+                if not self.read_more():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.text) and self.read_more():
+                continue
+            self.position = end
+            return value
+
+
+def resolve_url(base_url: str, path: str) -> str:
+    """Resolve a path relative to the base URL, absolute URLs are kept."""
+    if path.startswith(("http://", "https://")):
+        return path
+    if not path:
+        return base_url.rstrip('/')
+    return f"{base_url.rstrip('/')}/{path.lstrip('/')}"
+
+
+def body_size(request: requests.PreparedRequest) -> int:
+    """Size of the request body, the announced Content-Length of streamed (file) bodies."""
+    body = request.body
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return int(request.headers.get("Content-Length") or 0)
+
+
+def next_link(bundle: dict):
+    """Return the url of the next page of a search Bundle, None on the last page."""
+    for link in bundle.get("link", []):
+        if link.get("relation") == "next":
+            return link.get("url")
+    return None
+
+
+client_lock = threading.Lock()
+shared_client = None
+
+
+def get_client() -> FHIRClient:
+    """Return the shared client, creating it on first use."""
+    global shared_client
+    with client_lock:
+        if shared_client is None:
+            shared_client = FHIRClient()
+        return shared_client
+
+
+def forget_shared_client():
+    """Drop the shared client in a forked child process, its pooled connections belong to the parent."""
+    global client_lock, shared_client
+    client_lock = threading.Lock()
+    shared_client = None
+
+
+os.register_at_fork(after_in_child=forget_shared_client)
+
+
+def search(resource_type: str, params: dict = None, count: int = None):
+    """Search over the shared client, see FHIRClient.search."""
+    return get_client().search(resource_type, params=params, count=count)
+
+
+def configure_client(**kwargs) -> FHIRClient:
+    """Replace the shared client with one created from the given FHIRClient arguments."""
+    global shared_client
+    with client_lock:
+        if shared_client is not None:
+            shared_client.close()
+        shared_client = FHIRClient(**kwargs)
+        logger.debug(f"Configured shared {shared_client}")
+        return shared_client
@@ -1,15 +1,28 @@
 """Migration flask commands
 
 Defines number of commands relevant for creating and managing migrations.
+
+The Migration manager is created on first command use, so registering the
+blueprint neither scans the migrations directory nor imports the FHIR client.
 """
 
 from flask import Blueprint
 import click
 
-from fhir_migrations.migration import Migration
+from fhir_migrations.utils import SequenceError
 
 migration_blueprint = Blueprint('migration', __name__, cli_group=None)
-migration_manager = Migration()
+migration_manager = None
+
+
+def get_migration_manager():
+    """Return the Migration manager, creating it on first use."""
+    global migration_manager
+    if migration_manager is None:
+        from fhir_migrations.migration import Migration
+        migration_manager = Migration()
+    return migration_manager
+
 
 @migration_blueprint.cli.command("migrate", help="The name of the migration file to create")
 @click.argument('migration_name')
@@ -17,23 +30,219 @@ def migrate(migration_name):
     """
     Generates a new migration script in python.
     """
-    migration_manager.generate_migration_script(migration_name)
+    get_migration_manager().generate_migration_script(migration_name)
+
+
+def path_options(command):
+    """Options choosing how far to upgrade or downgrade."""
+    command = click.option(
+        "--steps", type=click.IntRange(min=0), default=None,
+        help="Number of migrations to run"
+    )(command)
+    command = click.option(
+        "--to", "to_revision", metavar="REVISION", default=None,
+        help="Revision to upgrade or downgrade to, 'base' to downgrade all migrations"
+    )(command)
+    return command
+
+
+def dry_run_options(command):
+    """Options planning a run without sending writes to FHIR."""
+    command = click.option(
+        "--latency", multiple=True, metavar="METHOD=SECONDS",
+        help="Estimated latency per request method for the dry run plan, e.g. PUT=0.2"
+    )(command)
+    command = click.option(
+        "--dry-run", is_flag=True,
+        help="Record writes instead of sending them and print the request plan"
+    )(command)
+    return command
+
+
+def metrics_options(command):
+    """Options writing a timing and request report of every migration run."""
+    command = click.option(
+        "--metrics-format", type=click.Choice(["json", "prometheus"]), default=None,
+        help="Format of the metrics report, by default Prometheus text for .prom files and JSON otherwise"
+    )(command)
+    command = click.option(
+        "--metrics-out", type=click.Path(dir_okay=False, writable=True), default=None,
+        help="Write per migration timing and FHIR request metrics to this file"
+    )(command)
+    return command
+
+
+def profile_options(command):
+    """Options profiling the migration function calls."""
+    command = click.option(
+        "--profile-interval", type=float, default=0.005, show_default=True,
+        help="Seconds between stack samples of the sampling profiler"
+    )(command)
+    command = click.option(
+        "--profile-mode", type=click.Choice(["cprofile", "sampling"]), default="cprofile", show_default=True,
+        help="Trace every call with cProfile, or sample stacks with low overhead"
+    )(command)
+    command = click.option(
+        "--profile", "profile_dir", type=click.Path(file_okay=False, writable=True), default=None,
+        help="Write a pstats and a collapsed stack file per migration to this directory"
+    )(command)
+    return command
+
+
+def target_options(command):
+    """Options running the migrations against several FHIR stores in parallel."""
+    command = click.option(
+        "--max-parallel", type=click.IntRange(min=1), default=None,
+        help="Number of targets migrated at the same time, FHIR_TARGET_CONCURRENCY by default"
+    )(command)
+    command = click.option(
+        "--targets-file", type=click.Path(exists=True, dir_okay=False), default=None,
+        help="File listing one target per line"
+    )(command)
+    command = click.option(
+        "--target", "targets", multiple=True, metavar="[NAME=]URL",
+        help="FHIR store to migrate instead of FHIR_URL, repeat for several stores"
+    )(command)
+    return command
+
+
+def run_options(command):
+    """Options shared by the upgrade and downgrade commands."""
+    return path_options(target_options(dry_run_options(metrics_options(profile_options(command)))))
+
+
+def migrate_targets(direction, targets=(), targets_file=None, max_parallel=None, to_revision=None, steps=None):
+    """Run the migrations on every target, printing the report. Exits with 1 when a target failed."""
+    import time
+    from fhir_migrations.targets import Target, format_report, read_targets, run_targets
+
+    try:
+        parsed = [Target.parse(target) for target in targets]
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--target")
+    if targets_file:
+        parsed.extend(read_targets(targets_file))
+
+    started = time.perf_counter()
+    # The sequence is validated once, before the workers start
+    results = run_targets(parsed, direction, get_migration_manager().migrations_dir, max_parallel,
+                          to_revision, steps)
+    click.echo(format_report(results, time.perf_counter() - started))
+    if not all(result.ok for result in results):
+        raise click.exceptions.Exit(1)
+
+
+def run_path(direction, **kwargs):
+    """Run the migrations of the manager, reporting a revision or steps the path cannot lead to
+    as a bad --to or --steps."""
+    from fhir_migrations.migration import RevisionPathError
+
+    try:
+        return get_migration_manager().run_migrations(direction, **kwargs)
+    except RevisionPathError as e:
+        raise click.BadParameter(str(e), param_hint="--steps" if kwargs.get("steps") is not None else "--to")
+
+
+def run_migrations(direction, dry_run=False, latency=(), metrics_out=None, metrics_format=None,
+                   profile_dir=None, profile_mode="cprofile", profile_interval=0.005,
+                   targets=(), targets_file=None, max_parallel=None, to_revision=None, steps=None):
+    """Run the migrations up or down to to_revision or for the steps, printing the plan of a dry run and
+    writing the requested metrics and profiles. With targets, the migrations are run on every target
+    instead of FHIR_URL."""
+    if to_revision is not None and steps is not None:
+        raise click.UsageError("--to and --steps cannot be combined")
+    if targets or targets_file:
+        if dry_run or metrics_out or profile_dir:
+            raise click.UsageError("--dry-run, --metrics-out and --profile are not supported with --target")
+        return migrate_targets(direction, targets, targets_file, max_parallel, to_revision, steps)
+
+    observers = []
+    recorder = None
+    if metrics_out:
+        from fhir_migrations.metrics import MetricsRecorder
+        recorder = MetricsRecorder()
+        observers.append(recorder)
+    if profile_dir:
+        from fhir_migrations.profiling import MigrationProfiler
+        observers.append(MigrationProfiler(profile_dir, profile_mode, profile_interval))
+
+    try:
+        if not dry_run:
+            run_path(direction, observers=observers, to_revision=to_revision, steps=steps)
+            return
+
+        from fhir_migrations.dry_run import LatencyModel, format_plan
+        try:
+            per_method = {method: float(seconds) for method, seconds in (item.split("=", 1) for item in latency)}
+        except ValueError:
+            raise click.BadParameter("Use METHOD=SECONDS, e.g. PUT=0.2", param_hint="--latency")
+
+        planner = run_path(direction, dry_run=True, latency_model=LatencyModel(per_method), observers=observers,
+                           to_revision=to_revision, steps=steps)
+        if planner is not None:
+            click.echo(format_plan(planner))
+    finally:
+        if recorder is not None:
+            from fhir_migrations.metrics import write_metrics
+            write_metrics(recorder, metrics_out, metrics_format)
 
 
 @migration_blueprint.cli.command("upgrade")
-def upgrade():
+@run_options
+def upgrade(**options):
     """
-    Runs all unapplied migrations present in the versions folder to upgrade the schema.
+    Runs all unapplied migrations present in the versions folder to upgrade the schema,
+    or those up to --to REVISION or the next --steps N.
     """
-    migration_manager.run_migrations("upgrade")
+    run_migrations("upgrade", **options)
 
 
 @migration_blueprint.cli.command("downgrade")
-def downgrade():
+@run_options
+def downgrade(**options):
+    """
+    Runs most recent migration to downgrade the schema,
+    or the migrations down to --to REVISION or the last --steps N.
+    """
+    run_migrations("downgrade", **options)
+
+
+@migration_blueprint.cli.command("compile")
+def compile():
+    """
+    Compiles the migrations metadata into a manifest stored in the versions folder.
+    """
+    get_migration_manager().compile_manifest()
+
+
+@migration_blueprint.cli.command("history")
+def history():
+    """
+    Lists the migrations in the order they are applied, marking the applied ones.
+    """
+    manager = get_migration_manager()
+    manager.build_migration_sequence()
+    applied_revisions = manager.applied_revisions()
+
+    for revision, location in manager.revision_sequence[:].locations():
+        marker = "*" if revision in applied_revisions else " "
+        click.echo(f"{marker} {revision} {location}")
+
+
+@migration_blueprint.cli.command("check")
+def check():
     """
-    Runs most recent migration to downgrade the schema.
+    Validates the migration sequence, reporting every problem found.
     """
-    migration_manager.run_migrations("downgrade")
+    try:
+        validation = get_migration_manager().validate_migrations()
+    except SequenceError as e:
+        validation = e.validation
+    for error in validation.errors:
+        click.echo(error, err=True)
+    if not validation.is_valid:
+        raise click.exceptions.Exit(1)
+    click.echo("Migration sequence is consistent.")
 
 
 @migration_blueprint.cli.command("reset")
@@ -41,4 +250,4 @@ def reset():
     """
     Resets the migration state by updating the latest applied migration in FHIR to None.
     """
-    migration_manager.update_latest_applied_migration_in_fhir(None)
+    get_migration_manager().update_latest_applied_migration_in_fhir(None)
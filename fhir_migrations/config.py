@@ -1,7 +1,31 @@
 import os
+import tempfile
 from pathlib import Path
 
 # Get the path to the examples directory
 EXAMPLES_DIR = os.path.join(Path(__file__).parent, "examples")
 
 MIGRATION_SCRIPTS_DIR = os.getenv("MIGRATION_SCRIPTS_DIR", str(EXAMPLES_DIR))
+
+# FHIR store connection settings
+FHIR_URL = os.getenv("FHIR_URL", 'http://fhir-internal:8080/fhir/')
+FHIR_TIMEOUT = float(os.getenv("FHIR_TIMEOUT", "30"))
+FHIR_POOL_SIZE = int(os.getenv("FHIR_POOL_SIZE", "10"))
+FHIR_RETRIES = int(os.getenv("FHIR_RETRIES", "3"))
+FHIR_ASYNC_CONCURRENCY = int(os.getenv("FHIR_ASYNC_CONCURRENCY", "100"))
+
+# Local spool of Bulk Data $export downloads
+FHIR_EXPORT_SPOOL_DIR = os.getenv(
+    "FHIR_EXPORT_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "fhir_migrations_export")
+)
+
+# Writer backend of open_writer(): "bundle" (batch/transaction Bundles) or "import" ($import)
+FHIR_WRITER_BACKEND = os.getenv("FHIR_WRITER_BACKEND", "bundle")
+# URL prefix $import input files are uploaded to with PUT, stored as Binary resources when unset
+FHIR_IMPORT_UPLOAD_URL = os.getenv("FHIR_IMPORT_UPLOAD_URL")
+
+# Number of FHIR stores upgraded in parallel worker processes by `--target`
+FHIR_TARGET_CONCURRENCY = int(os.getenv("FHIR_TARGET_CONCURRENCY", "4"))
+
+# Number of migrations of independent branches run at the same time by upgrade
+MIGRATION_BRANCH_CONCURRENCY = int(os.getenv("MIGRATION_BRANCH_CONCURRENCY", "4"))
@@ -0,0 +1,223 @@
+"""Migration Discovery
+
+Reads migration metadata (revision, down_revision and the presence of the
+upgrade/downgrade functions) from the source of a migration script without
+executing it. Migration scripts usually import third party libraries, configure
+logging and build module level data, none of which is needed to order migrations.
+
+Only when a value cannot be resolved statically (e.g. a revision computed at import
+time) the module is loaded to read the attribute, matching the previous behaviour.
+
+The metadata can be compiled into a manifest stored in the migrations directory.
+Files whose mtime and size, or content hash, match the manifest are not parsed again.
+
+Migration scripts are loaded with importlib into isolated, uniquely named modules
+which are dropped once the migration has run, so the globals of previously run
+migrations do not accumulate during long upgrades.
+"""
+import ast
+import hashlib
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import sys
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+REQUIRED_VARIABLES = ("revision", "down_revision")
+REQUIRED_FUNCTIONS = ("upgrade", "downgrade")
+MODULE_PREFIX = "fhir_migrations_script_"
+
+module_counter = itertools.count()
+
+
+def parse_migration_source(source: str, file_name: str = "<migration>") -> dict:
+    """Collect module level literal assignments and function names from source.
+    Values which are not literals are omitted from the returned variables."""
+    tree = ast.parse(source, filename=file_name)
+    variables = {}
+    dynamic = set()
+    functions = set()
+
+    for statement in tree.body:
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            functions.add(statement.name)
+            continue
+
+        if isinstance(statement, ast.Assign):
+            targets = statement.targets
+        elif isinstance(statement, ast.AnnAssign) and statement.value is not None:
+            targets = [statement.target]
+        else:
+            continue
+
+        for target in targets:
+            if not isinstance(target, ast.Name) or target.id not in REQUIRED_VARIABLES:
+                continue
+            try:
+                variables[target.id] = ast.literal_eval(statement.value)
+                dynamic.discard(target.id)
+            except ValueError:
+                variables.pop(target.id, None)
+                dynamic.add(target.id)
+
+    return {"variables": variables, "dynamic": dynamic, "functions": functions}
+
+
+def read_migration_file(file_path: str) -> tuple:
+    """Return (revision, down_revision) of the migration script at file_path.
+    Raises RuntimeError if the script misses a required variable or method."""
+    with open(file_path, "r") as migration_file:
+        source = migration_file.read()
+
+    parsed = parse_migration_source(source, file_path)
+    variables = parsed["variables"]
+    missing_functions = [name for name in REQUIRED_FUNCTIONS if name not in parsed["functions"]]
+    missing_variables = [name for name in REQUIRED_VARIABLES if name not in variables]
+
+    if parsed["dynamic"] or missing_functions or missing_variables:
+        # Fall back to executing the script when its metadata is not static
+        logger.debug(f"Loading {file_path} to resolve migration metadata")
+        return read_migration_module(file_path)
+
+    return str(variables["revision"]), variables["down_revision"]
+
+
+def read_migration_module(file_path: str) -> tuple:
+    """Return (revision, down_revision) by executing the migration script."""
+    with load_migration_module(file_path) as migration_module:
+        check_migration_module(migration_module, file_path)
+        return str(migration_module.revision), migration_module.down_revision
+
+
+@contextmanager
+def load_migration_module(file_path: str):
+    """Load the migration script into its own module namespace.
+    The module is registered in sys.modules under a unique name only while the
+    context is active. Afterwards it is dropped and its namespace cleared: module
+    functions reference the namespace through __globals__, a cycle that would keep
+    the globals alive until a full collection.
+    Compiled bytecode is cached in __pycache__ by the source file loader."""
+    module_name = f"{MODULE_PREFIX}{next(module_counter)}_{module_suffix(file_path)}"
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    if spec is None:
+        raise ImportError(f"Cannot load migration script {file_path}")
+
+    migration_module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = migration_module
+    try:
+        spec.loader.exec_module(migration_module)
+        yield migration_module
+    finally:
+        sys.modules.pop(module_name, None)
+        migration_module.__dict__.clear()
+
+
+def module_suffix(file_path: str) -> str:
+    """Identifier-safe suffix of the module name derived from the file name."""
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    return "".join(character if character.isalnum() else "_" for character in file_name)
+
+
+def check_migration_module(migration_module, file_path: str):
+    """Check for required attributes and methods of a loaded migration."""
+    file_name = os.path.basename(file_path)
+    for name in REQUIRED_VARIABLES:
+        if not hasattr(migration_module, name):
+            raise RuntimeError(f"Migration '{file_name}' is missing '{name}' variable.")
+    for name in REQUIRED_FUNCTIONS:
+        if not callable(getattr(migration_module, name, None)):
+            raise RuntimeError(f"Migration '{file_name}' is missing '{name}' method.")
+
+
+## COMPILED MANIFEST
+MANIFEST_FILE_NAME = ".migrations_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_hash(file_path: str) -> str:
+    """Return the sha256 hex digest of the file content."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as migration_file:
+        for chunk in iter(lambda: migration_file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(migrations_dir: str) -> dict:
+    """Load the compiled manifest of the migrations directory.
+    Returns None when no usable manifest exists."""
+    manifest_path = os.path.join(migrations_dir, MANIFEST_FILE_NAME)
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.warning(f"Ignoring unreadable migration manifest {manifest_path}: {e}")
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        logger.warning(f"Ignoring migration manifest {manifest_path} of unsupported version")
+        return None
+
+    return manifest
+
+
+def write_manifest(migrations_dir: str, entries: dict) -> str:
+    """Write the manifest with the per-file entries. The migration order is not stored,
+    it is derived from the entries, as the files have to be checked for changes anyway."""
+    manifest_path = os.path.join(migrations_dir, MANIFEST_FILE_NAME)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "migrations": entries,
+    }
+    temporary_path = f"{manifest_path}.tmp"
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(temporary_path, manifest_path)
+
+    return manifest_path
+
+
+def scan_migrations(migrations_dir: str, manifest: dict = None) -> dict:
+    """Return manifest entries for every migration file in the directory.
+    Entries of unchanged files (same mtime and size, or same content hash)
+    are reused from the manifest, other files are parsed."""
+    known_entries = manifest["migrations"] if manifest else {}
+    entries = {}
+
+    try:
+        directory_entries = sorted(
+            (entry for entry in os.scandir(migrations_dir) if entry.name.endswith('.py')),
+            key=lambda entry: entry.name
+        )
+    except FileNotFoundError:
+        return entries
+
+    for directory_entry in directory_entries:
+        file_name = directory_entry.name
+        file_stat = directory_entry.stat()
+        known_entry = known_entries.get(file_name)
+
+        if known_entry and known_entry["mtime"] == file_stat.st_mtime_ns \
+                and known_entry["size"] == file_stat.st_size:
+            entries[file_name] = known_entry
+            continue
+
+        content_hash = file_hash(directory_entry.path)
+        if known_entry and known_entry["hash"] == content_hash:
+            entry = dict(known_entry)
+        else:
+            revision, down_revision = read_migration_file(directory_entry.path)
+            entry = {"revision": revision, "down_revision": down_revision, "hash": content_hash}
+
+        entry["mtime"] = file_stat.st_mtime_ns
+        entry["size"] = file_stat.st_size
+        entries[file_name] = entry
+
+    return entries
@@ -0,0 +1,264 @@
+"""Dry Run Planning
+
+Runs migrations against an intercepting transport mounted on the shared FHIR
+client: reads are sent to the FHIR store, writes (POST, PUT, PATCH, DELETE) are
+recorded and answered locally without reaching the server. Every request is
+accounted to the running migration, producing a plan with request counts by
+method and resource type, payload bytes and an estimated duration:
+
+    flask upgrade --dry-run --latency PUT=0.2
+
+Entries of batch/transaction Bundles are counted individually. Requests sent through
+the shared client (`fhir_migrations.client`), the clients passed to the DryRun (e.g.
+the client of the Migration) and AsyncFHIRClients created during the dry run are
+intercepted; migrations calling `requests` directly, or reading back data they
+wrote, are not planned accurately.
+"""
+import json
+import logging
+from collections import Counter
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+
+from fhir_migrations.client import body_size, get_client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+DEFAULT_LATENCY = 0.05
+
+# The DryRun entered last, AsyncFHIRClients created meanwhile intercept their requests with it
+active_dry_run = None
+
+
+class LatencyModel:
+    """Estimated seconds per request by method, plus a cost per sent kilobyte."""
+
+    def __init__(self, per_method: dict = None, default: float = DEFAULT_LATENCY, per_kilobyte: float = 0.0):
+        self.per_method = {method.upper(): seconds for method, seconds in (per_method or {}).items()}
+        self.default = default
+        self.per_kilobyte = per_kilobyte
+
+    def estimate(self, method: str, bytes_sent: int) -> float:
+        return self.per_method.get(method, self.default) + self.per_kilobyte * bytes_sent / 1024
+
+
+class MigrationPlan:
+    """Requests a single migration would send."""
+
+    def __init__(self, revision: str = None, direction: str = None, location: str = None):
+        self.revision = revision
+        self.direction = direction
+        self.location = location
+        self.requests = Counter()
+        self.entries = Counter()
+        self.bytes_sent = 0
+        self.estimated_seconds = 0.0
+        self.error = None
+
+    def __repr__(self):
+        return f"MigrationPlan({self.revision}: {self.request_count} requests)"
+
+    @property
+    def request_count(self) -> int:
+        return sum(self.requests.values())
+
+    def as_dict(self) -> dict:
+        return {
+            "revision": self.revision,
+            "direction": self.direction,
+            "location": self.location,
+            "requests": [
+                {"method": method, "resource_type": resource_type, "count": count}
+                for (method, resource_type), count in sorted(self.requests.items())
+            ],
+            "bundle_entries": [
+                {"method": method, "resource_type": resource_type, "count": count}
+                for (method, resource_type), count in sorted(self.entries.items())
+            ],
+            "bytes_sent": self.bytes_sent,
+            "estimated_seconds": round(self.estimated_seconds, 6),
+            "error": self.error,
+        }
+
+
+class DryRun:
+    """Intercepts writes of the shared client, and of the additional clients, and accounts
+    requests per migration. Used as a context manager, and as a Migration observer."""
+
+    def __init__(self, client=None, latency_model: LatencyModel = None, clients=()):
+        self.client = client or get_client()
+        self.clients = [self.client] + [other for other in clients if other is not self.client]
+        self.latency_model = latency_model or LatencyModel()
+        self.overhead = MigrationPlan()
+        self.plans = []
+        self.current = self.overhead
+        self.mounted_adapters = None
+        self.previous_dry_run = None
+
+    def __enter__(self):
+        global active_dry_run
+        self.mounted_adapters = []
+        for client in self.clients:
+            adapters = client.session.adapters
+            self.mounted_adapters.append((client, dict(adapters)))
+            for prefix, adapter in list(adapters.items()):
+                adapters[prefix] = DryRunAdapter(self, adapter)
+        self.previous_dry_run, active_dry_run = active_dry_run, self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active_dry_run
+        active_dry_run = self.previous_dry_run
+        for client, adapters in self.mounted_adapters:
+            client.session.adapters.update(adapters)
+        self.mounted_adapters = None
+
+    def begin_migration(self, revision: str, direction: str, location: str = None):
+        self.current = MigrationPlan(revision, direction, location)
+        self.plans.append(self.current)
+
+    def end_migration(self, revision: str, direction: str, error: BaseException = None):
+        if error is not None:
+            self.current.error = str(error)
+        self.current = self.overhead
+
+    @property
+    def total(self) -> MigrationPlan:
+        """Accounting summed over the migrations and the state requests."""
+        total = MigrationPlan("total")
+        for plan in self.plans + [self.overhead]:
+            total.requests.update(plan.requests)
+            total.entries.update(plan.entries)
+            total.bytes_sent += plan.bytes_sent
+            total.estimated_seconds += plan.estimated_seconds
+        return total
+
+    def resource_type(self, url: str) -> str:
+        """First path segment relative to the FHIR base, e.g. Patient for Patient/1."""
+        base_path = urlparse(self.client.base_url).path.rstrip("/")
+        path = urlparse(url).path
+        if path.startswith(base_path):
+            path = path[len(base_path):]
+        return path.strip("/").split("/")[0] or "(base)"
+
+    def record(self, request: requests.PreparedRequest):
+        """Account the request to the running migration."""
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        return self.account(request.method, request.url, body, body_size(request))
+
+    def account(self, method: str, url: str, body, sent: int):
+        """Account a request with its body (bytes, or a stream which is not parsed) to the
+        running migration. Returns the posted Bundle, None for other requests."""
+        plan = self.current
+        resource_type = self.resource_type(url)
+
+        bundle = None
+        if method == "POST" and resource_type == "(base)" and isinstance(body, bytes):
+            bundle = parse_bundle(body)
+        if bundle is not None:
+            resource_type = "Bundle"
+            for entry in bundle.get("entry", []):
+                entry_request = entry.get("request", {})
+                entry_type = entry_request.get("url", "").split("?")[0].split("/")[0]
+                plan.entries[(entry_request.get("method"), entry_type)] += 1
+
+        plan.requests[(method, resource_type)] += 1
+        plan.bytes_sent += sent
+        plan.estimated_seconds += self.latency_model.estimate(method, sent)
+        return bundle
+
+
+class DryRunAdapter(BaseAdapter):
+    """Transport adapter passing reads to the wrapped adapter and answering writes locally."""
+
+    def __init__(self, dry_run: DryRun, adapter: BaseAdapter):
+        super().__init__()
+        self.dry_run = dry_run
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        bundle = self.dry_run.record(request)
+        if request.method not in WRITE_METHODS:
+            return self.adapter.send(request, **kwargs)
+
+        logger.debug(f"Dry run: not sending {request.method} {request.url}")
+        return simulated_response(request, bundle)
+
+    def close(self):
+        self.adapter.close()
+
+
+def dry_run_adapter(client):
+    """The DryRunAdapter mounted on the client, possibly wrapped by another adapter;
+    None outside of a dry run."""
+    for adapter in client.session.adapters.values():
+        while adapter is not None:
+            if isinstance(adapter, DryRunAdapter):
+                return adapter
+            adapter = getattr(adapter, "adapter", None)
+    return None
+
+
+def parse_bundle(body: bytes):
+    """Return the Bundle posted in body, None for other payloads."""
+    try:
+        resource = json.loads(body or b"null")
+    except ValueError:
+        return None
+    if isinstance(resource, dict) and resource.get("resourceType") == "Bundle":
+        return resource
+    return None
+
+
+def simulated_response(request, bundle: dict = None) -> requests.Response:
+    """Successful response to a write which was not sent."""
+    response = requests.Response()
+    response.request = request
+    response.url = request.url
+    response.headers["Content-Type"] = "application/fhir+json"
+    response.status_code, response.reason, response._content = simulated_content(
+        request.method, request.body, bundle)
+    return response
+
+
+def simulated_content(method: str, body, bundle: dict = None) -> tuple:
+    """Status code, reason and body of the successful response to a write which was not sent."""
+    if method == "DELETE":
+        return 204, "No Content", b""
+    if bundle is not None:
+        return 200, "OK", json.dumps({
+            "resourceType": "Bundle",
+            "type": f"{bundle.get('type', 'batch')}-response",
+            "entry": [{"response": {"status": "200 OK"}} for _ in bundle.get("entry", [])],
+        }).encode("utf-8")
+    body = body or b"{}"
+    if not isinstance(body, (bytes, str)):
+        # Streamed (file) bodies are not echoed
+        body = b"{}"
+    return 200, "OK", body.encode("utf-8") if isinstance(body, str) else body
+
+
+def format_plan(dry_run: DryRun) -> str:
+    """Human readable plan, one block per migration followed by the totals."""
+    lines = []
+    for plan in dry_run.plans + [dry_run.overhead, dry_run.total]:
+        title = plan.revision or "migration state"
+        if plan.location:
+            title = f"{title} ({plan.location})"
+        lines.append(
+            f"{title}: {plan.request_count} requests, {plan.bytes_sent} bytes sent, "
+            f"estimated {plan.estimated_seconds:.1f}s"
+        )
+        for (method, resource_type), count in sorted(plan.requests.items()):
+            lines.append(f"    {method} {resource_type}: {count}")
+        for (method, resource_type), count in sorted(plan.entries.items()):
+            lines.append(f"    Bundle entry {method} {resource_type}: {count}")
+        if plan.error:
+            lines.append(f"    failed: {plan.error}")
+    return "\n".join(lines)
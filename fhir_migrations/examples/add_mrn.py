@@ -1,8 +1,11 @@
-import requests
+import itertools
 import json
 import logging
-import os
-import sys
+
+from requests import HTTPError
+
+from fhir_migrations.client import get_client
+from fhir_migrations.executor import FatalItemError, run_concurrently
 
 # Migration script generated for adding MRNs to Patient resources
 revision = 'c5a1c49e-8efb-4610-b9d3-f59f98541f16'
@@ -11,13 +14,8 @@ down_revision = 'd5a1c49e-8efb-4610-b9d3-f59f98541f16'
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Define the FHIR server base URL
-FHIR_SERVER_URL = os.getenv('FHIR_URL')
-
-# Headers for FHIR requests
-HEADERS = {
-    'Content-Type': 'application/fhir+json'
-}
+# Shared, pooled FHIR client (base URL from the FHIR_URL environment variable)
+client = get_client()
 
 # Mock patient to MRN map
 patient_mrn_map = [
@@ -26,33 +24,30 @@ patient_mrn_map = [
 ]
 
 def upgrade():
-    for record in patient_mrn_map:
-        pat_id = record['PAT_ID']
-        mrn = record['MRN']
-        add_mrn_to_patient(pat_id, mrn)
+    # Records are processed concurrently, a fatal error cancels the remaining ones
+    run_concurrently(patient_mrn_map, lambda record: add_mrn_to_patient(record['PAT_ID'], record['MRN']))
+
+def find_patients(pat_id):
+    # Search for the patient resource, two matches are enough to detect duplicates
+    matches = client.search('Patient', {"identifier": f'uwDAL_Clarity|{pat_id}'})
+    return list(itertools.islice(matches, 2))
 
 def add_mrn_to_patient(pat_id, mrn):
     # Fetch the existing patient resource
-    response = requests.get(
-        f'{FHIR_SERVER_URL}/Patient',
-        params={"identifier": f'uwDAL_Clarity|{pat_id}'},
-        headers=HEADERS
-    )
-    
-    if response.status_code != 200:
-        logging.error(f'Failed to fetch patient {pat_id}: {response.status_code} {response.text}')
+    try:
+        patients = find_patients(pat_id)
+    except HTTPError as e:
+        logging.error(f'Failed to fetch patient {pat_id}: {e}')
         return
 
-    patients = response.json().get('entry', [])
     if not patients:
         logging.error(f'No patient found with PAT_ID {pat_id}.')
         return
 
     if len(patients) > 1:
-        logging.error(f'Multiple patients found with PAT_ID {pat_id}. Halting the upgrade process.')
-        sys.exit(1)
+        raise FatalItemError(f'Multiple patients found with PAT_ID {pat_id}. Halting the upgrade process.')
 
-    patient_resource = patients[0]['resource']
+    patient_resource = patients[0]
     
     # Replace or add the MRN identifier
     identifiers = patient_resource.get('identifier', [])
@@ -71,9 +66,8 @@ def add_mrn_to_patient(pat_id, mrn):
     patient_resource['identifier'] = identifiers
     
     # Update the patient resource
-    update_response = requests.put(
-        f"{FHIR_SERVER_URL}/Patient/{patient_resource['id']}",
-        headers=HEADERS,
+    update_response = client.put(
+        f"Patient/{patient_resource['id']}",
         data=json.dumps(patient_resource)
     )
     
@@ -83,28 +77,24 @@ def add_mrn_to_patient(pat_id, mrn):
         logging.error(f'Failed to update Patient {pat_id}: {update_response.status_code} {update_response.text}')
 
 def downgrade():
-    for record in patient_mrn_map:
-        pat_id = record['PAT_ID']
-        mrn = record['MRN']
-        remove_mrn_from_patient(pat_id, mrn)
+    run_concurrently(patient_mrn_map, lambda record: remove_mrn_from_patient(record['PAT_ID'], record['MRN']))
 
 def remove_mrn_from_patient(pat_id, mrn):
     # Fetch the existing patient resource
-    response = requests.get(f'{FHIR_SERVER_URL}/Patient?identifier=uwDAL_Clarity|{pat_id}', headers=HEADERS)
-    if response.status_code != 200:
-        logging.error(f'Failed to fetch patient {pat_id}: {response.status_code} {response.text}')
+    try:
+        patients = find_patients(pat_id)
+    except HTTPError as e:
+        logging.error(f'Failed to fetch patient {pat_id}: {e}')
         return
 
-    patients = response.json().get('entry', [])
     if not patients:
         logging.error(f'No patient found with PAT_ID {pat_id}.')
         return
 
     if len(patients) > 1:
-        logging.error(f'Multiple patients found with PAT_ID {pat_id}. Halting the downgrade process.')
-        sys.exit(1)
+        raise FatalItemError(f'Multiple patients found with PAT_ID {pat_id}. Halting the downgrade process.')
 
-    patient_resource = patients[0]['resource']
+    patient_resource = patients[0]
     # Remove the MRN identifier
     updated_identifiers = [id for id in patient_resource['identifier'] if id['value'] != mrn]
     
@@ -114,9 +104,8 @@ def remove_mrn_from_patient(pat_id, mrn):
 
     patient_resource['identifier'] = updated_identifiers
     # Update the patient resource
-    update_response = requests.put(
-        f"{FHIR_SERVER_URL}/Patient/{patient_resource['id']}",
-        headers=HEADERS,
+    update_response = client.put(
+        f"Patient/{patient_resource['id']}",
         data=json.dumps(patient_resource)
     )
     
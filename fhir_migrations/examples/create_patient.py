@@ -1,7 +1,7 @@
-import requests
 import json
 import logging
-import os
+
+from fhir_migrations.client import get_client
 
 # Migration script generated for add_active
 revision = '985f4e1e-29f5-4911-bc9c-2c774b685289'
@@ -10,15 +10,10 @@ down_revision = 'None'
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Define the FHIR server base URL
-FHIR_SERVER_URL = os.getenv('FHIR_URL')
+# Shared, pooled FHIR client (base URL from the FHIR_URL environment variable)
+client = get_client()
 PATIENT_ID = 'example'
 
-# Headers for FHIR requests
-HEADERS = {
-    'Content-Type': 'application/fhir+json'
-}
-
 def upgrade():
     # Defines upgrading function ran on upgrade command
     patient_resource = {
@@ -43,7 +38,7 @@ def upgrade():
         "gender": "male",
         "birthDate": "1980-01-01"
     }
-    response = requests.put(f'{FHIR_SERVER_URL}/Patient/{PATIENT_ID}', headers=HEADERS, data=json.dumps(patient_resource))
+    response = client.put(f'Patient/{PATIENT_ID}', data=json.dumps(patient_resource))
     if response.status_code == 200 or response.status_code == 201:
         logging.info('Patient created successfully.')
     else:
@@ -51,7 +46,7 @@ def upgrade():
 
 def downgrade():
     # Defines downgrading function ran on downgrade command
-    response = requests.delete(f'{FHIR_SERVER_URL}/Patient/{PATIENT_ID}', headers=HEADERS)
+    response = client.delete(f'Patient/{PATIENT_ID}')
     if response.status_code == 200 or response.status_code == 204:
         logging.info('Patient deleted successfully.')
     else:
@@ -0,0 +1,109 @@
+"""Concurrent Executor
+
+Runs a per-item function of a data migration over an iterable of work items on a
+bounded thread pool, so network bound steps overlap instead of waiting on each
+other:
+
+    from fhir_migrations.executor import FatalItemError, run_concurrently
+
+    def upgrade():
+        run_concurrently(patient_mrn_map, add_mrn, max_workers=8)
+
+Items are consumed lazily, keeping at most twice the worker count in flight.
+Errors are collected in the order of the items. Raising FatalItemError (or one of
+the `fatal_exceptions`) from the item function stops scheduling new items, cancels
+the queued ones and fails the run once the running ones finished.
+"""
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from fhir_migrations.config import FHIR_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class FatalItemError(Exception):
+    """Raised by an item function to cancel the remaining work."""
+
+
+class ItemError:
+    """Exception raised while processing the item at the given position."""
+
+    def __init__(self, index: int, item, exception: BaseException):
+        self.index = index
+        self.item = item
+        self.exception = exception
+
+    def __repr__(self):
+        return f"ItemError({self.index}: {self.exception!r})"
+
+
+class MigrationExecutionError(RuntimeError):
+    """Raised when items failed, holding the ItemErrors ordered by item position."""
+
+    def __init__(self, errors: list, cancelled: bool = False):
+        first = errors[0]
+        action = "Cancelled after" if cancelled else "Completed with"
+        super().__init__(f"{action} {len(errors)} failed item(s), first at item {first.index}: {first.exception}")
+        self.errors = errors
+        self.cancelled = cancelled
+
+
+class ExecutionReport:
+    """Summary of a concurrent run."""
+
+    def __init__(self):
+        self.completed = 0
+        self.errors = []
+        self.cancelled = False
+
+    def __repr__(self):
+        return f"ExecutionReport(completed={self.completed}, errors={len(self.errors)}, cancelled={self.cancelled})"
+
+
+def run_concurrently(items, func, max_workers: int = None, fatal_exceptions: tuple = (FatalItemError,),
+                     raise_errors: bool = True) -> ExecutionReport:
+    """Call func(item) for every item on a pool of max_workers threads (FHIR_POOL_SIZE by default).
+    Raises MigrationExecutionError when any item failed, unless raise_errors is False."""
+    max_workers = max_workers or FHIR_POOL_SIZE
+    report = ExecutionReport()
+    cancel = threading.Event()
+    in_flight = {}
+
+    def collect(futures):
+        for future in futures:
+            index, item = in_flight.pop(future)
+            if future.cancelled():
+                continue
+            exception = future.exception()
+            if exception is None:
+                report.completed += 1
+                continue
+            report.errors.append(ItemError(index, item, exception))
+            if isinstance(exception, fatal_exceptions):
+                logger.error(f"Fatal error on item {index}, cancelling remaining items: {exception}")
+                cancel.set()
+            else:
+                logger.error(f"Error on item {index}: {exception}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, item in enumerate(items):
+            if cancel.is_set():
+                break
+            in_flight[executor.submit(func, item)] = (index, item)
+            if len(in_flight) >= max_workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        if cancel.is_set():
+            for future in in_flight:
+                future.cancel()
+        collect(list(in_flight))
+
+    report.cancelled = cancel.is_set()
+    report.errors.sort(key=lambda error: error.index)
+    if report.errors and raise_errors:
+        raise MigrationExecutionError(report.errors, cancelled=report.cancelled)
+    return report
@@ -0,0 +1,249 @@
+"""Migration Metrics
+
+Measures every migration run: wall and CPU time, HTTP requests by method and
+status, bytes sent and received, and the time spent waiting on the FHIR store.
+Requests of the shared client are timed at the transport adapter, the time not
+spent waiting on FHIR (`code_seconds`) is the time spent in the migration code:
+
+    flask upgrade --metrics-out metrics.json
+    flask upgrade --metrics-out metrics.prom
+
+Reports are written as JSON, or in the Prometheus text exposition format for the
+`.prom` extension (or `--metrics-format prometheus`), e.g. for the node exporter
+textfile collector. Requests sent concurrently overlap, so their summed wait time
+can exceed the wall time; retries of throttled requests are counted once, with the
+final status. Requests outside of a migration (reading the migration state) are
+accounted to `overhead`.
+"""
+import json
+import logging
+import threading
+import time
+from collections import Counter
+
+from requests.adapters import BaseAdapter
+
+from fhir_migrations.client import body_size, get_client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+METRICS_FORMATS = ("json", "prometheus")
+PROMETHEUS_PREFIX = "fhir_migration"
+
+
+class MigrationMetrics:
+    """Timing and HTTP activity of a single migration run."""
+
+    def __init__(self, revision: str = None, direction: str = None, location: str = None):
+        self.revision = revision
+        self.direction = direction
+        self.location = location
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.fhir_seconds = 0.0
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = None
+        self.started = None
+        self.started_cpu = None
+
+    def __repr__(self):
+        return f"MigrationMetrics({self.revision}: {self.wall_seconds:.3f}s, {self.request_count} requests)"
+
+    @property
+    def request_count(self) -> int:
+        return sum(self.requests.values())
+
+    @property
+    def code_seconds(self) -> float:
+        """Wall time not spent waiting on FHIR responses."""
+        return max(self.wall_seconds - self.fhir_seconds, 0.0)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+
+    def stop(self):
+        self.wall_seconds = time.perf_counter() - self.started
+        self.cpu_seconds = time.process_time() - self.started_cpu
+
+    def as_dict(self) -> dict:
+        return {
+            "revision": self.revision,
+            "direction": self.direction,
+            "location": self.location,
+            "succeeded": self.error is None,
+            "error": self.error,
+            "wall_seconds": round(self.wall_seconds, 6),
+            "cpu_seconds": round(self.cpu_seconds, 6),
+            "fhir_seconds": round(self.fhir_seconds, 6),
+            "code_seconds": round(self.code_seconds, 6),
+            "requests": [
+                {"method": method, "status": status, "count": count}
+                for (method, status), count in sorted(self.requests.items())
+            ],
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+class MetricsRecorder:
+    """Times the requests of the shared client and accounts them per migration.
+    Used as a context manager, and as a Migration observer."""
+
+    def __init__(self, client=None):
+        self.client = client or get_client()
+        self.overhead = MigrationMetrics()
+        self.migrations = []
+        self.current = self.overhead
+        self.lock = threading.Lock()
+        self.mounted_adapters = None
+        # Duration of the whole run, migrations and overhead
+        self.run = MigrationMetrics()
+
+    def __enter__(self):
+        self.run.start()
+        adapters = self.client.session.adapters
+        self.mounted_adapters = dict(adapters)
+        for prefix, adapter in self.mounted_adapters.items():
+            adapters[prefix] = MetricsAdapter(self, adapter)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.client.session.adapters.update(self.mounted_adapters)
+        self.mounted_adapters = None
+        self.run.stop()
+
+    def begin_migration(self, revision: str, direction: str, location: str = None):
+        metrics = MigrationMetrics(revision, direction, location)
+        self.migrations.append(metrics)
+        self.current = metrics
+        metrics.start()
+
+    def end_migration(self, revision: str, direction: str, error: BaseException = None):
+        metrics = self.current
+        metrics.stop()
+        if error is not None:
+            metrics.error = str(error)
+        self.current = self.overhead
+        logger.info(
+            f"Migration {revision} {direction} took {metrics.wall_seconds:.2f}s "
+            f"(cpu {metrics.cpu_seconds:.2f}s, FHIR wait {metrics.fhir_seconds:.2f}s, "
+            f"{metrics.request_count} requests)"
+        )
+
+    def record(self, method: str, status: int, seconds: float, bytes_sent: int, bytes_received: int):
+        """Account a completed request to the running migration."""
+        with self.lock:
+            metrics = self.current
+            metrics.requests[(method, status)] += 1
+            metrics.fhir_seconds += seconds
+            metrics.bytes_sent += bytes_sent
+            metrics.bytes_received += bytes_received
+
+    def as_dict(self) -> dict:
+        return {
+            "wall_seconds": round(self.run.wall_seconds, 6),
+            "cpu_seconds": round(self.run.cpu_seconds, 6),
+            "migrations": [metrics.as_dict() for metrics in self.migrations],
+            "overhead": self.overhead.as_dict(),
+        }
+
+
+class MetricsAdapter(BaseAdapter):
+    """Transport adapter timing the requests sent through the wrapped adapter."""
+
+    def __init__(self, recorder: MetricsRecorder, adapter: BaseAdapter):
+        super().__init__()
+        self.recorder = recorder
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        sent = body_size(request)
+        start = time.perf_counter()
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except Exception:
+            self.recorder.record(request.method, 0, time.perf_counter() - start, sent, 0)
+            raise
+
+        if kwargs.get("stream"):
+            # Streamed bodies are read by the caller, count the announced size
+            received = int(response.headers.get("Content-Length") or 0)
+        else:
+            received = len(response.content or b"")
+        self.recorder.record(request.method, response.status_code, time.perf_counter() - start, sent, received)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def format_json(recorder: MetricsRecorder) -> str:
+    return json.dumps(recorder.as_dict(), indent=2)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_labels(metrics: MigrationMetrics, **extra) -> str:
+    labels = {
+        "revision": metrics.revision or "",
+        "direction": metrics.direction or "",
+        "location": metrics.location or "",
+    }
+    labels.update(extra)
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + "}"
+
+
+def format_prometheus(recorder: MetricsRecorder) -> str:
+    """Report in the Prometheus text exposition format, the overhead has an empty revision label."""
+    metrics_list = recorder.migrations + [recorder.overhead]
+    families = [
+        ("wall_seconds", "gauge", "Wall time of the migration run", lambda m: m.wall_seconds),
+        ("cpu_seconds", "gauge", "CPU time of the process during the migration run", lambda m: m.cpu_seconds),
+        ("fhir_wait_seconds", "gauge", "Time spent waiting on FHIR responses", lambda m: m.fhir_seconds),
+        ("code_seconds", "gauge", "Wall time not spent waiting on FHIR", lambda m: m.code_seconds),
+        ("succeeded", "gauge", "Whether the migration run succeeded", lambda m: int(m.error is None)),
+        ("http_sent_bytes_total", "counter", "Request body bytes sent to FHIR", lambda m: m.bytes_sent),
+        ("http_received_bytes_total", "counter", "Response body bytes received from FHIR",
+         lambda m: m.bytes_received),
+    ]
+
+    lines = [
+        f"# HELP {PROMETHEUS_PREFIX}_run_wall_seconds Wall time of the whole run",
+        f"# TYPE {PROMETHEUS_PREFIX}_run_wall_seconds gauge",
+        f"{PROMETHEUS_PREFIX}_run_wall_seconds {recorder.run.wall_seconds}",
+        f"# HELP {PROMETHEUS_PREFIX}_run_cpu_seconds CPU time of the whole run",
+        f"# TYPE {PROMETHEUS_PREFIX}_run_cpu_seconds gauge",
+        f"{PROMETHEUS_PREFIX}_run_cpu_seconds {recorder.run.cpu_seconds}",
+    ]
+    for name, metric_type, description, value in families:
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {description}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {metric_type}")
+        for metrics in metrics_list:
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{prometheus_labels(metrics)} {value(metrics)}")
+
+    lines.append(f"# HELP {PROMETHEUS_PREFIX}_http_requests_total FHIR requests by method and status")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_http_requests_total counter")
+    for metrics in metrics_list:
+        for (method, status), count in sorted(metrics.requests.items()):
+            labels = prometheus_labels(metrics, method=method, status=status)
+            lines.append(f"{PROMETHEUS_PREFIX}_http_requests_total{labels} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(recorder: MetricsRecorder, path: str, metrics_format: str = None):
+    """Write the report to path, as Prometheus text for the .prom extension and JSON otherwise."""
+    if metrics_format is None:
+        metrics_format = "prometheus" if path.endswith(".prom") else "json"
+    if metrics_format not in METRICS_FORMATS:
+        raise ValueError(f"Invalid metrics format {metrics_format}. Use 'json' or 'prometheus'.")
+
+    content = format_prometheus(recorder) if metrics_format == "prometheus" else format_json(recorder)
+    with open(path, "w") as metrics_file:
+        metrics_file.write(content)
+    logger.info(f"Wrote migration metrics to {path}")
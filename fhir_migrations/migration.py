@@ -6,6 +6,14 @@ When downgrading, the downgrade() function of the currently
 applied migration is being run. Downgrade goes 1 step back.
 When upgrading, the upgrade() function of the to-be-applied
 migration is being run. Upgrade applies all unapplied migrations.
+Both walk up or down to a target revision, or a number of steps,
+when given; the state is written after every migration.
+
+Migrations may branch (several migrations share a down_revision) and
+merge again (a down_revision listing several revisions). Such a
+history is held in a RevisionGraph and its applied state is the set
+of applied heads. On upgrade, migrations of independent branches run
+concurrently once the migrations they depend on are applied.
 
 If cycle is present in the migration order, the error is raised,
 and manual resolution is necessary.
@@ -16,83 +24,154 @@ first be applied.
 You cannot create more than one new migration file at a time.
 
 For branching/conflict resolution, manually review the migration files.
+
+Migration functions may be coroutines (async def upgrade/downgrade), these are
+run on their own event loop. Functions taking a checkpoint argument receive a Checkpoint
+to save their progress, a rerun after a failure resumes from the saved cursor.
 """
 
+import asyncio
+import inspect
 import os
 import uuid
-import imp
 import logging
-
-from fhir_migrations.config import MIGRATION_SCRIPTS_DIR
-from fhir_migrations.migration_resource import MigrationManager
-from fhir_migrations.utils import LinkedList
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+
+from fhir_migrations.checkpoint import Checkpoint, accepts_checkpoint
+from fhir_migrations.config import MIGRATION_BRANCH_CONCURRENCY, MIGRATION_SCRIPTS_DIR
+from fhir_migrations.discovery import (
+    load_manifest,
+    load_migration_module,
+    read_migration_file,
+    scan_migrations,
+    write_manifest,
+)
+from fhir_migrations.dry_run import DryRun, LatencyModel
+from fhir_migrations.migration_resource import ConcurrentMigrationError, MigrationState, RunHandedOverError
+from fhir_migrations.sharding import ran_sharded_step, reset_sharded_step
+from fhir_migrations.utils import (
+    RevisionGraph,
+    RevisionSequence,
+    RevisionSlice,
+    SequenceError,
+    down_revisions,
+    is_linear_history,
+    topological_order,
+    validate_graph,
+    validate_sequence,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+
+class RevisionPathError(ValueError):
+    """Raised when the target revision or the number of steps do not lead to a migration path."""
+
+
+def call_migration_function(function, *args):
+    """Call a migration upgrade()/downgrade() function.
+    Coroutine functions (async def) are run to completion on a new event loop."""
+    if inspect.iscoroutinefunction(function):
+        return asyncio.run(function(*args))
+    return function(*args)
+
+
 class Migration:
-    def __init__(self, migrations_dir=None):
+    def __init__(self, migrations_dir=None, client=None, resource_id: str = None, max_parallel: int = None):
         '''Initializes Migration class, which contains the logic
-        for managing the migration order'''
+        for managing the migration order. The migration state is kept with
+        the client and resource id, the shared client by default. Up to
+        max_parallel migrations of independent branches run at the same time'''
         if migrations_dir is None:
             migrations_dir = MIGRATION_SCRIPTS_DIR
 
         self.migrations_dir = migrations_dir
-        self.migration_sequence = LinkedList()
+        self.client = client
+        self.resource_id = resource_id
+        self.max_parallel = max_parallel or MIGRATION_BRANCH_CONCURRENCY
+        # Set for histories with branches or merges
+        self.migration_graph = None
+        self.revision_sequence = RevisionSequence()
         self.migrations_locations = {}
+        self.migrations_revisions = {}
+        self.migrations_entries = {}
+        self.manifest = None
+        self.state = None
+        # Migrations which completed a sharded step, their state may already be written by other workers
+        self.sharded_migrations = set()
+        # Notified with begin_migration/end_migration around every migration run
+        self.observers = []
         self.build_migration_sequence()
 
     def build_migration_sequence(self):
-        '''Builds the migration list, based on the double LInked List.
-        Checks for cycles'''
+        '''Builds the revision sequence in migration order.
+        Checks for cycles, forks, orphans and duplicate revisions'''
         migration_files: list = self.get_migrations()
         migration_nodes: dict = {}
 
         for migration in migration_files:
             migration_nodes[migration] = self.get_previous_migration_id(migration)
 
-        if len(migration_files) > 0:
-            try:
-                self.migration_sequence.build_list_from_dictionary(migration_nodes)
-            except KeyError as ke:
-                logger.error(f"Downrevision migration is missing in the sequence")
-                raise ke
-            except Exception as e:
-                logger.error(f"General exception encountered: {str(e)}")
-                raise e
+        self.migration_graph = None
+        if len(migration_files) > 0 and not is_linear_history(migration_nodes):
+            self.migration_graph = RevisionGraph(migration_nodes)
+            order = self.migration_graph.order
+        elif len(migration_files) > 0:
+            validation = self.validate_migrations(migration_files, migration_nodes)
+            if not validation.is_valid:
+                for error in validation.errors:
+                    logger.error(error)
+                raise SequenceError(validation)
+            # A validated history is a single line, its topological order is the migration order
+            order = topological_order({
+                migration: down_revisions(down_revision) for migration, down_revision in migration_nodes.items()
+            })
         else:
+            self.revision_sequence = RevisionSequence()
             error_message = "No valid migration files."
             logger.exception(error_message)
+            return
+
+        self.revision_sequence = RevisionSequence(order, [self.migrations_locations.get(revision) for revision in order])
 
+    def validate_migrations(self, migration_files: list = None, migration_nodes: dict = None):
+        '''Validates the migrations in a single pass, collecting every cycle, fork,
+        dangling down_revision and duplicate revision into one SequenceValidation.
+        Histories with merge revisions or branches are validated as a graph'''
+        if migration_files is None:
+            migration_files = self.get_migrations()
+        if migration_nodes is None:
+            migration_nodes = {
+                migration: self.get_previous_migration_id(migration) for migration in migration_files
+            }
+
+        if not is_linear_history(migration_nodes):
+            return validate_graph((migration, migration_nodes[migration]) for migration in migration_files)
+        return validate_sequence((migration, migration_nodes[migration]) for migration in migration_files)
 
     def get_migrations(self) -> list:
-        '''Retrieves all valid migrations from the files in the migration directory.'''
-        try:
-            migration_files = os.listdir(self.migrations_dir)
-            migration_files = [file for file in migration_files if file.endswith('.py')]
-        except FileNotFoundError:
-            migration_files = []
+        '''Retrieves all valid migrations from the files in the migration directory.
+        Files unchanged since the manifest was compiled (or since the previous scan)
+        are not parsed again.'''
+        if self.manifest is None:
+            self.manifest = load_manifest(self.migrations_dir)
+
+        # Metadata is read from the source, the module is only loaded when it runs
+        self.migrations_entries = scan_migrations(self.migrations_dir, self.manifest)
+        self.manifest = {"migrations": self.migrations_entries}
 
         revisions = []
-        for file_name in migration_files:
-            file_path = os.path.join(self.migrations_dir, file_name)
+        for file_name, entry in self.migrations_entries.items():
             module_name = os.path.splitext(file_name)[0]
-            migration_module = imp.load_source(module_name, file_path)
-
-            # Check for required attributes and methods
-            if not hasattr(migration_module, "revision"):
-                raise RuntimeError(f"Migration '{file_name}' is missing 'revision' variable.")
-            if not hasattr(migration_module, "down_revision"):
-                raise RuntimeError(f"Migration '{file_name}' is missing 'down_revision' variable.")
-            if not hasattr(migration_module, "upgrade") or not callable(getattr(migration_module, "upgrade")):
-                raise RuntimeError(f"Migration '{file_name}' is missing 'upgrade' method.")
-            if not hasattr(migration_module, "downgrade") or not callable(getattr(migration_module, "downgrade")):
-                raise RuntimeError(f"Migration '{file_name}' is missing 'downgrade' method.")
-
-            revision = str(getattr(migration_module, "revision"))
+            revision, down_revision = entry["revision"], entry["down_revision"]
+
             if revision:
                 revisions.append(revision)
                 self.migrations_locations[revision] = module_name
+                self.migrations_revisions[revision] = down_revision
 
         return revisions
 
@@ -106,12 +185,14 @@ class Migration:
             logger.error(message)
             raise ValueError(message)
 
+        if migration_id in self.migrations_revisions:
+            return self.migrations_revisions[migration_id]
+
         down_revision = None
         migration_path = os.path.join(self.migrations_dir, filename)
         if os.path.exists(migration_path):
             try:
-                migration_module = imp.load_source("migration_module", migration_path)
-                down_revision = getattr(migration_module, "down_revision", None)
+                _, down_revision = read_migration_file(migration_path)
             except Exception as e:
                 message = f"Error loading migration script {filename}: {e}"
                 logger.error(message)
@@ -122,6 +203,16 @@ class Migration:
 
         return down_revision
 
+    def compile_manifest(self) -> str:
+        """Write the manifest of the migrations directory, used to skip
+        parsing of unchanged migration files on subsequent runs."""
+        # Only a valid migration sequence is compiled
+        self.build_migration_sequence()
+        manifest_path = write_manifest(self.migrations_dir, self.migrations_entries)
+        logger.info(f"Compiled {len(self.migrations_entries)} migrations into {manifest_path}")
+
+        return manifest_path
+
     def generate_migration_script(self, migration_name: str):
         """Generate a new migration script with basic functions."""
         self.build_migration_sequence()
@@ -131,14 +222,25 @@ class Migration:
 
             raise ValueError(message)
 
-        current_migration_id = str(self.get_latest_applied_migration_from_fhir())
-        latest_created_migration_id = str(self.get_latest_created_migration())
+        if self.migration_graph is not None:
+            # Several applied heads are merged by the new migration
+            applied_heads = self.get_applied_heads_from_fhir()
+            if applied_heads != self.migration_graph.heads():
+                message = f"There exists not applied migration."
+                logger.error(message)
 
-        if current_migration_id != latest_created_migration_id:
-            message = f"There exists not applied migration."
-            logger.error(message)
+                raise RuntimeError(message)
+            down_revision = repr(tuple(applied_heads)) if len(applied_heads) > 1 else f"'{applied_heads[0]}'"
+        else:
+            current_migration_id = str(self.get_latest_applied_migration_from_fhir())
+            latest_created_migration_id = str(self.get_latest_created_migration())
+
+            if current_migration_id != latest_created_migration_id:
+                message = f"There exists not applied migration."
+                logger.error(message)
 
-            raise RuntimeError(message)
+                raise RuntimeError(message)
+            down_revision = f"'{current_migration_id}'"
 
         new_id = str(uuid.uuid4())
         migration_filename = f"{migration_name}.py"
@@ -147,7 +249,7 @@ class Migration:
         with open(migration_path, "w") as migration_file:
             migration_file.write(f"# Migration script generated for {migration_name}\n")
             migration_file.write(f"revision = '{new_id}'\n")
-            migration_file.write(f"down_revision = '{current_migration_id}'\n")
+            migration_file.write(f"down_revision = {down_revision}\n")
             migration_file.write("\n")
             migration_file.write("def upgrade():\n")
             migration_file.write("    # Add your upgrade migration code here\n")
@@ -162,82 +264,321 @@ class Migration:
 
         return migration_filename
 
-    def run_migrations(self, direction: str):
-        """Run migrations based on the specified direction ("upgrade" or "downgrade")."""
+    def run_migrations(self, direction: str, dry_run: bool = False, latency_model: LatencyModel = None,
+                       observers: list = (), to_revision: str = None, steps: int = None):
+        """Run migrations based on the specified direction ("upgrade" or "downgrade"),
+        up or down to `to_revision` or for `steps` migrations when given (see resolve_path).
+        With dry_run, writes to FHIR are recorded instead of sent and the DryRun plan is returned.
+        Additional observers are notified for this run only; observers which are context
+        managers (e.g. a MetricsRecorder) are entered around the run. The run stops early when
+        another worker of a sharded step recorded the step first, that worker continues it."""
+        planner = None
+        if dry_run:
+            # The state is written through the client of the Migration
+            planner = DryRun(latency_model=latency_model, clients=[self.client] if self.client else [])
+        observers = ([planner] if planner else []) + list(observers)
+
+        with ExitStack() as stack:
+            for observer in observers:
+                if hasattr(observer, "__enter__"):
+                    stack.enter_context(observer)
+                self.observers.append(observer)
+                stack.callback(self.observers.remove, observer)
+            try:
+                result = self.apply_migrations(direction, to_revision, steps)
+            except RunHandedOverError as e:
+                logger.info(f"{e}, stopping this run")
+                result = None
+
+        return planner if dry_run else result
+
+    def apply_migrations(self, direction: str, to_revision: str = None, steps: int = None):
+        """Apply the migrations of the path in the specified direction, stopping at the first failure.
+        The state is written after every migration."""
         # Update the migration to acquire most recent updates in the system
         self.build_migration_sequence()
         if direction not in ["upgrade", "downgrade"]:
             raise ValueError("Invalid migration direction. Use 'upgrade' or 'downgrade'.")
+        if self.migration_graph is not None:
+            return self.apply_graph(direction, to_revision, steps)
 
         current_migration = self.get_latest_applied_migration_from_fhir()
-        if current_migration and self.migration_sequence.find(current_migration) is None:
+        if current_migration == 'None':
+            current_migration = None
+        if current_migration and current_migration not in self.revision_sequence:
             message = f"Applied migration {current_migration} does not exist in the migration system"
             logger.error(message)
 
             raise KeyError(message)
 
-        applied_migrations = None
-        unapplied_migrations = None
-        if direction == "upgrade":
-            unapplied_migrations = self.get_unapplied_migrations(current_migration)
-        elif direction == "downgrade" and current_migration is not None:
-            applied_migrations = self.get_previous_migration(current_migration)
-            unapplied_migrations = current_migration
+        path = self.resolve_path(direction, current_migration, to_revision, steps)
+        if not path:
+            # If no migrations are left to run, silently exit
+            return
 
-        if not unapplied_migrations or unapplied_migrations == 'None':
+        logger.info(f"Running {len(path)} migration(s) {direction}")
+        for next_migration, applied_migration in path:
+            if not self.run_migration(direction, next_migration, applied_migration):
+                # Later migrations depend on the failed one
+                break
+
+    def resolve_path(self, direction: str, current_migration: str, to_revision: str = None,
+                     steps: int = None) -> list:
+        """The (migration to run, migration applied afterwards) pairs leading from the current
+        migration to to_revision, or the next `steps` ones. Upgrades default to all unapplied
+        migrations, downgrades to one step. Downgrading to "base" reverts every migration.
+        Raises RevisionPathError when the revision or steps do not lead to a path."""
+        if to_revision is not None and steps is not None:
+            raise RevisionPathError("Specify either a target revision or a number of steps, not both.")
+        if steps is not None and steps < 0:
+            raise RevisionPathError("The number of steps must not be negative.")
+
+        sequence = self.revision_sequence
+        current_position = sequence.index(current_migration) if current_migration else -1
+        if to_revision is None:
+            target_position = len(sequence) - 1 if direction == "upgrade" else current_position - 1
+            if steps is not None:
+                offset = steps if direction == "upgrade" else -steps
+                target_position = min(max(current_position + offset, -1), len(sequence) - 1)
+        elif to_revision == "base" and direction == "downgrade":
+            target_position = -1
+        elif to_revision in sequence:
+            target_position = sequence.index(to_revision)
+        else:
+            raise RevisionPathError(f"Unknown revision {to_revision}")
+
+        if direction == "upgrade":
+            if target_position < current_position:
+                raise RevisionPathError(f"Revision {to_revision} is already applied, use downgrade.")
+            return [(revision, revision) for revision in sequence[current_position + 1:target_position + 1]]
+
+        if target_position > current_position:
+            raise RevisionPathError(f"Revision {to_revision} is not applied, use upgrade.")
+        return [(revision, sequence.previous(revision))
+                for revision in reversed(sequence[target_position + 1:current_position + 1])]
+
+    def apply_graph(self, direction: str, to_revision: str = None, steps: int = None):
+        """Apply the migrations of a graph with branches or merges, see RevisionGraph.upgrade_path
+        and downgrade_path. Upgrades run independent branches concurrently and skip the migrations
+        depending on a failed one, downgrades run serially, latest first."""
+        if to_revision is not None and steps is not None:
+            raise RevisionPathError("Specify either a target revision or a number of steps, not both.")
+        if steps is not None and steps < 0:
+            raise RevisionPathError("The number of steps must not be negative.")
+        graph = self.migration_graph
+        if to_revision is not None and to_revision not in graph and not (
+                to_revision == "base" and direction == "downgrade"):
+            raise RevisionPathError(f"Unknown revision {to_revision}")
+
+        applied = graph.ancestors(self.get_applied_heads_from_fhir())
+        if direction == "upgrade":
+            path = graph.upgrade_path(applied, to_revision, steps)
+        elif to_revision in graph and to_revision not in applied:
+            raise RevisionPathError(f"Revision {to_revision} is not applied, use upgrade.")
+        else:
+            path = graph.downgrade_path(applied, to_revision, steps)
+        if not path:
             # If no migrations are left to run, silently exit
             return
 
+        logger.info(f"Running {len(path)} migration(s) {direction}")
         if direction == "upgrade":
-            # Run all available migrations
-            for migration in unapplied_migrations:
-                self.run_migration(direction, migration, migration)
-        if direction == "downgrade":
-            # Run one migration down
-            self.run_migration(direction, unapplied_migrations, applied_migrations)
-
-    def run_migration(self, direction: str, next_migration: str, applied_migration: str):
-        """Run migration(s) based on the specified direction ("upgrade" or "downgrade")."""
-        # Update the migration to acquire most recent updates in the system
-        migration_path = os.path.join(self.migrations_dir, self.migrations_locations[next_migration] + ".py")
-        try:
-            logger.info("Running the migration")
-            migration_module = imp.load_source('migration_module', migration_path)
+            return self.upgrade_graph(path, applied)
+
+        for next_migration in path:
+            applied.discard(next_migration)
+            if not self.run_migration(direction, next_migration, graph.heads(applied)):
+                break
+
+    def upgrade_graph(self, path: list, applied: set):
+        """Upgrade the migrations of the path, each once the migrations it depends on are applied.
+        Up to max_parallel migrations run on worker threads; the state is written by the calling
+        thread after each of them. Observers tracking a single current migration (those without
+        a true `concurrent` attribute) get the migrations one at a time."""
+        graph = self.migration_graph
+        pending = set(path)
+        concurrent = all(getattr(observer, "concurrent", False) for observer in self.observers)
+        max_workers = self.max_parallel if concurrent else 1
+
+        def skip_descendants(revision):
+            skipped = graph.descendants([revision]) & pending
+            pending.difference_update(skipped)
+            if skipped:
+                logger.error(f"Skipping {len(skipped)} migration(s) depending on {revision}: "
+                             f"{', '.join(graph.sorted(skipped))}")
+
+        if max_workers == 1:
+            for next_migration in path:
+                if next_migration not in pending:
+                    continue
+                pending.discard(next_migration)
+                if self.run_migration("upgrade", next_migration, graph.heads(applied | {next_migration})):
+                    applied.add(next_migration)
+                else:
+                    skip_descendants(next_migration)
+            return
 
-            if direction == "upgrade":
-                migration_module.upgrade()
-            elif direction == "downgrade":
-                migration_module.downgrade()
+        # Migrations become ready once their last unapplied parent is applied
+        waiting = {revision: sum(parent not in applied for parent in graph.parents[revision]) for revision in path}
+        ready = deque(revision for revision in path if not waiting[revision])
+        conflict = None
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="migration") as executor:
+            running = {}
+            while True:
+                while ready and conflict is None:
+                    next_migration = ready.popleft()
+                    if next_migration not in pending:
+                        continue
+                    pending.discard(next_migration)
+                    future = executor.submit(self.run_migration, "upgrade", next_migration, None, False)
+                    running[future] = next_migration
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    next_migration = running.pop(future)
+                    if not future.result():
+                        skip_descendants(next_migration)
+                        continue
+                    applied.add(next_migration)
+                    for child in graph.children[next_migration]:
+                        if child in waiting:
+                            waiting[child] -= 1
+                            if not waiting[child]:
+                                ready.append(child)
+                    if conflict is not None:
+                        continue
+                    try:
+                        self.update_latest_applied_migration_in_fhir(
+                            graph.heads(applied), next_migration in self.sharded_migrations)
+                    except ConcurrentMigrationError as e:
+                        # Another runner changed the state, let the running migrations finish
+                        conflict = e
+
+        if conflict is not None:
+            self.record_applied_after_conflict(applied)
+            raise conflict
+
+    def record_applied_after_conflict(self, applied: set):
+        """Record the applied migrations of the graph together with those another runner recorded
+        meanwhile, so migrations which ran are not applied again by the next run."""
+        graph = self.migration_graph
+        try:
+            stored = graph.ancestors(self.get_applied_heads_from_fhir())
+            self.update_latest_applied_migration_in_fhir(graph.heads(stored | applied))
+        except (ConcurrentMigrationError, KeyError) as e:
+            logger.error(f"Applied migrations {', '.join(graph.heads(applied))} could not be recorded: {e}")
+
+    def run_migration(self, direction: str, next_migration: str, applied_migration, update_state: bool = True) -> bool:
+        """Run migration(s) based on the specified direction ("upgrade" or "downgrade").
+        Afterwards applied_migration (the applied heads of a graph) is written as the state,
+        unless update_state is false. Returns whether the migration succeeded."""
+        # Update the migration to acquire most recent updates in the system
+        location = self.migrations_locations[next_migration]
+        migration_path = os.path.join(self.migrations_dir, location + ".py")
+        for observer in self.observers:
+            observer.begin_migration(next_migration, direction, location)
 
-            self.update_latest_applied_migration_in_fhir(applied_migration)
+        error = None
+        try:
+            logger.info(f"Running the migration {next_migration} ({location}) {direction}")
+            reset_sharded_step()
+            with load_migration_module(migration_path) as migration_module:
+                function = getattr(migration_module, direction)
+                if accepts_checkpoint(function):
+                    # Resume from the progress saved by a previous, failed run
+                    checkpoint = Checkpoint.load(next_migration, direction, self.client, self.resource_id)
+                    if checkpoint.cursor is not None:
+                        logger.info(f"Resuming migration {next_migration} from checkpoint {checkpoint.cursor!r}")
+                    self.call_migration(next_migration, direction, function, checkpoint)
+                    checkpoint.clear()
+                else:
+                    self.call_migration(next_migration, direction, function)
+            if ran_sharded_step():
+                self.sharded_migrations.add(next_migration)
+
+            if update_state:
+                self.update_latest_applied_migration_in_fhir(applied_migration,
+                                                             next_migration in self.sharded_migrations)
+        except RunHandedOverError:
+            # The migration succeeded, another worker of the sharded step continues the run
+            raise
+        except ConcurrentMigrationError as e:
+            # Another runner changed the state, continuing would overwrite it
+            error = e
+            raise
         except Exception as e:
-            message = f"Error executing migration {applied_migration}: {e}"
+            error = e
+            message = f"Error executing migration {next_migration}: {e}"
             logger.error(message)
-
-    def get_unapplied_migrations(self, applied_migration) -> list:
+            return False
+        finally:
+            for observer in self.observers:
+                observer.end_migration(next_migration, direction, error)
+
+        return True
+
+    def call_migration(self, revision: str, direction: str, function, *args):
+        """Call the migration function, within the profile() context of observers providing one."""
+        with ExitStack() as profiling:
+            for observer in self.observers:
+                if hasattr(observer, "profile"):
+                    profiling.enter_context(observer.profile(revision, direction))
+            return call_migration_function(function, *args)
+
+    def get_unapplied_migrations(self, applied_migration) -> RevisionSlice:
         """Retrieve all migrations that have not yet been ran."""
-        return self.migration_sequence.get_sublist(applied_migration)
+        return self.revision_sequence.after(applied_migration)
 
     def get_previous_migration(self, current_migration) -> str:
         """Retrieve the previous migration."""
-        return self.migration_sequence.previous(current_migration)
+        return self.revision_sequence.previous(current_migration)
 
     def get_latest_created_migration(self) -> str:
         """Retrieve the latest created migration."""
-        return self.migration_sequence.head
+        return self.revision_sequence.head()
 
     ## FHIR MANAGEMENT LOGIC
+    def get_migration_state(self, refresh: bool = False) -> MigrationState:
+        """Return the migration state, fetching it from FHIR when not yet read or refresh is set."""
+        if self.state is None or refresh:
+            self.state = MigrationState.load(self.client, self.resource_id)
+        return self.state
+
     def get_latest_applied_migration_from_fhir(self) -> str:
-        """Retrieve the latest applied migration migration id from FHIR."""
-        # Logic to retrieve the latest applied migration number from FHIR
-        manager = MigrationManager.get_manager(create_if_not_found=False)
-        if manager is None:
-            return None
-
-        return manager.get_latest_migration()
-
-    def update_latest_applied_migration_in_fhir(self, latest_applied_migration: str):
-        """Update the latest applied migration id in FHIR."""
-        # Logic to update the latest applied migration number in FHIR
-        manager = MigrationManager.get_manager(create_if_not_found=True)
-        manager.update_migration(latest_applied_migration)
+        """Retrieve the latest applied migration migration id from FHIR.
+        The fetched state is kept for the updates of the current run."""
+        return self.get_migration_state(refresh=True).get_latest_migration()
+
+    def get_applied_heads_from_fhir(self) -> list:
+        """Retrieve the applied heads of the migration graph from FHIR.
+        Raises KeyError for heads which are not in the migration system."""
+        heads = self.get_migration_state(refresh=True).get_applied_heads()
+        unknown = [head for head in heads if head not in self.revision_sequence]
+        if unknown:
+            message = f"Applied migration {', '.join(unknown)} does not exist in the migration system"
+            logger.error(message)
+
+            raise KeyError(message)
+        return heads
+
+    def applied_revisions(self) -> set:
+        """Revisions applied according to the state in FHIR."""
+        if self.migration_graph is not None:
+            return self.migration_graph.ancestors(self.get_applied_heads_from_fhir())
+        current_migration = self.get_latest_applied_migration_from_fhir()
+        return set(self.revision_sequence) - set(self.get_unapplied_migrations(current_migration))
+
+    def update_latest_applied_migration_in_fhir(self, latest_applied_migration, sharded: bool = False):
+        """Update the latest applied migration id in FHIR, conditional on the version
+        of the state read at the start of the run. For a migration graph, a list of the
+        applied heads is written. After a sharded step, the same state written by another
+        worker of the step is accepted, raising RunHandedOverError."""
+        if isinstance(latest_applied_migration, (list, tuple, set)):
+            heads = latest_applied_migration
+            if self.migration_graph is not None:
+                heads = self.migration_graph.sorted(heads)
+            self.get_migration_state().update_heads(list(heads), sharded)
+            return
+        self.get_migration_state().update(latest_applied_migration, sharded)
@@ -3,25 +3,46 @@
 Defines a FHIR resource holding data about the latest migration by specializing
 the `fhirclient.Basic` class. A single Basic resource is maintained with the most
 recently (successfully) run migration revision held in the single Basic.code value.
+For a migration graph with branches, the applied heads are held as one coding each.
+Requests are sent over the shared, pooled FHIR client.
+
+`MigrationState` reads the Basic resource once per run and writes later updates
+as version-aware (If-Match) updates, so a concurrent runner is detected instead
+of being silently overwritten.
+
+The FHIR client and resource identifier default to the shared client and
+MIGRATION_RESOURCE_ID; a MigrationState created with its own `client` and
+`resource_id` keeps the state of another FHIR store (see fhir_migrations.targets).
 """
 import os
-import requests
 import json
 import logging
 
 from fhirclient.models.basic import Basic
+from fhirclient.models.coding import Coding
+
+from fhir_migrations.client import get_client
+from fhir_migrations.config import FHIR_URL
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-fhir_url = os.getenv("FHIR_URL", 'http://fhir-internal:8080/fhir/')
 MIGRATION_SYSTEM = "http://fhir.migration.system"
+MIGRATION_CODE_SYSTEM = "http://our.migration.system"
 MIGRATION_RESOURCE_ID = os.getenv("MIGRATION_RESOURCE_ID", "e61c4580-2493-417f-a26c-26faa8eb70ba")
+# Deprecated: kept for scripts importing it, requests are sent over the shared client
+# (see fhir_migrations.client.default_base_url)
+fhir_url = FHIR_URL
+
+
+def identifier_params(resource_id: str = None) -> dict:
+    """Search parameters of the Migration Manager with the resource identifier"""
+    return {"identifier": f'{MIGRATION_SYSTEM}|{resource_id or MIGRATION_RESOURCE_ID}'}
 
 
 class MigrationManager(Basic):
     """Represents a FHIR resource for managing migrations."""
-    search_params = {"identifier": f'{MIGRATION_SYSTEM}|{MIGRATION_RESOURCE_ID}'}
+    search_params = identifier_params()
 
     def __init__(self, jsondict=None, strict=True):
         super(Basic, self).__init__(jsondict=jsondict, strict=strict)
@@ -34,12 +55,12 @@ class MigrationManager(Basic):
         return f"{self.resource_type}/{self.id}"
 
     @staticmethod
-    def get_manager(create_if_not_found=True) -> 'MigrationManager':
+    def get_manager(create_if_not_found=True, client=None, resource_id: str = None) -> 'MigrationManager':
         """Search for the Migration Manager. If specified, create one when not found"""
-        basic = MigrationManager.get_resource()
+        basic = MigrationManager.get_resource(client, resource_id)
         if basic is None and create_if_not_found:
             logger.debug("Creating new resource")
-            basic = MigrationManager.persist()
+            basic = MigrationManager.persist(client=client, resource_id=resource_id)
             return MigrationManager(basic)
         elif basic is None and not create_if_not_found:
             return None
@@ -47,16 +68,16 @@ class MigrationManager(Basic):
         return MigrationManager(basic)
 
     @staticmethod
-    def get_resource():
+    def get_resource(client=None, resource_id: str = None):
         # GET request to retrieve the resource
         headers = {
             'Content-Type': 'application/fhir+json',
             'Cache-Control': 'no-cache'
         }
 
-        response = requests.get(
-            f"{fhir_url}Basic",
-            params=MigrationManager.search_params,
+        response = (client or get_client()).get(
+            "Basic",
+            params=identifier_params(resource_id),
             headers=headers
         )
         response.raise_for_status()
@@ -66,21 +87,23 @@ class MigrationManager(Basic):
         return basic
 
     @staticmethod
-    def persist(resource = None):
-        """Persist Basic state to FHIR store"""
+    def persist(resource = None, version_id: str = None, client=None, resource_id: str = None):
+        """Persist Basic state to FHIR store.
+        When version_id is given, the resource is only updated if it still is at that version."""
+        client = client or get_client()
         if not resource:
             resource = {
                 "resourceType": "Basic",
                 "identifier": [
                     {
                         "system": MIGRATION_SYSTEM,
-                        "value": MIGRATION_RESOURCE_ID
+                        "value": resource_id or MIGRATION_RESOURCE_ID
                     }
                 ],
                 "code": {
                     "coding": [
                         {
-                            "system": "http://our.migration.system",
+                            "system": MIGRATION_CODE_SYSTEM,
                             "code": "updated-code"
                         }
                     ]
@@ -88,31 +111,129 @@ class MigrationManager(Basic):
             }
         resource_json = json.dumps(resource)
         headers = {
-            'Content-Type': 'application/fhir+json'
+            'Content-Type': 'application/fhir+json',
+            'Prefer': 'return=representation'
         }
 
-        response = requests.put(
-            f"{fhir_url}Basic",
-            params=MigrationManager.search_params,
-            headers=headers,
-            data=resource_json
-        )
+        if version_id is not None and resource.get("id"):
+            headers['If-Match'] = f'W/"{version_id}"'
+            response = client.put(
+                f"Basic/{resource['id']}",
+                headers=headers,
+                data=resource_json
+            )
+            if response.status_code in (409, 412):
+                message = f"Migration state Basic/{resource['id']} was modified by another runner"
+                logger.error(message)
+                raise ConcurrentMigrationError(message)
+        else:
+            response = client.put(
+                "Basic",
+                params=identifier_params(resource_id),
+                headers=headers,
+                data=resource_json
+            )
         response.raise_for_status()
 
         return response.json()
 
-    def update_migration(self, migration_id: str):
-        """Update the migration id on the FHIR"""
-        self.code.coding[0].code = migration_id
+    def update_migration(self, migration_id: str, client=None, resource_id: str = None):
+        """Update the migration id on the FHIR.
+        The update is conditional on the version of the resource that was read."""
+        return self.update_heads([migration_id] if migration_id else [], client, resource_id)
+
+    def update_heads(self, heads: list, client=None, resource_id: str = None):
+        """Update the applied heads (one coding each) on the FHIR.
+        The update is conditional on the version of the resource that was read."""
+        system = self.code.coding[0].system if self.code.coding else MIGRATION_CODE_SYSTEM
+        self.code.coding = [Coding({"system": system, "code": head}) for head in heads] or [Coding({"system": system})]
 
-        response = MigrationManager.persist(self.as_json())
+        response = MigrationManager.persist(self.as_json(), version_id=self.version_id,
+                                            client=client, resource_id=resource_id)
         return response
 
+    @property
+    def version_id(self):
+        """Version of the resource as read from the FHIR store"""
+        if self.meta is None:
+            return None
+        return self.meta.versionId
+
     def get_latest_migration(self):
         """Returns the most recent ran migration"""
         current_migration = self.code.coding[0].code
         return current_migration
 
+    def get_applied_heads(self) -> list:
+        """Returns the applied heads of a migration graph, the latest migration of a linear history"""
+        return [coding.code for coding in self.code.coding if coding.code not in (None, 'None')]
+
+
+class ConcurrentMigrationError(RuntimeError):
+    """Raised when the migration state was updated by another runner."""
+
+
+class RunHandedOverError(ConcurrentMigrationError):
+    """Raised after a sharded step when another worker of the step already wrote the state.
+    That worker continues the run, this one has to stop."""
+
+
+class MigrationState:
+    """Migration state of a single run. The MigrationManager is fetched once,
+    subsequent updates reuse it together with its version."""
+
+    def __init__(self, manager: MigrationManager = None, client=None, resource_id: str = None):
+        self.manager = manager
+        self.client = client
+        self.resource_id = resource_id
+
+    @classmethod
+    def load(cls, client=None, resource_id: str = None) -> 'MigrationState':
+        """Fetch the current state from the FHIR store."""
+        manager = MigrationManager.get_manager(create_if_not_found=False, client=client, resource_id=resource_id)
+        return cls(manager, client, resource_id)
+
+    def get_latest_migration(self):
+        """Returns the most recent ran migration, None if no state exists yet"""
+        if self.manager is None:
+            return None
+        return self.manager.get_latest_migration()
+
+    def get_applied_heads(self) -> list:
+        """Returns the applied heads, empty if no state exists yet"""
+        if self.manager is None:
+            return []
+        return self.manager.get_applied_heads()
+
+    def update(self, migration_id: str, sharded: bool = False):
+        """Persist migration_id as the latest applied migration.
+        Raises ConcurrentMigrationError if the state changed since it was read. After a sharded
+        step (see fhir_migrations.sharding), the state already written by another worker is accepted
+        and RunHandedOverError raised: only the worker which wrote the state continues the run."""
+        return self.update_heads([migration_id] if migration_id else [], sharded)
+
+    def update_heads(self, heads: list, sharded: bool = False):
+        """Persist the applied heads of a migration graph, see update()."""
+        if self.manager is None:
+            logger.debug("Creating new resource")
+            self.manager = MigrationManager(MigrationManager.persist(client=self.client, resource_id=self.resource_id))
+
+        try:
+            response = self.manager.update_heads(heads, self.client, self.resource_id)
+        except ConcurrentMigrationError:
+            if not sharded:
+                raise
+            # Workers of a sharded migration all advance the state once its shards are done
+            current = MigrationManager.get_manager(create_if_not_found=False, client=self.client,
+                                                   resource_id=self.resource_id)
+            if current is None or current.get_applied_heads() != list(heads):
+                raise
+            self.manager = current
+            raise RunHandedOverError(
+                f"Migration state already at {', '.join(heads) or 'None'}, written by another worker")
+        self.manager = MigrationManager(response)
+        return response
+
 
 def first_in_bundle(bundle):
     """Return first resource in bundle
@@ -0,0 +1,177 @@
+"""Migration Profiling
+
+Profiles the upgrade()/downgrade() call of every migration run, without changes to
+the migration scripts, writing one file set per revision into a directory:
+
+    flask upgrade --profile profiles/
+    flask upgrade --profile profiles/ --profile-mode sampling --profile-interval 0.01
+
+The `cprofile` mode traces every function call of the thread running the migration
+with cProfile and writes `<revision>-<direction>.pstats` (for `python -m pstats`
+or snakeviz), and `<revision>-<direction>.collapsed` holding collapsed stacks for
+flamegraph tools (flamegraph.pl, speedscope). Work done on other threads, e.g.
+items of `run_concurrently`, is not traced.
+
+The `sampling` mode records the stacks of all threads every `interval` seconds from
+a background thread, so its overhead does not depend on the number of calls and is
+low enough for production runs. It only writes the collapsed stacks, whose counts
+are samples; the first frame of each stack is the thread name.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+PROFILE_MODES = ("cprofile", "sampling")
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# Frames deeper than this are not expanded into collapsed stacks
+MAX_STACK_DEPTH = 200
+# Call paths taking less time than this are left out of the collapsed stacks of a cProfile run
+MIN_COLLAPSED_SECONDS = 1e-6
+
+
+def frame_label(file_name: str, line_number: int, function_name: str) -> str:
+    """Collapsed stack frame, e.g. add_mrn (add_mrn.py:34)"""
+    label = f"{function_name} ({os.path.basename(file_name)}:{line_number})" if line_number else function_name
+    return label.replace(";", ":")
+
+
+def collapse_pstats(stats: pstats.Stats) -> Counter:
+    """Approximate collapsed stacks, in microseconds, from the caller graph of a profile.
+    The time of a function is split among its callers in proportion to their cumulative time."""
+    entries = stats.stats
+    callees = defaultdict(list)
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller in callers:
+            callees[caller].append(function)
+
+    stacks = Counter()
+
+    def walk(function, path, cumulative):
+        if cumulative < MIN_COLLAPSED_SECONDS:
+            # Bounds the expansion of wide call graphs
+            return
+        _, _, own_time, total_time, _ = entries[function]
+        share = cumulative / total_time if total_time else 0.0
+        path = path + (frame_label(*function),)
+        stacks[";".join(path)] += int(own_time * share * 1_000_000)
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for callee in callees[function]:
+            if frame_label(*callee) in path:
+                # Recursion, the time is accounted to the outer call
+                continue
+            walk(callee, path, entries[callee][4][function][3] * share)
+
+    for function, (_, _, _, total_time, callers) in entries.items():
+        if not callers:
+            walk(function, (), total_time)
+
+    return Counter({stack: count for stack, count in stacks.items() if count > 0})
+
+
+def write_collapsed(stacks: Counter, path: str):
+    with open(path, "w") as collapsed_file:
+        for stack, count in sorted(stacks.items()):
+            collapsed_file.write(f"{stack} {count}\n")
+
+
+class StackSampler:
+    """Samples the stacks of all other threads at a fixed interval on a daemon thread."""
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="migration-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self.stacks[self.collapse(names.get(thread_id, str(thread_id)), frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def collapse(thread_name: str, frame) -> str:
+        labels = []
+        while frame is not None and len(labels) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            labels.append(frame_label(code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        labels.append(thread_name.replace(";", ":"))
+        return ";".join(reversed(labels))
+
+
+class MigrationProfiler:
+    """Migration observer profiling the migration function calls into a directory."""
+
+    def __init__(self, directory: str, mode: str = "cprofile", interval: float = DEFAULT_SAMPLE_INTERVAL):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Invalid profile mode {mode}. Use 'cprofile' or 'sampling'.")
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.written = []
+
+    def begin_migration(self, revision: str, direction: str, location: str = None):
+        pass
+
+    def end_migration(self, revision: str, direction: str, error: BaseException = None):
+        pass
+
+    def path(self, revision: str, direction: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{revision}-{direction}.{extension}")
+
+    @contextmanager
+    def profile(self, revision: str, direction: str):
+        """Profile the enclosed migration function call."""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.mode == "sampling":
+            sampler = StackSampler(self.interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self.write(revision, direction, collapsed=sampler.stacks)
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stats = pstats.Stats(profiler)
+            pstats_path = self.path(revision, direction, "pstats")
+            stats.dump_stats(pstats_path)
+            self.written.append(pstats_path)
+            self.write(revision, direction, collapsed=collapse_pstats(stats))
+
+    def write(self, revision: str, direction: str, collapsed: Counter):
+        collapsed_path = self.path(revision, direction, "collapsed")
+        write_collapsed(collapsed, collapsed_path)
+        self.written.append(collapsed_path)
+        logger.info(f"Wrote {self.mode} profile of {revision} {direction} to {self.directory}")
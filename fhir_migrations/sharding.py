@@ -0,0 +1,513 @@
+"""Sharded Migrations
+
+Splits the work set of one large migration into shards processed by several
+workers: processes forked by `run_sharded` and `flask upgrade` runs on other
+nodes. The workers coordinate through one lease per shard, a Basic resource next
+to the MigrationManager that is claimed, renewed and completed with version-aware
+(If-Match) updates, so a shard is only worked on by one worker at a time:
+
+    from fhir_migrations.sharding import HashPartitioner, ShardedRun, run_sharded
+
+    OBSERVATIONS = HashPartitioner("Observation", 16)
+
+    def recode(shard):
+        for observation in shard.resources():
+            ...
+
+    def upgrade():
+        run_sharded("recode-observations", OBSERVATIONS, recode, processes=4)
+
+    def downgrade():
+        ShardedRun("recode-observations", OBSERVATIONS).clear()
+
+Partitioners split the resources of a type by a hash of the id or by id ranges,
+both filtered while paging, or by `_lastUpdated` windows, filtered by the server.
+FHIR search has no hash or range criteria on `_id`, so every shard of a hash or
+id range partitioner pages through all resources matching the params and drops
+the ones of other shards: N shards cost N full scans of the resource type, the
+server reads and sends every resource N times. Narrow `params` to the resources
+the migration changes, or use a LastUpdatedPartitioner, whose shards are read
+once in total.
+A worker claims a pending, failed or expired shard, calls the shard function and
+marks the shard done. While shards are leased by other workers, it waits for them.
+`run_sharded` returns once every shard is done, so the migration state only moves
+forward after all shards completed, and raises ShardingError when a shard failed.
+A later run retries the failed shards and skips the done ones; `clear()` removes
+the leases, e.g. in the downgrade.
+
+Leases expire `lease_seconds` after they were claimed or renewed, then another
+worker takes the shard over. `shard.resources()` renews the lease while paging,
+shard functions doing long work of their own call `shard.renew()`. Expiry is
+compared against the local clock, the clocks of the nodes should be synchronized.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from requests.adapters import HTTPAdapter
+
+from fhir_migrations.client import FHIRClient, get_client
+from fhir_migrations.dry_run import DryRunAdapter
+from fhir_migrations.migration_resource import MIGRATION_RESOURCE_ID, MIGRATION_SYSTEM, first_in_bundle
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+SHARD_SYSTEM = f"{MIGRATION_SYSTEM}/shard"
+SHARD_RUN_SYSTEM = f"{MIGRATION_SYSTEM}/shard-run"
+SHARD_EXTENSION_URL = f"{MIGRATION_SYSTEM}/shard-lease"
+SHARD_STATUSES = ("pending", "leased", "done", "failed")
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_POLL_INTERVAL = 5.0
+
+# Whether the migration running on the thread completed a sharded step, see ran_sharded_step()
+thread_state = threading.local()
+
+
+class ShardingError(RuntimeError):
+    """Raised when shards of a sharded run failed."""
+
+
+class LeaseLostError(RuntimeError):
+    """Raised when the lease of a shard was taken over by another worker."""
+
+
+def format_instant(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def parse_instant(value) -> datetime:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class Partitioner:
+    """Splits the resources of a type, matching the search params, into `count` shards."""
+
+    def __init__(self, resource_type: str, count: int, params: dict = None):
+        if count < 1:
+            raise ValueError("A partitioner needs at least one shard")
+        self.resource_type = resource_type
+        self.count = count
+        self.params = dict(params or {})
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.resource_type}, {self.count})"
+
+    def search_params(self, index: int) -> dict:
+        """Search parameters of the resources of the shard."""
+        return dict(self.params)
+
+    def contains(self, index: int, resource: dict) -> bool:
+        """Whether a resource found by the shard search belongs to the shard."""
+        return True
+
+    def describe(self, index: int) -> str:
+        return f"{self.resource_type} shard {index + 1}/{self.count}"
+
+
+class HashPartitioner(Partitioner):
+    """Shards by a stable hash of the resource id.
+    Filtered on the client: every shard pages through all resources matching the params,
+    `count` shards scan the resource type `count` times."""
+
+    @staticmethod
+    def shard_of(resource_id: str, count: int) -> int:
+        return int(hashlib.sha1(resource_id.encode("utf-8")).hexdigest()[:8], 16) % count
+
+    def contains(self, index: int, resource: dict) -> bool:
+        return self.shard_of(resource["id"], self.count) == index
+
+
+class IdRangePartitioner(Partitioner):
+    """Shards by id ranges split at the boundaries: (..., b0), [b0, b1), ..., [bn, ...).
+    FHIR has no range search on _id: every shard pages through all resources matching the
+    params, `count` shards scan the resource type `count` times."""
+
+    def __init__(self, resource_type: str, boundaries: list, params: dict = None):
+        super().__init__(resource_type, len(boundaries) + 1, params)
+        self.boundaries = sorted(boundaries)
+
+    def bounds(self, index: int) -> tuple:
+        lower = self.boundaries[index - 1] if index > 0 else None
+        upper = self.boundaries[index] if index < len(self.boundaries) else None
+        return lower, upper
+
+    def contains(self, index: int, resource: dict) -> bool:
+        lower, upper = self.bounds(index)
+        return (lower is None or resource["id"] >= lower) and (upper is None or resource["id"] < upper)
+
+    def describe(self, index: int) -> str:
+        lower, upper = self.bounds(index)
+        return f"{self.resource_type} ids [{lower or ''}, {upper or ''})"
+
+
+class LastUpdatedPartitioner(Partitioner):
+    """Shards by `count` equal _lastUpdated windows from start (inclusive) to end (exclusive).
+    The bounds must be the same for all workers, pass fixed instants rather than the current time."""
+
+    def __init__(self, resource_type: str, start, end, count: int, params: dict = None):
+        super().__init__(resource_type, count, params)
+        self.start = parse_instant(start)
+        self.end = parse_instant(end)
+        if self.end <= self.start:
+            raise ValueError("The end of the _lastUpdated range must be after its start")
+
+    def window(self, index: int) -> tuple:
+        step = (self.end - self.start) / self.count
+        upper = self.end if index == self.count - 1 else self.start + step * (index + 1)
+        return format_instant(self.start + step * index), format_instant(upper)
+
+    def search_params(self, index: int) -> dict:
+        lower, upper = self.window(index)
+        return dict(self.params, _lastUpdated=[f"ge{lower}", f"lt{upper}"])
+
+    def describe(self, index: int) -> str:
+        lower, upper = self.window(index)
+        return f"{self.resource_type} updated [{lower}, {upper})"
+
+
+class Lease:
+    """Lease of one shard, held in a Basic resource."""
+
+    def __init__(self, resource: dict):
+        self.resource = resource
+
+    def __repr__(self):
+        return f"Lease({self.index} {self.status} {self.owner or ''})"
+
+    @property
+    def state(self) -> dict:
+        for extension in self.resource.get("extension", []):
+            if extension.get("url") == SHARD_EXTENSION_URL:
+                return json.loads(extension["valueString"])
+        return {}
+
+    @property
+    def index(self) -> int:
+        return self.state["index"]
+
+    @property
+    def status(self) -> str:
+        return self.state.get("status", "pending")
+
+    @property
+    def owner(self):
+        return self.state.get("owner")
+
+    @property
+    def version_id(self):
+        return self.resource.get("meta", {}).get("versionId")
+
+    def expired(self, now: datetime) -> bool:
+        expires = self.state.get("expires")
+        return expires is None or parse_instant(expires) <= now
+
+    def claimable(self, now: datetime) -> bool:
+        return self.status in ("pending", "failed") or (self.status == "leased" and self.expired(now))
+
+    def with_state(self, **changes) -> dict:
+        """The lease resource with updated state."""
+        state = dict(self.state, **changes)
+        extensions = [extension for extension in self.resource.get("extension", [])
+                      if extension.get("url") != SHARD_EXTENSION_URL]
+        extensions.append({"url": SHARD_EXTENSION_URL, "valueString": json.dumps(state)})
+        return dict(self.resource, extension=extensions)
+
+
+class Shard:
+    """The shard a worker holds the lease of, handed to the shard function."""
+
+    def __init__(self, run: 'ShardedRun', lease: Lease):
+        self.run = run
+        self.lease = lease
+        self.index = lease.index
+        self.renewed = time.monotonic()
+
+    def __repr__(self):
+        return f"Shard({self.run.name}: {self.description})"
+
+    @property
+    def description(self) -> str:
+        return self.run.partitioner.describe(self.index)
+
+    @property
+    def search_params(self) -> dict:
+        return self.run.partitioner.search_params(self.index)
+
+    def contains(self, resource: dict) -> bool:
+        return self.run.partitioner.contains(self.index, resource)
+
+    def renew(self):
+        """Extend the lease. Raises LeaseLostError when another worker took the shard over."""
+        self.lease = self.run.update_lease(self.lease, expires=self.run.expiry())
+        self.renewed = time.monotonic()
+
+    def renew_if_due(self):
+        if time.monotonic() - self.renewed > self.run.lease_seconds / 3:
+            self.renew()
+
+    def resources(self, count: int = None):
+        """Generator over the resources of the shard, renewing the lease while paging."""
+        partitioner = self.run.partitioner
+        for resource in self.run.get_client().search(partitioner.resource_type, self.search_params, count):
+            self.renew_if_due()
+            if self.contains(resource):
+                yield resource
+
+
+class ShardedRun:
+    """The shards of one sharded migration step and their leases, identified by the name."""
+
+    def __init__(self, name: str, partitioner: Partitioner, client=None, worker_id: str = None,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 resource_id: str = None):
+        self.name = name
+        self.partitioner = partitioner
+        self.client = client
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.resource_id = resource_id or MIGRATION_RESOURCE_ID
+
+    def __repr__(self):
+        return f"ShardedRun({self.name}, {self.partitioner})"
+
+    @property
+    def run_identifier(self) -> str:
+        return f"{self.resource_id}/{self.name}/{self.partitioner.count}"
+
+    def shard_identifier(self, index: int) -> str:
+        return f"{self.run_identifier}/{index}"
+
+    def get_client(self):
+        return self.client or get_client()
+
+    def expiry(self) -> str:
+        return format_instant(datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds))
+
+    def leases(self) -> dict:
+        """Leases of the run by shard index, creating the missing ones."""
+        response = self.get_client().get(
+            "Basic",
+            params={"identifier": f"{SHARD_RUN_SYSTEM}|{self.run_identifier}", "_count": self.partitioner.count},
+            headers={'Cache-Control': 'no-cache'}
+        )
+        response.raise_for_status()
+        leases = {}
+        for entry in response.json().get("entry", []):
+            lease = Lease(entry["resource"])
+            leases[lease.index] = lease
+
+        for index in range(self.partitioner.count):
+            if index not in leases:
+                leases[index] = self.create_lease(index)
+        return leases
+
+    def create_lease(self, index: int) -> Lease:
+        """Create the pending lease of a shard, unless another worker created it first."""
+        identifier = self.shard_identifier(index)
+        resource = {
+            "resourceType": "Basic",
+            "identifier": [
+                {"system": SHARD_SYSTEM, "value": identifier},
+                {"system": SHARD_RUN_SYSTEM, "value": self.run_identifier},
+            ],
+            "code": {"coding": [{"system": MIGRATION_SYSTEM, "code": "shard"}]},
+            "extension": [{"url": SHARD_EXTENSION_URL, "valueString": json.dumps({
+                "index": index, "status": "pending", "description": self.partitioner.describe(index),
+            })}],
+        }
+        response = self.get_client().post(
+            "Basic",
+            headers={'If-None-Exist': f"identifier={SHARD_SYSTEM}|{identifier}", 'Prefer': 'return=representation'},
+            data=json.dumps(resource)
+        )
+        response.raise_for_status()
+        return Lease(response.json())
+
+    def update_lease(self, lease: Lease, **changes) -> Lease:
+        """Update the lease if it is unchanged since it was read. Raises LeaseLostError otherwise."""
+        resource = lease.with_state(**changes)
+        response = self.get_client().put(
+            f"Basic/{resource['id']}",
+            headers={'If-Match': f'W/"{lease.version_id}"', 'Prefer': 'return=representation'},
+            data=json.dumps(resource)
+        )
+        if response.status_code in (409, 412):
+            raise LeaseLostError(f"Lease of {self.partitioner.describe(lease.index)} was changed by another worker")
+        response.raise_for_status()
+        return Lease(response.json())
+
+    def read_lease(self, index: int) -> Lease:
+        response = self.get_client().get(
+            "Basic",
+            params={"identifier": f"{SHARD_SYSTEM}|{self.shard_identifier(index)}"},
+            headers={'Cache-Control': 'no-cache'}
+        )
+        response.raise_for_status()
+        return Lease(first_in_bundle(response.json()))
+
+    def claim(self, lease: Lease):
+        """Lease the shard to this worker, returns the Shard or None when another worker was faster."""
+        try:
+            claimed = self.update_lease(lease, status="leased", owner=self.worker_id, expires=self.expiry(),
+                                        attempts=lease.state.get("attempts", 0) + 1, error=None)
+        except LeaseLostError:
+            return None
+        return Shard(self, claimed)
+
+    def complete(self, shard: Shard):
+        """Mark the shard done. A lease taken over meanwhile is fine when the other worker completed it."""
+        try:
+            shard.lease = self.update_lease(shard.lease, status="done", expires=None)
+        except LeaseLostError:
+            if self.read_lease(shard.index).status != "done":
+                raise
+
+    def fail(self, shard: Shard, error: Exception):
+        try:
+            shard.lease = self.update_lease(shard.lease, status="failed", expires=None, error=str(error))
+        except LeaseLostError:
+            logger.warning(f"{shard} failed after its lease was taken over: {error}")
+
+    def work(self, func) -> int:
+        """Process claimable shards with func(shard) until every shard is done.
+        Returns the number of shards processed by this worker."""
+        processed = 0
+        # Failed shards are pending again for a new run
+        retry = {index for index, lease in self.leases().items() if lease.status == "failed"}
+        while True:
+            leases = self.leases()
+            if all(lease.status == "done" for lease in leases.values()):
+                logger.info(f"{self} completed, {processed} shard(s) processed by {self.worker_id}")
+                return processed
+
+            now = datetime.now(timezone.utc)
+            failed = [lease for lease in leases.values() if lease.status == "failed" and lease.index not in retry]
+            if failed:
+                errors = "; ".join(f"{self.partitioner.describe(lease.index)}: {lease.state.get('error')}"
+                                   for lease in failed)
+                raise ShardingError(f"{self}: {len(failed)} shard(s) failed: {errors}")
+
+            shard = None
+            for lease in sorted(leases.values(), key=lambda lease: lease.index):
+                if lease.claimable(now):
+                    shard = self.claim(lease)
+                    if shard is not None:
+                        break
+            if shard is None:
+                logger.debug(f"{self}: waiting for shards leased by other workers")
+                time.sleep(self.poll_interval)
+                continue
+
+            retry.discard(shard.index)
+            logger.info(f"Processing {shard} as {self.worker_id}")
+            try:
+                func(shard)
+            except LeaseLostError as e:
+                logger.warning(f"Abandoning {shard}: {e}")
+                continue
+            except Exception as e:
+                logger.error(f"{shard} failed: {e}")
+                self.fail(shard, e)
+                raise ShardingError(f"{shard} failed: {e}") from e
+            self.complete(shard)
+            processed += 1
+
+    def work_dry_run(self, func) -> int:
+        """Process every shard once with func(shard), holding local leases. For a dry run,
+        whose lease writes are recorded but not stored. Returns the number of shards."""
+        for index in range(self.partitioner.count):
+            lease = Lease({
+                "resourceType": "Basic",
+                "id": f"dry-run-{index}",
+                "extension": [{"url": SHARD_EXTENSION_URL, "valueString": json.dumps({
+                    "index": index, "status": "leased", "owner": self.worker_id,
+                })}],
+            })
+            logger.info(f"Dry run: processing {self.partitioner.describe(index)}")
+            func(Shard(self, lease))
+        return self.partitioner.count
+
+    def clear(self):
+        """Delete the leases of the run."""
+        response = self.get_client().delete(
+            "Basic", params={"identifier": f"{SHARD_RUN_SYSTEM}|{self.run_identifier}"})
+        response.raise_for_status()
+
+
+def intercepting_adapters(*clients) -> list:
+    """Adapters mounted on the clients in place of the pooled HTTPAdapter, e.g. by a dry run or metrics."""
+    adapters = []
+    for client in clients:
+        for adapter in client.session.adapters.values():
+            while adapter is not None and not isinstance(adapter, HTTPAdapter):
+                adapters.append(adapter)
+                adapter = getattr(adapter, "adapter", None)
+    return adapters
+
+
+def work_in_child(run: ShardedRun, func):
+    """Worker process body. The forked process opens its own connections."""
+    if run.client is not None:
+        run.client = FHIRClient(base_url=run.client.base_url, timeout=run.client.timeout)
+    run.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    try:
+        run.work(func)
+    except Exception as e:
+        logger.error(f"Worker {run.worker_id} of {run} failed: {e}")
+        os._exit(1)
+    os._exit(0)
+
+
+def run_sharded(name: str, partitioner: Partitioner, func, processes: int = 1, **kwargs) -> int:
+    """Process the shards with func(shard) in this and `processes - 1` forked worker processes,
+    together with the workers of other nodes running the same step. Returns once every shard is done,
+    raises ShardingError when a shard failed. Keyword arguments are passed to ShardedRun.
+    Other workers may have written the migration state of the step already. This is accepted when
+    the state is updated afterwards (see ran_sharded_step), and the run of this node stops: the
+    worker which wrote the state continues it. Under a dry run or metrics recording, the shards
+    are processed in this process only: forked workers open new clients without the intercepting
+    adapters."""
+    run = ShardedRun(name, partitioner, **kwargs)
+    adapters = intercepting_adapters(run.get_client(), get_client())
+    if any(isinstance(adapter, DryRunAdapter) for adapter in adapters):
+        return run.work_dry_run(func)
+    if adapters and processes > 1:
+        logger.info(f"{run}: requests are intercepted, processing the shards without forked workers")
+        processes = 1
+
+    children = []
+    context = multiprocessing.get_context("fork")
+    for _ in range(processes - 1):
+        child = context.Process(target=work_in_child, args=(run, func), daemon=True)
+        child.start()
+        children.append(child)
+
+    try:
+        processed = run.work(func)
+    finally:
+        for child in children:
+            child.join()
+    thread_state.sharded = True
+    return processed
+
+
+def reset_sharded_step():
+    """Forget sharded steps completed on this thread, called before a migration runs."""
+    thread_state.sharded = False
+
+
+def ran_sharded_step() -> bool:
+    """Whether a sharded step completed on this thread since reset_sharded_step().
+    The workers of the step then all write the same migration state."""
+    return getattr(thread_state, "sharded", False)
@@ -0,0 +1,697 @@
+"""Stub FHIR Server
+
+An in-process, in-memory stand-in for a FHIR store, used by the tests and the end
+to end benchmarks where no real server is available. It runs on a background
+thread of a `ThreadingHTTPServer` bound to a free local port:
+
+    from fhir_migrations.client import configure_client
+    from fhir_migrations.stub_server import StubFHIRServer
+
+    with StubFHIRServer(latency=0.005, throttle_rate=0.01) as server:
+        configure_client(base_url=server.base_url)
+        ...
+
+Supported interactions, for any resource type:
+
+- read, create (POST), update (PUT) and delete, with `If-Match` version checks
+- conditional create (`If-None-Exist`), update and delete (`PUT Basic?identifier=system|value`)
+- search by `identifier`, `_id` and `_lastUpdated`, paged by `_count` with `next` links
+- JSON Patch (PATCH with `application/json-patch+json`)
+- batch and transaction Bundles posted to the base URL
+- Bulk Data `$export` (system, type or group level) with status polling and NDJSON files
+- `$import` of NDJSON inputs posted as raw Binary resources or uploaded below `files_url`
+
+`latency` delays every response, `error_rate` answers the given share of requests
+with `error_status` (500) and `throttle_rate` with 429 and a `Retry-After` header.
+Requests are counted by method and status in `request_counts`.
+"""
+import base64
+import copy
+import json
+import logging
+import random
+import re
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+DEFAULT_EXPORT_FILE_SIZE = 1000
+JSON_CONTENT_TYPES = ("application/fhir+json", "application/json")
+ID_PATTERN = re.compile(r"^[A-Za-z0-9\-.]{1,64}$")
+
+
+class StubError(Exception):
+    """Error answered with the status and an OperationOutcome."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def operation_outcome(message: str, code: str = "processing") -> dict:
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": code, "diagnostics": message}],
+    }
+
+
+def parse_version(if_match: str) -> str:
+    """Version id of an If-Match header value, e.g. W/"3" -> 3"""
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    return value.strip('"')
+
+
+def matches_identifier(resource: dict, token: str) -> bool:
+    """Whether the resource has an identifier matching the system|value token."""
+    if "|" in token:
+        system, value = token.split("|", 1)
+    else:
+        system, value = None, token
+    for identifier in resource.get("identifier", []):
+        if system and identifier.get("system") != system:
+            continue
+        if not value or identifier.get("value") == value:
+            return True
+    return False
+
+
+def matches_last_updated(resource: dict, expressions: list) -> bool:
+    """Whether meta.lastUpdated satisfies every prefixed _lastUpdated value (ge, gt, le, lt, eq)."""
+    last_updated = resource.get("meta", {}).get("lastUpdated", "")
+    for expression in expressions:
+        prefix, value = expression[:2], expression[2:]
+        if prefix not in ("ge", "gt", "le", "lt", "eq"):
+            prefix, value = "eq", expression
+        compared = last_updated[:len(value)]
+        if prefix == "ge" and not compared >= value:
+            return False
+        if prefix == "gt" and not compared > value:
+            return False
+        if prefix == "le" and not compared <= value:
+            return False
+        if prefix == "lt" and not compared < value:
+            return False
+        if prefix == "eq" and not compared == value:
+            return False
+    return True
+
+
+def apply_json_patch(resource: dict, operations: list) -> dict:
+    """Apply add, remove, replace and test operations of a JSON Patch."""
+    patched = copy.deepcopy(resource)
+    for operation in operations:
+        op = operation.get("op")
+        tokens = [token.replace("~1", "/").replace("~0", "~") for token in operation["path"].split("/")[1:]]
+        if not tokens:
+            raise StubError(422, "Patching the resource root is not supported")
+
+        parent = patched
+        try:
+            for token in tokens[:-1]:
+                parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        except (KeyError, IndexError, ValueError):
+            raise StubError(422, f"Patch path {operation['path']} not found")
+        key = tokens[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == "-" else int(key)
+            exists = 0 <= key < len(parent)
+        else:
+            exists = key in parent
+        if op in ("remove", "replace", "test") and not exists:
+            raise StubError(422, f"Patch path {operation['path']} not found")
+
+        if op == "add" and isinstance(parent, list):
+            parent.insert(key, operation["value"])
+        elif op in ("add", "replace"):
+            parent[key] = operation["value"]
+        elif op == "remove":
+            del parent[key]
+        elif op == "test":
+            if parent[key] != operation["value"]:
+                raise StubError(422, f"Patch test failed at {operation['path']}")
+        else:
+            raise StubError(422, f"Unsupported patch operation {op}")
+    return patched
+
+
+class ResourceStore:
+    """Thread safe in-memory resources by type and id, with version history ids.
+    Identifier values are indexed, so identifier searches do not scan all resources."""
+
+    def __init__(self):
+        self.resources = {}
+        self.identifier_index = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return sum(len(resources) for resources in self.resources.values())
+
+    def all(self, resource_type: str) -> list:
+        with self.lock:
+            return list(self.resources.get(resource_type, {}).values())
+
+    def read(self, resource_type: str, resource_id: str) -> dict:
+        with self.lock:
+            resource = self.resources.get(resource_type, {}).get(resource_id)
+        if resource is None:
+            raise StubError(404, f"Resource {resource_type}/{resource_id} is not known")
+        return resource
+
+    def write(self, resource_type: str, resource: dict, resource_id: str = None, if_match: str = None):
+        """Create or update the resource, returns (resource, created)."""
+        if resource.get("resourceType") != resource_type:
+            raise StubError(400, f"Expected a {resource_type} resource")
+        resource_id = resource_id or resource.get("id") or str(uuid.uuid4())
+        if resource.get("id") not in (None, resource_id):
+            raise StubError(400, f"Resource id {resource.get('id')} does not match the URL id {resource_id}")
+
+        with self.lock:
+            existing = self.resources.get(resource_type, {}).get(resource_id)
+            version = int(existing["meta"]["versionId"]) if existing else 0
+            if if_match is not None:
+                if existing is None:
+                    raise StubError(404, f"Resource {resource_type}/{resource_id} is not known")
+                if parse_version(if_match) != str(version):
+                    raise StubError(412, f"Version {if_match} does not match the current version {version}")
+
+            stored = dict(resource, id=resource_id)
+            stored["meta"] = dict(resource.get("meta", {}), versionId=str(version + 1),
+                                  lastUpdated=datetime.now(timezone.utc).isoformat(timespec="milliseconds"))
+            self.resources.setdefault(resource_type, {})[resource_id] = stored
+            if existing is not None:
+                self.unindex(existing)
+            self.index(stored)
+        return stored, existing is None
+
+    def delete(self, resource_type: str, resource_id: str) -> bool:
+        with self.lock:
+            existing = self.resources.get(resource_type, {}).pop(resource_id, None)
+            if existing is not None:
+                self.unindex(existing)
+            return existing is not None
+
+    def index(self, resource: dict):
+        for identifier in resource.get("identifier", []):
+            key = (resource["resourceType"], identifier.get("value"))
+            self.identifier_index.setdefault(key, {})[resource["id"]] = None
+
+    def unindex(self, resource: dict):
+        for identifier in resource.get("identifier", []):
+            self.identifier_index.get((resource["resourceType"], identifier.get("value")), {}).pop(resource["id"], None)
+
+    def candidates(self, resource_type: str, identifiers: list) -> list:
+        """Resources possibly matching the identifier search, all resources of the type without one."""
+        values = [token.split("|", 1)[-1] for token in identifiers[0].split(",")] if identifiers else []
+        with self.lock:
+            resources = self.resources.get(resource_type, {})
+            if not values or not all(values):
+                return list(resources.values())
+            ids = {}
+            for value in values:
+                ids.update(self.identifier_index.get((resource_type, value), {}))
+            return [resources[resource_id] for resource_id in ids]
+
+    def search(self, resource_type: str, params: list) -> list:
+        """Resources matching all (name, value) search parameters."""
+        identifiers = [value for name, value in params if name == "identifier"]
+        ids = [value.split(",") for name, value in params if name == "_id"]
+        last_updated = [value for name, value in params if name == "_lastUpdated"]
+
+        matches = []
+        for resource in self.candidates(resource_type, identifiers):
+            if any(not any(matches_identifier(resource, token) for token in value.split(",")) for value in identifiers):
+                continue
+            if any(resource["id"] not in values for values in ids):
+                continue
+            if last_updated and not matches_last_updated(resource, last_updated):
+                continue
+            matches.append(resource)
+        return matches
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {resource_type: dict(resources) for resource_type, resources in self.resources.items()}
+
+    def restore(self, snapshot: dict):
+        with self.lock:
+            self.resources = snapshot
+            self.identifier_index = {}
+            for resources in snapshot.values():
+                for resource in resources.values():
+                    self.index(resource)
+
+
+class StubResponse:
+    """Status, headers and JSON body, or raw content, of a handled request."""
+
+    def __init__(self, status: int, body: dict = None, headers: dict = None, content: bytes = None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.content = content
+
+    @classmethod
+    def for_resource(cls, status: int, resource: dict, base_url: str, prefer: str = None) -> 'StubResponse':
+        location = f"{base_url}/{resource['resourceType']}/{resource['id']}/_history/{resource['meta']['versionId']}"
+        headers = {"ETag": f'W/"{resource["meta"]["versionId"]}"', "Location": location}
+        body = None if prefer == "return=minimal" else resource
+        return cls(status, body, headers)
+
+
+class StubFHIRServer:
+    """In-memory FHIR server on a background thread."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 500, throttle_rate: float = 0.0, retry_after: int = 0,
+                 page_size: int = DEFAULT_PAGE_SIZE, seed: int = None, export_polls: int = 1,
+                 export_file_size: int = DEFAULT_EXPORT_FILE_SIZE):
+        self.store = ResourceStore()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        # Status polls answered with 202 before an export completes, resources per exported file
+        self.export_polls = export_polls
+        self.export_file_size = export_file_size
+        self.jobs = {}
+        self.files = {}
+        self.random = random.Random(seed)
+        self.request_counts = Counter()
+        self.counts_lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), StubRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.thread = None
+
+    def __repr__(self):
+        return f"StubFHIRServer({self.base_url})"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/fhir"
+
+    @property
+    def files_url(self) -> str:
+        """URL prefix of the plain file storage, e.g. for uploads of $import inputs."""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/files"
+
+    @property
+    def request_count(self) -> int:
+        return sum(self.request_counts.values())
+
+    def start(self) -> 'StubFHIRServer':
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05},
+                                       name="stub-fhir-server", daemon=True)
+        self.thread.start()
+        logger.debug(f"Started {self}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def count(self, method: str, status: int):
+        with self.counts_lock:
+            self.request_counts[(method, status)] += 1
+
+    def injected_fault(self):
+        """A 429 or error response for the configured share of requests, None otherwise."""
+        if not (self.throttle_rate or self.error_rate):
+            return None
+        with self.counts_lock:
+            draw = self.random.random()
+        if draw < self.throttle_rate:
+            return StubResponse(429, operation_outcome("Too many requests", "throttled"),
+                                {"Retry-After": str(self.retry_after)})
+        if draw < self.throttle_rate + self.error_rate:
+            return StubResponse(self.error_status, operation_outcome("Injected error", "exception"))
+        return None
+
+    def handle(self, method: str, path: str, query: list, headers, body: bytes) -> StubResponse:
+        """Dispatch a request relative to the base path, e.g. ('GET', 'Patient/1', ...)"""
+        segments = [segment for segment in path.split("/") if segment]
+        content_type = headers.get("Content-Type") or "application/fhir+json"
+        if body and segments[:1] == ["Binary"] and content_type.split(";")[0] not in JSON_CONTENT_TYPES:
+            # Raw content posted to Binary is stored as its data
+            payload = {"resourceType": "Binary", "contentType": content_type,
+                       "data": base64.b64encode(body).decode("ascii")}
+        else:
+            payload = json.loads(body) if body else None
+        prefer = headers.get("Prefer")
+
+        if method == "POST" and not segments:
+            return self.process_bundle(payload)
+        if method == "GET" and segments == ["metadata"]:
+            return StubResponse(200, {"resourceType": "CapabilityStatement", "status": "active",
+                                      "kind": "instance", "fhirVersion": "4.0.1", "format": ["json"]})
+        if any(segment.startswith("$") for segment in segments):
+            return self.operation(method, segments, query, payload)
+        if not segments or len(segments) > 2:
+            raise StubError(404, f"Unsupported path {path}")
+
+        resource_type = segments[0]
+        resource_id = segments[1] if len(segments) == 2 else None
+
+        if method == "GET" and resource_id is None:
+            return self.search(resource_type, query)
+        if method == "GET":
+            return StubResponse.for_resource(200, self.store.read(resource_type, resource_id), self.base_url)
+        if method == "POST" and resource_id is None:
+            return self.create(resource_type, payload, headers.get("If-None-Exist"), prefer)
+        if method == "PUT":
+            return self.update(resource_type, resource_id, query, payload, headers.get("If-Match"), prefer)
+        if method == "PATCH" and resource_id is not None:
+            current = self.store.read(resource_type, resource_id)
+            resource, _ = self.store.write(resource_type, apply_json_patch(current, payload), resource_id,
+                                           if_match=headers.get("If-Match"))
+            return StubResponse.for_resource(200, resource, self.base_url, prefer)
+        if method == "DELETE":
+            return self.delete(resource_type, resource_id, query)
+        raise StubError(405, f"{method} {path} is not supported")
+
+    def operation(self, method: str, segments: list, query: list, payload: dict) -> StubResponse:
+        """Bulk Data operations: $export and $import kick-off, status polling and file downloads."""
+        names = [segment for segment in segments if segment.startswith("$")]
+        name = names[0]
+        arguments = segments[segments.index(name) + 1:]
+
+        if name == "$export" and method == "GET":
+            return self.start_export(segments[:segments.index(name)], dict(query))
+        if name == "$import" and method == "POST" and not arguments:
+            return self.start_import(payload)
+        if name == "$job-status" and len(arguments) == 1:
+            return self.job_status(method, arguments[0])
+        if name == "$job-file" and len(arguments) == 2 and method == "GET":
+            job = self.jobs.get(arguments[0])
+            if job is None or job["polls"] > 0:
+                raise StubError(404, f"Unknown job file {'/'.join(arguments)}")
+            return StubResponse(200, headers={"Content-Type": "application/fhir+ndjson"},
+                                content=job["files"][int(arguments[1])])
+        raise StubError(404, f"Unsupported operation {method} {name}")
+
+    def add_job(self, manifest: dict, files: list) -> StubResponse:
+        """Register an asynchronous job completing after `export_polls` status polls.
+        The manifest refers to the files by index, as `$job-file/<job>/<index>` URLs."""
+        job_id = str(uuid.uuid4())
+        for entries in (manifest.get("output", []), manifest.get("error", [])):
+            for entry in entries:
+                if "file" in entry:
+                    entry["url"] = f"{self.base_url}/$job-file/{job_id}/{entry.pop('file')}"
+        self.jobs[job_id] = {"polls": self.export_polls, "manifest": manifest, "files": files}
+        return StubResponse(202, headers={"Content-Location": f"{self.base_url}/$job-status/{job_id}"})
+
+    def start_export(self, level: list, options: dict) -> StubResponse:
+        """Start an export of the requested types (all types by default), changed since _since.
+        The level (system, Patient or Group/id) does not restrict the exported resources."""
+        with self.store.lock:
+            types = options["_type"].split(",") if options.get("_type") else sorted(self.store.resources)
+            since = options.get("_since")
+            files = []
+            output = []
+            for resource_type in types:
+                resources = self.store.all(resource_type)
+                if since:
+                    resources = [resource for resource in resources if matches_last_updated(resource, [f"ge{since}"])]
+                for start in range(0, len(resources), self.export_file_size):
+                    chunk = resources[start:start + self.export_file_size]
+                    output.append({"type": resource_type, "file": len(files), "count": len(chunk)})
+                    files.append("".join(json.dumps(resource) + "\n" for resource in chunk).encode("utf-8"))
+
+        return self.add_job({
+            "transactionTime": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "request": f"{self.base_url}/{'/'.join(level + ['$export'])}?{urlencode(options)}",
+            "requiresAccessToken": False,
+            "output": output,
+            "error": [],
+        }, files)
+
+    def start_import(self, parameters: dict) -> StubResponse:
+        """Import the NDJSON inputs of a Parameters resource (input parts `type` and `url`).
+        Lines failing validation are reported as OperationOutcomes with their line number."""
+        inputs = []
+        for parameter in (parameters or {}).get("parameter", []):
+            if parameter.get("name") == "input":
+                parts = {part["name"]: part.get("valueCode") or part.get("valueUri") for part in parameter["part"]}
+                inputs.append((parts["type"], parts["url"]))
+        if not inputs:
+            raise StubError(400, "No input given to $import")
+
+        files = []
+        output = []
+        errors = []
+        for resource_type, url in inputs:
+            imported, outcomes = self.import_file(resource_type, self.fetch_input(url))
+            output.append({"type": "OperationOutcome", "inputUrl": url, "count": imported})
+            if outcomes:
+                errors.append({"type": "OperationOutcome", "inputUrl": url, "file": len(files),
+                               "count": len(outcomes)})
+                files.append("".join(json.dumps(outcome) + "\n" for outcome in outcomes).encode("utf-8"))
+
+        return self.add_job({
+            "transactionTime": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "request": f"{self.base_url}/$import",
+            "output": output,
+            "error": errors,
+        }, files)
+
+    def fetch_input(self, url: str) -> bytes:
+        """Content of an import input, a Binary of the store or an uploaded file."""
+        binary_prefix = f"{self.base_url}/Binary/"
+        if url.startswith(binary_prefix):
+            return base64.b64decode(self.store.read("Binary", url[len(binary_prefix):])["data"])
+        if url.startswith(f"{self.files_url}/") and url[len(self.files_url) + 1:] in self.files:
+            return self.files[url[len(self.files_url) + 1:]]
+        raise StubError(400, f"Import input {url} is not available")
+
+    def import_file(self, resource_type: str, content: bytes):
+        """Store the resources of an NDJSON file, returns the imported count and error OperationOutcomes."""
+        imported = 0
+        outcomes = []
+        for line_number, line in enumerate(content.splitlines(), start=1):
+            if not line.strip():
+                continue
+            reference = resource_type
+            try:
+                resource = json.loads(line)
+                reference = f"{resource_type}/{resource.get('id', '')}"
+                if "id" in resource and not ID_PATTERN.match(str(resource["id"])):
+                    raise StubError(400, f"Invalid resource id {resource['id']!r}")
+                self.store.write(resource_type, resource)
+                imported += 1
+            except (StubError, ValueError) as error:
+                outcome = operation_outcome(f"Line {line_number}: {error}")
+                outcome["issue"][0]["location"] = [f"line {line_number}"]
+                outcome["issue"][0]["expression"] = [reference]
+                outcomes.append(outcome)
+        return imported, outcomes
+
+    def job_status(self, method: str, job_id: str) -> StubResponse:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise StubError(404, f"Unknown job {job_id}")
+        if method == "DELETE":
+            del self.jobs[job_id]
+            return StubResponse(202)
+        if job["polls"] > 0:
+            job["polls"] -= 1
+            return StubResponse(202, headers={"X-Progress": "in-progress"})
+        return StubResponse(200, job["manifest"])
+
+    def handle_file(self, method: str, name: str, body: bytes) -> StubResponse:
+        """Plain file storage below /files, standing in for the upload location of $import inputs."""
+        if method == "PUT":
+            self.files[name] = body
+            return StubResponse(201)
+        if method == "GET" and name in self.files:
+            return StubResponse(200, headers={"Content-Type": "application/octet-stream"}, content=self.files[name])
+        raise StubError(404, f"Unknown file {name}")
+
+    def create(self, resource_type: str, resource: dict, if_none_exist: str = None,
+               prefer: str = None) -> StubResponse:
+        """Create, or with If-None-Exist return the single resource matching its search parameters."""
+        with self.store.lock:
+            if if_none_exist:
+                matches = self.store.search(resource_type, parse_qsl(if_none_exist))
+                if len(matches) > 1:
+                    raise StubError(412, f"Conditional create matched {len(matches)} resources")
+                if matches:
+                    return StubResponse.for_resource(200, matches[0], self.base_url, prefer)
+            stored, _ = self.store.write(resource_type, dict(resource, id=None))
+        return StubResponse.for_resource(201, stored, self.base_url, prefer)
+
+    def update(self, resource_type: str, resource_id: str, query: list, resource: dict,
+               if_match: str = None, prefer: str = None) -> StubResponse:
+        """Update by id or, without an id, conditionally on the search parameters."""
+        if resource_id is None:
+            matches = self.store.search(resource_type, query)
+            if len(matches) > 1:
+                raise StubError(412, f"Conditional update matched {len(matches)} resources")
+            resource_id = matches[0]["id"] if matches else resource.get("id")
+        stored, created = self.store.write(resource_type, resource, resource_id, if_match=if_match)
+        return StubResponse.for_resource(201 if created else 200, stored, self.base_url, prefer)
+
+    def delete(self, resource_type: str, resource_id: str, query: list) -> StubResponse:
+        if resource_id is not None:
+            self.store.delete(resource_type, resource_id)
+        else:
+            for resource in self.store.search(resource_type, query):
+                self.store.delete(resource_type, resource["id"])
+        return StubResponse(204)
+
+    def search(self, resource_type: str, query: list) -> StubResponse:
+        """Searchset Bundle of one page, with a next link while more matches remain."""
+        params = [(name, value) for name, value in query if name not in ("_count", "_offset")]
+        options = dict(query)
+        count = min(int(options.get("_count", self.page_size)), MAX_PAGE_SIZE)
+        offset = int(options.get("_offset", 0))
+
+        matches = self.store.search(resource_type, params)
+        page = matches[offset:offset + count]
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(matches),
+            "link": [{"relation": "self", "url": self.search_url(resource_type, params, count, offset)}],
+            "entry": [
+                {"fullUrl": f"{self.base_url}/{resource_type}/{resource['id']}", "resource": resource,
+                 "search": {"mode": "match"}}
+                for resource in page
+            ],
+        }
+        if offset + count < len(matches):
+            bundle["link"].append({"relation": "next",
+                                   "url": self.search_url(resource_type, params, count, offset + count)})
+        return StubResponse(200, bundle)
+
+    def search_url(self, resource_type: str, params: list, count: int, offset: int) -> str:
+        return f"{self.base_url}/{resource_type}?{urlencode(params + [('_count', count), ('_offset', offset)])}"
+
+    def process_bundle(self, bundle: dict) -> StubResponse:
+        """Process the entries of a batch or transaction Bundle.
+        A failing transaction entry rolls back the transaction and fails the request."""
+        if not bundle or bundle.get("resourceType") != "Bundle" or bundle.get("type") not in ("batch", "transaction"):
+            raise StubError(400, "Expected a batch or transaction Bundle")
+        transaction = bundle["type"] == "transaction"
+
+        snapshot = self.store.snapshot() if transaction else None
+        entries = []
+        for entry in bundle.get("entry", []):
+            request = entry.get("request", {})
+            url = urlsplit(request.get("url", ""))
+            entry_headers = {}
+            if request.get("ifMatch"):
+                entry_headers["If-Match"] = request["ifMatch"]
+            if request.get("ifNoneExist"):
+                entry_headers["If-None-Exist"] = request["ifNoneExist"]
+            body = json.dumps(entry["resource"]).encode("utf-8") if "resource" in entry else b""
+            try:
+                response = self.handle(request.get("method", "GET"), url.path, parse_qsl(url.query),
+                                       entry_headers, body)
+            except StubError as error:
+                if transaction:
+                    self.store.restore(snapshot)
+                    raise
+                response = StubResponse(error.status, operation_outcome(str(error)))
+
+            entry_response = {"status": str(response.status)}
+            if "Location" in response.headers:
+                entry_response["location"] = response.headers["Location"]
+            if response.status >= 400:
+                entry_response["outcome"] = response.body
+                entries.append({"response": entry_response})
+            else:
+                entries.append({"resource": response.body, "response": entry_response}
+                               if response.body else {"response": entry_response})
+
+        return StubResponse(200, {"resourceType": "Bundle", "type": f"{bundle['type']}-response", "entry": entries})
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """Routes HTTP requests below /fhir to the StubFHIRServer."""
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, avoid the delayed ACK stall on keep-alive connections
+    disable_nagle_algorithm = True
+    base_path = "/fhir"
+    files_path = "/files/"
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def do_PATCH(self):
+        self.dispatch()
+
+    def do_DELETE(self):
+        self.dispatch()
+
+    def dispatch(self):
+        stub = self.server.stub
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        if stub.latency:
+            threading.Event().wait(stub.latency)
+
+        response = stub.injected_fault()
+        if response is None:
+            try:
+                if url.path.startswith(self.files_path):
+                    response = stub.handle_file(self.command, url.path[len(self.files_path):], body)
+                elif not url.path.startswith(self.base_path):
+                    raise StubError(404, f"Unknown path {url.path}")
+                else:
+                    response = stub.handle(self.command, url.path[len(self.base_path):], parse_qsl(url.query),
+                                           self.headers, body)
+            except StubError as error:
+                response = StubResponse(error.status, operation_outcome(str(error)))
+            except (ValueError, KeyError, TypeError) as error:
+                response = StubResponse(400, operation_outcome(f"Invalid request: {error}"))
+
+        stub.count(self.command, response.status)
+        self.respond(response)
+
+    def respond(self, response: StubResponse):
+        content = response.content
+        if content is None:
+            content = json.dumps(response.body).encode("utf-8") if response.body is not None else b""
+        self.send_response(response.status)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        if content and "Content-Type" not in response.headers:
+            self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
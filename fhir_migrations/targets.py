@@ -0,0 +1,180 @@
+"""Migration Targets
+
+Runs the migrations against many FHIR stores, e.g. one per tenant, instead of
+the single store of FHIR_URL. Every target keeps its own migration state (its
+own MigrationManager Basic resource) and is migrated in a fresh worker process
+with its own shared client, so migration functions using `get_client()`,
+FHIR_URL or a `FHIRClient()`/`AsyncFHIRClient()` without a base URL address the
+target they run for, as do helper modules which captured them at import:
+
+    from fhir_migrations.targets import Target, format_report, run_targets
+
+    results = run_targets([Target("http://tenant-a/fhir"), Target("http://tenant-b/fhir")], "upgrade")
+    print(format_report(results))
+
+At most `max_workers` targets (FHIR_TARGET_CONCURRENCY by default) are migrated
+at the same time. A failing target does not stop the others; every target gets a
+TargetResult with its status, applied revisions and timing.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from fhir_migrations import config
+from fhir_migrations.config import FHIR_TARGET_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Target:
+    """A FHIR store to migrate, with the identifier of its migration state."""
+
+    def __init__(self, url: str, name: str = None, resource_id: str = None):
+        self.url = url
+        self.name = name or url
+        self.resource_id = resource_id
+
+    def __repr__(self):
+        return f"Target({self.name})"
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Target':
+        """Target of a `[name=]url` specification, e.g. tenant-a=http://tenant-a/fhir"""
+        name, separator, url = spec.strip().partition("=")
+        if not separator or "://" in name:
+            name, url = None, spec.strip()
+        if not url:
+            raise ValueError(f"Invalid target {spec!r}. Use [name=]url.")
+        return cls(url, name)
+
+
+def read_targets(path: str) -> list:
+    """Targets listed one per line in a file; blank lines and # comments are skipped."""
+    with open(path) as targets_file:
+        return [Target.parse(line) for line in targets_file if line.strip() and not line.lstrip().startswith("#")]
+
+
+class TargetResult:
+    """Outcome of migrating one target."""
+
+    def __init__(self, target: Target, direction: str, seconds: float = 0.0, applied: list = None,
+                 previous: str = None, current: str = None, error: str = None):
+        self.target = target
+        self.direction = direction
+        self.seconds = seconds
+        # (revision, seconds) of every migration run successfully
+        self.applied = applied or []
+        self.previous = previous
+        self.current = current
+        self.error = error
+
+    def __repr__(self):
+        return f"TargetResult({self.target.name} {self.status})"
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def status(self) -> str:
+        return "succeeded" if self.ok else "failed"
+
+
+class TargetRecorder:
+    """Observer recording the migrations run for a target and the first error.
+    Migrations of independent branches may be recorded concurrently."""
+    concurrent = True
+
+    def __init__(self):
+        self.applied = []
+        self.error = None
+        self.started = {}
+        self.lock = threading.Lock()
+
+    def begin_migration(self, revision: str, direction: str, location: str):
+        with self.lock:
+            self.started[revision] = time.perf_counter()
+
+    def end_migration(self, revision: str, direction: str, error: Exception = None):
+        with self.lock:
+            started = self.started.pop(revision)
+            if error is None:
+                self.applied.append((revision, time.perf_counter() - started))
+            elif self.error is None:
+                self.error = f"{revision}: {error}"
+
+
+def migrate_target(target: Target, direction: str, migrations_dir: str = None, to_revision: str = None,
+                   steps: int = None) -> TargetResult:
+    """Run the migrations for one target. Called in a fresh worker process, which is pointed at the target."""
+    # Migration functions and their helper modules read FHIR_URL, use the shared client or create
+    # their own clients. The config module was imported before, so its FHIR_URL is replaced before
+    # the modules importing it are, and clients take the target URL from the default
+    os.environ["FHIR_URL"] = config.FHIR_URL = target.url
+    from fhir_migrations.client import configure_client, set_default_base_url
+    from fhir_migrations.migration import Migration
+
+    started = time.perf_counter()
+    result = TargetResult(target, direction)
+    recorder = TargetRecorder()
+    set_default_base_url(target.url)
+    client = configure_client(base_url=target.url)
+    try:
+        migration = Migration(migrations_dir, client=client, resource_id=target.resource_id)
+        result.previous = migration.get_latest_applied_migration_from_fhir()
+        migration.run_migrations(direction, observers=[recorder], to_revision=to_revision, steps=steps)
+        result.current = migration.get_migration_state().get_latest_migration()
+        result.error = recorder.error
+    except Exception as e:
+        logger.error(f"Migrating {target} failed: {e}")
+        result.error = recorder.error or f"{type(e).__name__}: {e}"
+    result.applied = recorder.applied
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+def run_targets(targets: list, direction: str, migrations_dir: str = None, max_workers: int = None,
+                to_revision: str = None, steps: int = None) -> list:
+    """Migrate the targets in parallel worker processes, returns their TargetResults in target order.
+    to_revision and steps limit the migrations run, see Migration.resolve_path."""
+    if not targets:
+        return []
+    max_workers = min(max_workers or FHIR_TARGET_CONCURRENCY, len(targets))
+    logger.info(f"Running {direction} on {len(targets)} targets, {max_workers} at a time")
+
+    # Workers are spawned, so they do not inherit the pooled connections of this process, and
+    # every target gets a new worker: modules imported for a target, which may have captured its
+    # client or FHIR_URL, are not reused for the next one
+    with multiprocessing.get_context("spawn").Pool(max_workers, maxtasksperchild=1) as pool:
+        pending = [pool.apply_async(migrate_target, (target, direction, migrations_dir, to_revision, steps))
+                   for target in targets]
+        results = []
+        for target, result in zip(targets, pending):
+            try:
+                results.append(result.get())
+            except Exception as e:
+                logger.error(f"Migrating {target} failed: {e}")
+                results.append(TargetResult(target, direction, error=f"{type(e).__name__}: {e}"))
+    return results
+
+
+def format_report(results: list, seconds: float = None) -> str:
+    """Text report of the targets run, with a summary line."""
+    width = max((len(result.target.name) for result in results), default=0)
+    lines = []
+    for result in results:
+        line = (f"{result.status.upper():9} {result.target.name:{width}}  {result.seconds:8.2f}s  "
+                f"{len(result.applied)} applied, {result.previous or '-'} -> {result.current or '-'}")
+        if result.error:
+            line += f"  {result.error}"
+        lines.append(line)
+
+    failed = sum(1 for result in results if not result.ok)
+    summary = f"{len(results)} targets: {len(results) - failed} succeeded, {failed} failed"
+    if seconds is not None:
+        summary += f" in {seconds:.2f}s ({sum(result.seconds for result in results):.2f}s of target time)"
+    lines.append(summary)
+    return "\n".join(lines)
@@ -8,7 +8,20 @@ each time new migration is added to the migrations directory.
 Self.head is always pointing to the latest created migration id, tail is pointing
 to the first created migration (the migration with no preceding migration).
 Hence, primary iterates backwards and adds forward.
+
+The (revision, down_revision) pairs a list is built from are validated in a single
+pass beforehand, reporting every cycle, fork, orphan and duplicate at once.
+
+Migration keeps its order in a RevisionSequence only, derived once from the
+validated pairs; it does not maintain a LinkedList alongside it.
+
+Histories where revisions share a down_revision (branches) or where a merge
+revision has several down_revisions are held in a RevisionGraph instead, a DAG
+ordered topologically; the applied state of a graph is the set of its heads.
 """
+from collections import deque
+
+
 class Node:
     def __init__(self, data):
         """Initialize a node with two connections containing data."""
@@ -33,34 +46,29 @@ class Node:
 
 class LinkedList:
     def __init__(self):
-        """Initialize a linked list."""
+        """Initialize a linked list.
+        Nodes are indexed by their data, positions count from the tail (0) to the head."""
         self.head = None
+        self.index = {}
+        self.positions = {}
 
     def __contains__(self, data):
         """Find whether specific data is present in the list."""
-        current_node = self.head
-        while current_node:
-            if current_node.data == data:
-                return True
-            current_node = current_node.prev_node
-        return False
+        return data in self.index
+
+    def __len__(self):
+        """Number of nodes in the list."""
+        return len(self.index)
 
     def find(self, data) -> Node:
-        """Find the first node containing specified data."""
-        current_node = self.head
-        while current_node:
-            if current_node.data == data:
-                return current_node
-            current_node = current_node.prev_node
-        return None
+        """Find the node containing specified data."""
+        return self.index.get(data)
 
     def next_node(self, current_node_data) -> Node:
         """Retrieve node after the specified one."""
-        next_node = self.head
-        while next_node and next_node.prev_node:
-            if next_node.prev_node.data == current_node_data:
-                return next_node
-            next_node = next_node.prev_node
+        current_node = self.find(current_node_data)
+        if current_node and current_node.next_node:
+            return current_node.next_node
         return None
 
     def next(self, current_node_data) -> object:
@@ -86,6 +94,11 @@ class LinkedList:
         else:
             return None
 
+    def distance(self, first_node_data, last_node_data) -> int:
+        """Return the number of steps from the first node to the last node.
+        Negative when the last node precedes the first one."""
+        return self.positions[last_node_data] - self.positions[first_node_data]
+
     def get_sublist(self, first_node_data: str, last_node_data: str = None) -> list:
         """Return a list consisting of nodes between the specified boundaries.
         Inclusive of last endpoint, but not of first."""
@@ -94,9 +107,17 @@ class LinkedList:
             last_node = self.head
         else:
             last_node = self.find(last_node_data)
+        if last_node is None:
+            return unapplied_migrations
+
+        # Without a preceding first node, everything up to the tail is included
+        last_position = self.positions[last_node.data]
+        first_position = self.positions.get(first_node_data, -1)
+        if first_position > last_position:
+            first_position = -1
 
         # Iterate over migrations starting from the latest migration
-        while last_node and last_node.data != first_node_data:
+        for _ in range(last_position - first_position):
             unapplied_migrations.append(last_node.data)
             last_node = last_node.prev_node
 
@@ -108,22 +129,26 @@ class LinkedList:
     def add(self, data):
         """Add new node after the head, updating the head.
         Raises an error if node with such migration already exists in the list."""
-        new_node = self.find(data)
-        if new_node:
+        if data in self.index:
             raise ValueError("adding a duplicate item")
         new_node = Node(data)
 
-        if self.head is None:
-            self.head = new_node
-        else:
+        if self.head is not None:
             current_node = self.head
             current_node.next_node = new_node
             new_node.prev_node = current_node
-            self.head = new_node
+        self.head = new_node
+        self.positions[data] = len(self.index)
+        self.index[data] = new_node
 
     def build_list_from_dictionary(self, previous_nodes: dict):
         '''Creates a sorted LinkedList where head is the latest created migration in the directory.
-        Tail is the migration pointing to "None," all new migrations are added after the head'''
+        Tail is the migration pointing to "None," all new migrations are added after the head.
+        Raises SequenceError listing every problem found when the nodes do not form a single line.'''
+        validation = validate_sequence(previous_nodes)
+        if not validation.is_valid:
+            raise SequenceError(validation)
+
         nodes_references: dict = {}
         for key in previous_nodes.keys():
             node = Node(key)
@@ -131,14 +156,14 @@ class LinkedList:
 
         # First, create all migration nodes without linking them
         for migration, node in nodes_references.items():
-            prev_node_id = previous_nodes[migration]
-            if prev_node_id != 'None':
+            for prev_node_id in down_revisions(previous_nodes[migration]):
                 prev_node = nodes_references[prev_node_id]
                 if prev_node:
                     node.prev_node = prev_node
                     prev_node.next_node = node
 
         # Find the migration node that has no 'next_node' (i.e., the tail node)
+        self.head = None
         for node in nodes_references.values():
             if node.next_node is None:
                 self.head = node
@@ -146,6 +171,21 @@ class LinkedList:
 
         # Assess whether there are any inconsistencies
         self.check_consistency()
+        self.build_index()
+
+    def build_index(self):
+        """Rebuild the data and position indexes by iterating from the head."""
+        chain = []
+        node = self.head
+        while node:
+            chain.append(node)
+            node = node.prev_node
+
+        self.index = {}
+        self.positions = {}
+        for position, node in enumerate(reversed(chain)):
+            self.index[node.data] = node
+            self.positions[node.data] = position
 
     def check_consistency(self):
         '''Iterates from the head to check whether all of the nodes were rightly assigned
@@ -164,12 +204,10 @@ class LinkedList:
 
             # Check for inconsistent references
             if node.next_node:
-                next_node = self.find(node.next_node.data)
-                if next_node.prev_node != node:
+                if node.next_node.prev_node != node:
                     raise RuntimeError("Consistency error: node references are not consistent")
             if node.prev_node:
-                prev_node = self.find(node.prev_node.data)
-                if prev_node.next_node != node:
+                if node.prev_node.next_node != node:
                     raise RuntimeError("Consistency error: node references are not consistent")
             node = node.prev_node
 
@@ -194,15 +232,412 @@ class LinkedList:
 
                 # Check for inconsistent references
                 if node.next_node:
-                    next_node = self.find(node.next_node.data)
-                    if next_node.prev_node != node:
+                    if node.next_node.prev_node != node:
                         raise RuntimeError(f"Consistency error: node references are not consistent")
                 if node.prev_node:
-                    prev_node = self.find(node.prev_node.data)
-                    if prev_node.next_node != node:
+                    if node.prev_node.next_node != node:
                         raise RuntimeError(f"Consistency error: node references are not consistent")
 
             if tail_count != 1:
                 raise RuntimeError(f"Consistency error: expected exactly one tail node, found {tail_count}")
 
             return True
+
+
+class RevisionSequence:
+    """Immutable, array backed sequence of revisions in migration order.
+    Index 0 is the first created migration (the tail), the last index is the
+    latest created one (the head). File locations share the indexes."""
+    __slots__ = ("revisions", "locations", "positions")
+
+    def __init__(self, revisions=(), locations=()):
+        """Initialize from revisions in migration order and their optional locations."""
+        revisions = tuple(revisions)
+        object.__setattr__(self, "revisions", revisions)
+        object.__setattr__(self, "locations", tuple(locations) or (None,) * len(revisions))
+        object.__setattr__(self, "positions", {revision: i for i, revision in enumerate(revisions)})
+
+    @classmethod
+    def from_linked_list(cls, linked_list: LinkedList, locations: dict = None) -> 'RevisionSequence':
+        """Create the sequence from a LinkedList, looking up locations by revision."""
+        revisions = linked_list.get_sublist(None)
+        locations = locations or {}
+        return cls(revisions, [locations.get(revision) for revision in revisions])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __len__(self):
+        return len(self.revisions)
+
+    def __iter__(self):
+        return iter(self.revisions)
+
+    def __contains__(self, revision):
+        return revision in self.positions
+
+    def __getitem__(self, key):
+        """Revision at an index, or a RevisionSlice view for a slice."""
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self.revisions))
+            if step != 1:
+                raise ValueError("RevisionSequence slices do not support steps")
+            return RevisionSlice(self, start, max(start, stop))
+        return self.revisions[key]
+
+    def __repr__(self):
+        return f"RevisionSequence({list(self.revisions)})"
+
+    def index(self, revision) -> int:
+        """Position of the revision, raises KeyError for unknown revisions."""
+        return self.positions[revision]
+
+    def location(self, revision):
+        """File location of the revision."""
+        return self.locations[self.positions[revision]]
+
+    def head(self):
+        """Latest created revision."""
+        return self.revisions[-1] if self.revisions else None
+
+    def previous(self, revision):
+        """Revision created before the specified one."""
+        position = self.positions.get(revision)
+        if position:
+            return self.revisions[position - 1]
+        return None
+
+    def next(self, revision):
+        """Revision created after the specified one."""
+        position = self.positions.get(revision)
+        if position is not None and position + 1 < len(self.revisions):
+            return self.revisions[position + 1]
+        return None
+
+    def after(self, revision) -> 'RevisionSlice':
+        """Revisions created after the specified one (all of them for unknown revisions)."""
+        return self.between(revision, self.head())
+
+    def between(self, first_revision, last_revision) -> 'RevisionSlice':
+        """Revisions between the boundaries, exclusive of first and inclusive of last,
+        matching LinkedList.get_sublist."""
+        if last_revision not in self.positions:
+            return RevisionSlice(self, 0, 0)
+        stop = self.positions[last_revision] + 1
+        start = self.positions.get(first_revision, -1) + 1
+        if start > stop:
+            start = 0
+        return RevisionSlice(self, start, stop)
+
+
+class RevisionSlice:
+    """View over a contiguous range of a RevisionSequence, sharing its storage."""
+    __slots__ = ("sequence", "start", "stop")
+
+    def __init__(self, sequence: RevisionSequence, start: int, stop: int):
+        self.sequence = sequence
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        revisions = self.sequence.revisions
+        for position in range(self.start, self.stop):
+            yield revisions[position]
+
+    def __reversed__(self):
+        revisions = self.sequence.revisions
+        for position in range(self.stop - 1, self.start - 1, -1):
+            yield revisions[position]
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("RevisionSlice index out of range")
+        return self.sequence.revisions[self.start + index]
+
+    def __eq__(self, other):
+        if isinstance(other, (RevisionSlice, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"RevisionSlice({list(self)})"
+
+    def locations(self):
+        """Iterate over (revision, location) pairs of the view."""
+        sequence = self.sequence
+        for position in range(self.start, self.stop):
+            yield sequence.revisions[position], sequence.locations[position]
+
+
+class SequenceValidation:
+    """Result of validating (revision, down_revision) pairs.
+    For a graph (linear False), forks and multiple heads are allowed."""
+    def __init__(self, linear: bool = True):
+        self.linear = linear
+        self.duplicates = []
+        self.dangling = {}
+        self.heads = []
+        self.tails = []
+        self.forks = {}
+        self.merges = {}
+        self.cycles = []
+
+    @property
+    def is_valid(self) -> bool:
+        """Whether the pairs form exactly one line without cycles."""
+        return not self.errors
+
+    @property
+    def errors(self) -> list:
+        """Human readable description of every problem found."""
+        errors = []
+        if self.cycles:
+            errors.append("Cycle detected in the sequence")
+        if self.duplicates:
+            errors.append(f"Duplicate revisions: {', '.join(self.duplicates)}")
+        for revision, down_revision in self.dangling.items():
+            errors.append(f"Revision {revision} points to missing down_revision {down_revision}")
+        if self.linear:
+            for down_revision, revisions in self.forks.items():
+                errors.append(f"Revisions {', '.join(revisions)} share down_revision {down_revision}")
+            if len(self.heads) > 1:
+                errors.append(f"Multiple heads: {', '.join(self.heads)}")
+            for revision, revision_parents in self.merges.items():
+                errors.append(f"Revision {revision} merges down_revisions {', '.join(revision_parents)}")
+        if len(self.tails) > 1:
+            errors.append(f"Multiple tails: {', '.join(self.tails)}")
+        if not self.tails and not self.cycles and not self.dangling and self.heads:
+            errors.append("No tail revision pointing to None")
+        return errors
+
+    def __repr__(self):
+        return f"SequenceValidation(errors={self.errors})"
+
+
+class SequenceError(RuntimeError):
+    """Raised when the migration pairs do not form a single line."""
+    def __init__(self, validation: SequenceValidation):
+        super().__init__("\n".join(validation.errors))
+        self.validation = validation
+
+
+def validate_sequence(previous_nodes) -> SequenceValidation:
+    """Validate a dictionary, or an iterable of (revision, down_revision) pairs, in O(n).
+    Iterable pairs may contain the same revision more than once, which is reported.
+    down_revisions are read as by `down_revisions`, like is_linear_history and validate_graph do:
+    None and 'None' mark the tail and a 1-tuple names a single down_revision."""
+    validation = SequenceValidation()
+    pairs = previous_nodes.items() if isinstance(previous_nodes, dict) else previous_nodes
+
+    parents = {}
+    for revision, down_revision in pairs:
+        if revision in parents and revision not in validation.duplicates:
+            validation.duplicates.append(revision)
+        revision_parents = down_revisions(down_revision)
+        if len(revision_parents) > 1:
+            validation.merges[revision] = revision_parents
+        # None for the tail, it is not a revision
+        parents[revision] = revision_parents[0] if revision_parents else None
+
+    children = {}
+    for revision, down_revision in parents.items():
+        if down_revision is None:
+            validation.tails.append(revision)
+        elif down_revision not in parents:
+            validation.dangling[revision] = down_revision
+        else:
+            children.setdefault(down_revision, []).append(revision)
+        for parent in validation.merges.get(revision, ())[1:]:
+            if parent not in parents:
+                validation.dangling.setdefault(revision, parent)
+
+    validation.heads = [revision for revision in parents if revision not in children]
+    validation.forks = {revision: nodes for revision, nodes in children.items() if len(nodes) > 1}
+
+    # Every node has a single parent: walk parents once, remembering the walk that visited each node
+    visited_by = {}
+    for start, revision in enumerate(parents):
+        path = []
+        while revision in parents and revision not in visited_by:
+            visited_by[revision] = start
+            path.append(revision)
+            revision = parents[revision]
+        if revision in visited_by and visited_by[revision] == start:
+            validation.cycles.append(path[path.index(revision):])
+
+    return validation
+
+
+def down_revisions(down_revision) -> tuple:
+    """The down_revision of a migration as a tuple, empty for the first migration.
+    Merge revisions list several down_revisions."""
+    if isinstance(down_revision, (list, tuple)):
+        return tuple(str(revision) for revision in down_revision if revision not in (None, 'None'))
+    if down_revision in (None, 'None'):
+        return ()
+    return (str(down_revision),)
+
+
+def is_linear_history(previous_nodes: dict) -> bool:
+    """Whether no revision is a merge and no two revisions share a down_revision."""
+    seen = set()
+    for down_revision in previous_nodes.values():
+        if isinstance(down_revision, (list, tuple)):
+            if len(down_revisions(down_revision)) > 1:
+                return False
+            down_revision = (down_revisions(down_revision) or ('None',))[0]
+        if down_revision in seen:
+            return False
+        seen.add(down_revision)
+    return True
+
+
+def validate_graph(previous_nodes) -> SequenceValidation:
+    """Validate (revision, down_revision(s)) pairs of a DAG: duplicates, missing down_revisions,
+    cycles and more than one first revision are reported, branches and merges are allowed."""
+    validation = SequenceValidation(linear=False)
+    pairs = previous_nodes.items() if isinstance(previous_nodes, dict) else previous_nodes
+
+    parents = {}
+    for revision, down_revision in pairs:
+        if revision in parents and revision not in validation.duplicates:
+            validation.duplicates.append(revision)
+        parents[revision] = down_revisions(down_revision)
+
+    children = {}
+    for revision, revision_parents in parents.items():
+        if not revision_parents:
+            validation.tails.append(revision)
+        for parent in revision_parents:
+            if parent not in parents:
+                validation.dangling[revision] = parent
+            else:
+                children.setdefault(parent, []).append(revision)
+
+    validation.heads = [revision for revision in parents if revision not in children]
+    validation.forks = {revision: nodes for revision, nodes in children.items() if len(nodes) > 1}
+
+    # Revisions left over by a topological sort are on or behind a cycle
+    ordered = topological_order({
+        revision: tuple(parent for parent in revision_parents if parent in parents)
+        for revision, revision_parents in parents.items()
+    })
+    ordered = set(ordered)
+    left = [revision for revision in parents if revision not in ordered]
+    if left:
+        validation.cycles.append(left)
+
+    return validation
+
+
+def topological_order(parents: dict) -> list:
+    """Revisions ordered parents first, ties kept in the order of the dictionary.
+    Revisions on a cycle are left out."""
+    positions = {revision: position for position, revision in enumerate(parents)}
+    waiting = {revision: len(revision_parents) for revision, revision_parents in parents.items()}
+    children = {}
+    for revision, revision_parents in parents.items():
+        for parent in revision_parents:
+            children.setdefault(parent, []).append(revision)
+
+    ready = deque(revision for revision, count in waiting.items() if count == 0)
+    order = []
+    while ready:
+        revision = ready.popleft()
+        order.append(revision)
+        for child in sorted(children.get(revision, ()), key=positions.get):
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                ready.append(child)
+    return order
+
+
+class RevisionGraph:
+    """Immutable DAG of revisions. Merge revisions have several parents (down_revisions),
+    branches share a parent. `order` lists the revisions topologically, parents first."""
+
+    def __init__(self, previous_nodes: dict):
+        """Initialize from a dictionary of revision to down_revision(s).
+        Raises SequenceError when the graph is not valid."""
+        validation = validate_graph(previous_nodes)
+        if not validation.is_valid:
+            raise SequenceError(validation)
+
+        self.parents = {revision: down_revisions(down_revision) for revision, down_revision in previous_nodes.items()}
+        self.children = {revision: [] for revision in self.parents}
+        for revision, revision_parents in self.parents.items():
+            for parent in revision_parents:
+                self.children[parent].append(revision)
+        self.order = tuple(topological_order(self.parents))
+        self.positions = {revision: position for position, revision in enumerate(self.order)}
+
+    def __contains__(self, revision):
+        return revision in self.parents
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __repr__(self):
+        return f"RevisionGraph(heads={self.heads()})"
+
+    def sorted(self, revisions) -> list:
+        """Revisions in topological order."""
+        return sorted(revisions, key=self.positions.__getitem__)
+
+    def heads(self, revisions=None) -> list:
+        """Revisions of the set (all by default) which no other revision of the set depends on."""
+        revisions = set(self.order if revisions is None else revisions)
+        return self.sorted(revision for revision in revisions
+                           if not any(child in revisions for child in self.children[revision]))
+
+    def ancestors(self, revisions) -> set:
+        """The revisions together with every revision they depend on."""
+        found = set()
+        stack = list(revisions)
+        while stack:
+            revision = stack.pop()
+            if revision not in found:
+                found.add(revision)
+                stack.extend(self.parents[revision])
+        return found
+
+    def descendants(self, revisions) -> set:
+        """The revisions together with every revision depending on them."""
+        found = set()
+        stack = list(revisions)
+        while stack:
+            revision = stack.pop()
+            if revision not in found:
+                found.add(revision)
+                stack.extend(self.children[revision])
+        return found
+
+    def upgrade_path(self, applied: set, to_revision: str = None, steps: int = None) -> list:
+        """Unapplied revisions in topological order: all of them, those to_revision depends on,
+        or the first `steps` ones. Every prefix of the path can be applied in order."""
+        pending = [revision for revision in self.order if revision not in applied]
+        if to_revision is not None:
+            required = self.ancestors([to_revision])
+            pending = [revision for revision in pending if revision in required]
+        if steps is not None:
+            pending = pending[:steps]
+        return pending
+
+    def downgrade_path(self, applied: set, to_revision: str = None, steps: int = None) -> list:
+        """Applied revisions to revert, latest first: those depending on to_revision ("base" for all),
+        or the last `steps` ones (one by default). Each is a head once the previous ones are reverted."""
+        reverted = [revision for revision in reversed(self.order) if revision in applied]
+        if to_revision == "base":
+            return reverted
+        if to_revision is not None:
+            depending = self.descendants([to_revision]) - {to_revision}
+            return [revision for revision in reverted if revision in depending]
+        return reverted[:1 if steps is None else steps]
@@ -0,0 +1,208 @@
+"""Bundle Writer
+
+Collects create, update and delete operations and sends them to the FHIR store as
+`batch` or `transaction` Bundles instead of one request per resource. A Bundle is
+flushed once it holds `max_entries` entries or its body would exceed `max_bytes`,
+and on `flush()`/`close()` or when leaving the `with` block:
+
+    from fhir_migrations.writer import BundleWriter
+
+    with BundleWriter(on_result=log_result) as writer:
+        for patient in patients:
+            writer.update(patient, record=patient["id"])
+
+Each operation produces a WriteResult holding the response status of its Bundle
+entry and the caller supplied `record`, passed to `on_result` and returned by `flush()`.
+A Bundle rejected as a whole reports every operation in it as failed.
+
+`open_writer()` returns the writer of the FHIR_WRITER_BACKEND setting: this
+BundleWriter ("bundle") or the $import based ImportWriter ("import",
+see fhir_migrations.bulk_import), which share this API.
+"""
+import json
+import logging
+
+from fhir_migrations.client import get_client
+from fhir_migrations.config import FHIR_WRITER_BACKEND
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_MAX_ENTRIES = 100
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+BUNDLE_TYPES = ("batch", "transaction")
+WRITER_BACKENDS = ("bundle", "import")
+
+
+class WriteResult:
+    """Outcome of a single write operation."""
+
+    def __init__(self, method: str, url: str, record=None, status: str = None,
+                 location: str = None, resource: dict = None, outcome: dict = None):
+        self.method = method
+        self.url = url
+        self.record = record
+        self.status = status
+        self.location = location
+        self.resource = resource
+        self.outcome = outcome
+
+    def __repr__(self):
+        return f"WriteResult({self.method} {self.url}: {self.status})"
+
+    @property
+    def status_code(self) -> int:
+        """Numeric HTTP status of the entry, 0 when unknown."""
+        try:
+            return int(str(self.status).split()[0])
+        except (ValueError, IndexError):
+            return 0
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 300
+
+
+class BundleWriter:
+    """Buffers write operations and sends them as batch or transaction Bundles."""
+
+    def __init__(self, client=None, bundle_type: str = "batch", max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES, on_result=None):
+        if bundle_type not in BUNDLE_TYPES:
+            raise ValueError(f"Invalid bundle type {bundle_type}. Use 'batch' or 'transaction'.")
+
+        self.client = client
+        self.bundle_type = bundle_type
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_result = on_result
+        self.entries = []
+        self.pending = []
+        self.pending_bytes = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not send the buffered operations of a failed block
+        if exc_type is None:
+            self.close()
+        elif self.pending:
+            operations = ", ".join(f"{method} {url}" for method, url, _ in self.pending)
+            logger.warning(f"Discarding {len(self.pending)} buffered operations after {exc_type.__name__}: "
+                           f"{operations}")
+
+    def create(self, resource: dict, record=None, if_none_exist: str = None):
+        """Queue creation of the resource (POST), optionally conditional on a search."""
+        request = {"method": "POST", "url": resource["resourceType"]}
+        if if_none_exist:
+            request["ifNoneExist"] = if_none_exist
+        return self.add({"resource": resource, "request": request}, record)
+
+    def update(self, resource: dict, record=None, if_match: str = None):
+        """Queue update of the resource (PUT), optionally conditional on its version."""
+        request = {"method": "PUT", "url": f"{resource['resourceType']}/{resource['id']}"}
+        if if_match:
+            request["ifMatch"] = if_match
+        return self.add({"resource": resource, "request": request}, record)
+
+    def delete(self, reference: str, record=None):
+        """Queue deletion of the referenced resource, e.g. 'Patient/123'."""
+        return self.add({"request": {"method": "DELETE", "url": reference}}, record)
+
+    def add(self, entry: dict, record=None) -> list:
+        """Queue a Bundle entry. Returns the results of a flush triggered by the thresholds."""
+        serialized = json.dumps(entry, separators=(",", ":"))
+        results = []
+        if self.entries and self.pending_bytes + len(serialized) + 1 > self.max_bytes:
+            results = self.flush()
+
+        self.entries.append(serialized)
+        self.pending.append((entry["request"]["method"], entry["request"]["url"], record))
+        self.pending_bytes += len(serialized) + 1
+
+        if len(self.entries) >= self.max_entries:
+            results.extend(self.flush())
+        return results
+
+    def flush(self) -> list:
+        """Send the queued operations as one Bundle and return their WriteResults.
+        When the Bundle is rejected as a whole, or its response does not hold one entry per
+        operation, every operation is reported as failed. The operations stay queued when
+        the request itself raised, e.g. on a connection error."""
+        if not self.entries:
+            return []
+
+        body = (
+            f'{{"resourceType":"Bundle","type":"{self.bundle_type}","entry":['
+            + ",".join(self.entries)
+            + "]}"
+        )
+        client = self.client or get_client()
+        response = client.post("", data=body)
+
+        pending = self.pending
+        self.entries = []
+        self.pending = []
+        self.pending_bytes = 0
+
+        if response.status_code < 400:
+            entries = response.json().get("entry", [])
+            if len(entries) != len(pending):
+                logger.error(f"Response to the {self.bundle_type} of {len(pending)} entries "
+                             f"holds {len(entries)} entries")
+                entries = [{"response": {"status": "500 Internal Server Error", "outcome": {
+                    "resourceType": "OperationOutcome",
+                    "issue": [{"severity": "error", "code": "exception", "diagnostics":
+                               f"Bundle response holds {len(entries)} entries for {len(pending)} requests"}],
+                }}}] * len(pending)
+        else:
+            # The Bundle was rejected (a transaction rolled back), report the failure for every entry
+            try:
+                outcome = response.json() if response.content else None
+            except ValueError:
+                outcome = None
+            logger.error(f"{self.bundle_type.capitalize()} of {len(pending)} entries failed: {response.status_code}")
+            entries = [{"response": {"status": str(response.status_code), "outcome": outcome}}] * len(pending)
+
+        results = []
+        for (method, url, record), entry in zip(pending, entries):
+            entry_response = entry.get("response", {})
+            result = WriteResult(
+                method, url, record,
+                status=entry_response.get("status"),
+                location=entry_response.get("location"),
+                resource=entry.get("resource"),
+                outcome=entry_response.get("outcome"),
+            )
+            self.report(result)
+            results.append(result)
+
+        return results
+
+    def report(self, result: WriteResult):
+        """Count the result and pass it to the on_result callback."""
+        if result.ok:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+            logger.error(f"{result.method} {result.url} failed: {result.status}")
+        if self.on_result is not None:
+            self.on_result(result)
+
+    def close(self) -> list:
+        """Flush the remaining operations."""
+        return self.flush()
+
+
+def open_writer(backend: str = None, **kwargs) -> BundleWriter:
+    """Create the writer of the backend, FHIR_WRITER_BACKEND by default, with the writer arguments."""
+    backend = backend or FHIR_WRITER_BACKEND
+    if backend not in WRITER_BACKENDS:
+        raise ValueError(f"Invalid writer backend {backend}. Use 'bundle' or 'import'.")
+    if backend == "import":
+        from fhir_migrations.bulk_import import ImportWriter
+        return ImportWriter(**kwargs)
+    return BundleWriter(**kwargs)
@@ -0,0 +1,46 @@
+import asyncio
+import json
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+from fhir_migrations.async_client import AsyncFHIRClient
+
+
+def test_async_client_limits_concurrency():
+    in_flight = 0
+    peak = 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.001)
+        in_flight -= 1
+        return httpx.Response(200, json={"resourceType": "Patient", "id": request.url.path.split("/")[-1]})
+
+    async def run():
+        async with AsyncFHIRClient("http://fhir.example/fhir", concurrency=5,
+                                   transport=httpx.MockTransport(handler)) as client:
+            responses = await asyncio.gather(*(client.get(f"Patient/{i}") for i in range(50)))
+        return [response.json()["id"] for response in responses]
+
+    assert asyncio.run(run()) == [str(i) for i in range(50)]
+    assert peak <= 5
+
+
+def test_async_client_search_follows_next_links():
+    pages = {
+        "/fhir/Patient": {"entry": [{"resource": {"id": "1"}}], "link": [
+            {"relation": "next", "url": "http://fhir.example/fhir?page=2"}]},
+        "/fhir": {"entry": [{"resource": {"id": "2"}}], "link": []},
+    }
+
+    def handler(request):
+        return httpx.Response(200, content=json.dumps(pages[request.url.path]))
+
+    async def run():
+        async with AsyncFHIRClient("http://fhir.example/fhir", transport=httpx.MockTransport(handler)) as client:
+            return [patient["id"] async for patient in client.search("Patient", count=1)]
+
+    assert asyncio.run(run()) == ["1", "2"]
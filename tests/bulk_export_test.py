@@ -0,0 +1,84 @@
+import pytest
+
+from fhir_migrations.bulk_export import BulkExport, BulkExportError, read_ndjson
+from fhir_migrations.client import FHIRClient
+from fhir_migrations.stub_server import StubFHIRServer
+
+
+@pytest.fixture
+def server():
+    with StubFHIRServer(export_polls=2, export_file_size=3) as server:
+        for index in range(7):
+            server.store.write("Patient", {"resourceType": "Patient", "id": f"p{index}"})
+        server.store.write("Observation", {"resourceType": "Observation", "id": "o1"})
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    client = FHIRClient(base_url=server.base_url, retries=0)
+    yield client
+    client.close()
+
+
+def test_export_is_spooled_and_streamed(client, server, tmp_path):
+    export = BulkExport(["Patient"], client=client, spool_dir=str(tmp_path), poll_interval=0.01)
+
+    patients = list(export.resources("Patient"))
+    assert [patient["id"] for patient in patients] == [f"p{index}" for index in range(7)]
+    assert len(export.files()) == 3
+    assert list(export.resources("Observation")) == []
+    # Two polls answered in progress, one completed
+    assert server.request_counts[("GET", 202)] == 3
+    # The job was deleted after the download
+    assert server.jobs == {}
+
+
+def test_spool_is_reused(client, server, tmp_path):
+    first = BulkExport(["Patient", "Observation"], client=client, spool_dir=str(tmp_path), poll_interval=0.01)
+    assert len(list(first.resources())) == 8
+    requests = server.request_count
+
+    second = BulkExport(["Patient", "Observation"], client=client, spool_dir=str(tmp_path), poll_interval=0.01)
+    assert second.directory == first.directory
+    assert [resource["id"] for resource in second.resources("Observation")] == ["o1"]
+    assert second.transaction_time == first.transaction_time
+    assert server.request_count == requests
+
+    other = BulkExport(["Observation"], client=client, spool_dir=str(tmp_path), poll_interval=0.01)
+    assert other.directory != first.directory
+
+    second.clear()
+    assert BulkExport(["Patient", "Observation"], client=client, spool_dir=str(tmp_path)).load_spool() is None
+
+
+def test_spool_per_server(client, server, tmp_path):
+    with StubFHIRServer() as other_server:
+        other_server.store.write("Patient", {"resourceType": "Patient", "id": "other"})
+        other_client = FHIRClient(base_url=other_server.base_url, retries=0)
+        first = BulkExport(["Patient"], client=client, spool_dir=str(tmp_path), poll_interval=0.01)
+        other = BulkExport(["Patient"], client=other_client, spool_dir=str(tmp_path), poll_interval=0.01)
+
+        assert other.directory != first.directory
+        assert len(list(first.resources())) == 7
+        assert [resource["id"] for resource in other.resources()] == ["other"]
+        other_client.close()
+
+
+def test_failed_kick_off(client, server, tmp_path):
+    server.error_rate = 1.0
+    export = BulkExport(["Patient"], level="Group/1", client=client, spool_dir=str(tmp_path))
+    with pytest.raises(BulkExportError) as exc_info:
+        export.run()
+    assert exc_info.value.outcome["resourceType"] == "OperationOutcome"
+    assert export.load_spool() is None
+
+
+def test_read_ndjson(tmp_path):
+    path = tmp_path / "Patient.ndjson"
+    path.write_bytes(b'{"id": "1"}\n\n{"id": "2"}')
+    assert [resource["id"] for resource in read_ndjson(str(path))] == ["1", "2"]
+
+    empty = tmp_path / "empty.ndjson"
+    empty.write_bytes(b"")
+    assert list(read_ndjson(str(empty))) == []
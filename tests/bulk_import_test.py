@@ -0,0 +1,153 @@
+import pytest
+
+from fhir_migrations.bulk_import import ImportWriter
+from fhir_migrations.client import FHIRClient
+from fhir_migrations.dry_run import DryRun
+from fhir_migrations.metrics import MetricsRecorder
+from fhir_migrations.stub_server import StubFHIRServer
+from fhir_migrations.writer import BundleWriter, open_writer
+
+
+@pytest.fixture
+def server():
+    with StubFHIRServer(export_polls=1) as server:
+        server.store.write("Patient", {"resourceType": "Patient", "id": "old"})
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    client = FHIRClient(base_url=server.base_url, retries=0)
+    yield client
+    client.close()
+
+
+def patient(patient_id):
+    return {"resourceType": "Patient", "id": patient_id}
+
+
+def test_import_through_binary(client, server, tmp_path):
+    results = []
+    with ImportWriter(client, on_result=results.append, directory=str(tmp_path), poll_interval=0.01) as writer:
+        for index in range(5):
+            writer.update(patient(f"p{index}"), record=index)
+        writer.create({"resourceType": "Observation", "id": "o1"}, record="o1")
+
+    assert [result.record for result in results] == [0, 1, 2, 3, 4, "o1"]
+    assert all(result.ok for result in results)
+    assert writer.imports == 1
+    assert server.store.read("Patient", "p4")["id"] == "p4"
+    assert server.store.read("Observation", "o1")["id"] == "o1"
+    # One Binary per resource type
+    assert len(server.store.all("Binary")) == 2
+    # The local NDJSON files are removed
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_import_through_upload_url(client, server, tmp_path):
+    with ImportWriter(client, upload_url=server.files_url, max_entries=3, directory=str(tmp_path),
+                      poll_interval=0.01) as writer:
+        for index in range(7):
+            writer.update(patient(f"p{index}"))
+
+    assert writer.imports == 3
+    assert writer.succeeded == 7
+    assert len(server.files) == 3
+    assert server.store.all("Binary") == []
+
+
+def test_uploads_go_through_the_client(client, server, tmp_path):
+    with MetricsRecorder(client) as recorder:
+        recorder.begin_migration("rev1", "upgrade")
+        with ImportWriter(client, upload_url=server.files_url, directory=str(tmp_path), poll_interval=0.01) as writer:
+            writer.update(patient("p1"))
+        recorder.end_migration("rev1", "upgrade")
+
+    assert writer.uploads == 1
+    assert recorder.migrations[0].requests[("PUT", 201)] == 1
+    assert recorder.migrations[0].bytes_sent > 0
+
+
+@pytest.mark.parametrize("upload_to_files", [False, True])
+def test_dry_run_plans_the_import(client, server, tmp_path, upload_to_files):
+    upload_url = server.files_url if upload_to_files else None
+    with DryRun(client) as planner:
+        with ImportWriter(client, upload_url=upload_url, directory=str(tmp_path), poll_interval=0.01) as writer:
+            writer.update(patient("p1"))
+            writer.create({"resourceType": "Observation", "id": "o1"})
+
+    assert writer.succeeded == 2
+    assert (writer.uploads, writer.imports) == (2, 0)
+    upload = ("PUT", "files") if upload_to_files else ("POST", "Binary")
+    assert planner.total.requests[upload] == 2
+    assert planner.total.requests[("POST", "$import")] == 1
+    # Nothing reached the server
+    assert server.files == {}
+    assert server.store.all("Binary") == []
+    assert server.store.all("Observation") == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_missing_imports_are_failed(client, server, tmp_path, monkeypatch):
+    import_file = server.import_file
+    # The server silently drops one resource of every input
+    monkeypatch.setattr(server, "import_file", lambda resource_type, content: (
+        import_file(resource_type, content)[0] - 1, []))
+    with ImportWriter(client, directory=str(tmp_path), poll_interval=0.01) as writer:
+        writer.update(patient("p1"))
+        writer.update(patient("p2"))
+
+    assert (writer.succeeded, writer.failed) == (0, 2)
+
+
+def test_files_are_removed_on_error(client, server, tmp_path):
+    with pytest.raises(RuntimeError):
+        with ImportWriter(client, directory=str(tmp_path), poll_interval=0.01) as writer:
+            writer.update(patient("p1"))
+            raise RuntimeError("migration failed")
+
+    assert list(tmp_path.iterdir()) == []
+    assert writer.imports == 0
+
+
+def test_errors_are_mapped_to_records(client, server, tmp_path):
+    with ImportWriter(client, directory=str(tmp_path), poll_interval=0.01) as writer:
+        writer.update(patient("p1"), record="first")
+        writer.update(patient("bad id"), record="second")
+        writer.update(patient("p3"), record="third")
+        results = writer.flush()
+
+    failed = [result for result in results if not result.ok]
+    assert [result.record for result in failed] == ["second"]
+    assert failed[0].status_code == 400
+    assert failed[0].outcome["issue"][0]["expression"] == ["Patient/bad id"]
+    assert writer.succeeded == 2
+    assert writer.failed == 1
+
+
+def test_deletes_are_sent_in_bundles(client, server, tmp_path):
+    with ImportWriter(client, directory=str(tmp_path), poll_interval=0.01) as writer:
+        writer.update(patient("p1"))
+        writer.delete("Patient/old", record="old")
+        results = writer.flush()
+
+    assert {(result.method, result.ok) for result in results} == {("DELETE", True), ("PUT", True)}
+    assert [resource["id"] for resource in server.store.all("Patient")] == ["p1"]
+    assert server.request_counts[("POST", 200)] == 1
+
+
+def test_conditional_writes_are_rejected(client):
+    writer = ImportWriter(client)
+    with pytest.raises(ValueError):
+        writer.update(patient("p1"), if_match='W/"1"')
+    with pytest.raises(ValueError):
+        writer.create(patient("p1"), if_none_exist="identifier=x")
+
+
+def test_open_writer(client, monkeypatch):
+    assert type(open_writer(client=client)) is BundleWriter
+    assert type(open_writer("import", client=client)) is ImportWriter
+    monkeypatch.setattr("fhir_migrations.writer.FHIR_WRITER_BACKEND", "import")
+    assert type(open_writer(client=client, max_entries=10)) is ImportWriter
+    with pytest.raises(ValueError):
+        open_writer("csv")
@@ -0,0 +1,81 @@
+import json
+import pytest
+from unittest.mock import MagicMock, patch
+
+from fhir_migrations.checkpoint import CHECKPOINT_EXTENSION_URL, Checkpoint, accepts_checkpoint
+from fhir_migrations.migration import Migration
+
+
+def checkpoint_bundle(cursor):
+    resource = {
+        "resourceType": "Basic",
+        "extension": [{"url": CHECKPOINT_EXTENSION_URL, "valueString": json.dumps(cursor)}],
+    }
+    return {"resourceType": "Bundle", "total": 1, "entry": [{"resource": resource}]}
+
+
+@pytest.fixture
+def client():
+    client = MagicMock()
+    with patch("fhir_migrations.checkpoint.get_client", return_value=client):
+        yield client
+
+
+def test_checkpoint_round_trip(client):
+    client.get.return_value.json.return_value = {"resourceType": "Bundle", "total": 0}
+    checkpoint = Checkpoint.load("rev1", "upgrade")
+    assert checkpoint.cursor is None
+
+    client.put.return_value.content = b""
+    checkpoint.save({"page": "http://fhir.example/fhir?page=3"})
+    assert checkpoint.cursor == {"page": "http://fhir.example/fhir?page=3"}
+    assert client.put.call_args[1]["params"]["identifier"].endswith("/upgrade/rev1")
+
+    checkpoint.clear()
+    assert client.delete.call_count == 1
+    assert checkpoint.cursor is None
+
+
+def test_checkpoint_per_target():
+    client = MagicMock()
+    client.get.return_value.json.return_value = {"resourceType": "Bundle", "total": 0}
+    client.put.return_value.content = b""
+    with patch("fhir_migrations.checkpoint.get_client") as get_client:
+        checkpoint = Checkpoint.load("rev1", "upgrade", client, "migration-manager-replica")
+        checkpoint.save(1)
+    assert get_client.call_count == 0
+    assert client.get.call_args[1]["params"]["identifier"].endswith("|migration-manager-replica/upgrade/rev1")
+    assert client.put.call_args[1]["params"] == checkpoint.search_params
+    assert checkpoint.identifier != Checkpoint("rev1", "upgrade").identifier
+
+
+def test_accepts_checkpoint():
+    assert accepts_checkpoint(lambda checkpoint: None)
+    assert accepts_checkpoint(lambda cursor: None)
+    assert accepts_checkpoint(lambda checkpoint=None: None)
+    assert not accepts_checkpoint(lambda: None)
+    assert not accepts_checkpoint(lambda dry_run=False: None)
+    assert not accepts_checkpoint(lambda *args: None)
+
+
+def test_run_migration_resumes_from_checkpoint(client, tmp_path):
+    (tmp_path / "batches.py").write_text(
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "processed = []\n"
+        "def upgrade(checkpoint):\n"
+        "    for batch in range(checkpoint.cursor or 0, 5):\n"
+        "        checkpoint.save(batch + 1)\n"
+        "def downgrade():\n"
+        "    pass\n"
+    )
+    client.get.return_value.json.return_value = checkpoint_bundle(3)
+    client.put.return_value.content = b""
+    migration = Migration(str(tmp_path))
+
+    with patch.object(Migration, "update_latest_applied_migration_in_fhir"):
+        assert migration.run_migration("upgrade", "rev1", "rev1")
+
+    saved = [json.loads(call[1]["data"])["extension"][0]["valueString"] for call in client.put.call_args_list]
+    assert saved == ["4", "5"]
+    assert client.delete.call_count == 1
@@ -0,0 +1,103 @@
+import json
+import pytest
+from unittest.mock import MagicMock, patch
+
+from fhir_migrations import client as client_module
+from fhir_migrations.client import BundleReader, FHIRClient, configure_client, get_client
+
+
+def test_client_url_resolution():
+    client = FHIRClient(base_url="http://fhir.example/fhir/")
+    assert client.url("Patient/1") == "http://fhir.example/fhir/Patient/1"
+    assert client.url("/Basic") == "http://fhir.example/fhir/Basic"
+    assert client.url("https://other.example/Patient") == "https://other.example/Patient"
+
+
+def test_client_pool_configuration():
+    client = FHIRClient(base_url="http://fhir.example/fhir", pool_size=25, retries=0)
+    adapter = client.session.get_adapter("http://fhir.example/fhir")
+    assert adapter._pool_maxsize == 25
+    assert client.session.headers["Content-Type"] == "application/fhir+json"
+
+
+def test_client_default_timeout():
+    client = FHIRClient(base_url="http://fhir.example/fhir", timeout=7)
+    with patch.object(client.session, "request") as request_mock:
+        client.get("Patient", params={"_count": 1})
+        client.put("Patient/1", timeout=3)
+
+    assert request_mock.call_args_list[0][1]["timeout"] == 7
+    assert request_mock.call_args_list[0][0] == ("GET", "http://fhir.example/fhir/Patient")
+    assert request_mock.call_args_list[1][1]["timeout"] == 3
+
+
+def test_configure_client_replaces_shared_client():
+    previous_client = client_module.shared_client
+    try:
+        configured = configure_client(base_url="http://tenant.example/fhir")
+        assert get_client() is configured
+        assert get_client().base_url == "http://tenant.example/fhir"
+    finally:
+        client_module.shared_client = previous_client
+
+
+def bundle_page(ids, next_url=None):
+    bundle = {
+        "resourceType": "Bundle",
+        "entry": [{"resource": {"resourceType": "Patient", "id": id}, "search": {"mode": "match"}} for id in ids],
+        "link": [{"relation": "self", "url": "http://fhir.example/fhir/Patient"}],
+    }
+    if next_url:
+        bundle["link"].append({"relation": "next", "url": next_url})
+    return bundle
+
+
+def test_client_search_follows_next_links():
+    client = FHIRClient(base_url="http://fhir.example/fhir")
+    pages = {
+        "http://fhir.example/fhir/Patient": bundle_page(["1", "2"], "http://fhir.example/fhir?page=2"),
+        "http://fhir.example/fhir?page=2": bundle_page(["3"]),
+    }
+
+    def request(method, url, **kwargs):
+        assert kwargs["stream"]
+        response = MagicMock(status_code=200)
+        response.iter_content.return_value = chunked(json.dumps(pages[url]).encode("utf-8"), 16)
+        return response
+
+    with patch.object(client.session, "request", side_effect=request) as request_mock:
+        results = client.search("Patient", {"active": "true"}, count=2)
+        assert next(results)["id"] == "1"
+        assert request_mock.call_count == 1
+        assert [patient["id"] for patient in results] == ["2", "3"]
+
+    assert request_mock.call_args_list[0][1]["params"] == {"active": "true", "_count": 2}
+    assert request_mock.call_count == 2
+
+
+def chunked(content: bytes, size: int):
+    return [content[start:start + size] for start in range(0, len(content), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 4096])
+def test_bundle_reader_decodes_entries_across_chunks(size):
+    bundle = bundle_page(["1", "Zoë", "3"], "http://fhir.example/fhir?page=2")
+    bundle["total"] = 12345
+    content = json.dumps(bundle, indent=1, ensure_ascii=False).encode("utf-8")
+
+    reader = BundleReader(chunked(content, size))
+    assert [entry["resource"]["id"] for entry in reader] == ["1", "Zoë", "3"]
+    assert reader.members["total"] == 12345
+    assert reader.members["link"] == bundle["link"]
+
+
+def test_bundle_reader_without_entries():
+    reader = BundleReader([b'{"resourceType": "Bundle", "total": 0}'])
+    assert list(reader) == []
+    assert reader.members == {"resourceType": "Bundle", "total": 0}
+
+
+def test_bundle_reader_rejects_truncated_bundles():
+    reader = BundleReader(chunked(json.dumps(bundle_page(["1", "2"])).encode("utf-8")[:-40], 8))
+    with pytest.raises(ValueError):
+        list(reader)
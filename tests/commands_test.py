@@ -0,0 +1,71 @@
+import subprocess
+import sys
+
+IMPORT_SNIPPET = """
+import sys
+from flask import Flask
+from fhir_migrations.commands import migration_blueprint
+Flask('test').register_blueprint(migration_blueprint)
+print('fhir_migrations.migration' in sys.modules, 'requests' in sys.modules)
+"""
+
+
+def test_blueprint_import_is_lazy():
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SNIPPET])
+    assert output.decode().split() == ["False", "False"]
+
+
+def cli_runner(tmp_path, monkeypatch):
+    from flask import Flask
+    from fhir_migrations import commands
+    from fhir_migrations.migration import Migration
+
+    (tmp_path / "first.py").write_text(
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "def upgrade():\n"
+        "    pass\n"
+        "def downgrade():\n"
+        "    pass\n"
+    )
+    monkeypatch.setattr(commands, "migration_manager", Migration(str(tmp_path)))
+    app = Flask("test")
+    app.register_blueprint(commands.migration_blueprint)
+    return app.test_cli_runner()
+
+
+def test_unknown_revision_is_a_bad_parameter(tmp_path, monkeypatch):
+    from unittest.mock import patch
+    from fhir_migrations.migration import Migration
+
+    runner = cli_runner(tmp_path, monkeypatch)
+    with patch.object(Migration, "get_latest_applied_migration_from_fhir", return_value=None):
+        result = runner.invoke(args=["upgrade", "--to", "unknown"])
+    assert result.exit_code == 2
+    assert "Invalid value for --to: Unknown revision unknown" in result.output
+
+
+def test_unusable_steps_are_a_bad_parameter(tmp_path, monkeypatch):
+    from unittest.mock import patch
+    from fhir_migrations.migration import Migration, RevisionPathError
+
+    runner = cli_runner(tmp_path, monkeypatch)
+    with patch.object(Migration, "apply_migrations", side_effect=RevisionPathError("No path")):
+        result = runner.invoke(args=["downgrade", "--steps", "1"])
+    assert result.exit_code == 2
+    assert "Invalid value for --steps: No path" in result.output
+
+
+def test_other_value_errors_are_not_bad_parameters(tmp_path, monkeypatch):
+    import json
+    from unittest.mock import patch
+    from fhir_migrations.migration import Migration
+
+    runner = cli_runner(tmp_path, monkeypatch)
+    # e.g. a state response which is not JSON
+    with patch.object(Migration, "get_latest_applied_migration_from_fhir",
+                      side_effect=json.JSONDecodeError("Expecting value", "<html>", 0)):
+        result = runner.invoke(args=["upgrade", "--to", "rev1"])
+    assert result.exit_code == 1
+    assert isinstance(result.exception, json.JSONDecodeError)
+    assert "Invalid value" not in result.output
@@ -0,0 +1,143 @@
+import gc
+import os
+import sys
+import weakref
+import pytest
+from unittest.mock import patch
+
+from fhir_migrations import discovery
+from fhir_migrations.discovery import (
+    load_manifest,
+    load_migration_module,
+    parse_migration_source,
+    read_migration_file,
+    scan_migrations,
+    write_manifest,
+)
+
+MIGRATION_SOURCE = """
+import module_that_does_not_exist
+
+revision = 'rev2'
+down_revision = 'rev1'
+
+raise RuntimeError("migration executed during discovery")
+
+def upgrade():
+    pass
+
+def downgrade():
+    pass
+"""
+
+
+def test_parse_migration_source():
+    parsed = parse_migration_source(MIGRATION_SOURCE)
+    assert parsed["variables"] == {"revision": "rev2", "down_revision": "rev1"}
+    assert parsed["functions"] == {"upgrade", "downgrade"}
+    assert not parsed["dynamic"]
+
+
+def test_read_migration_file_does_not_execute(tmp_path):
+    migration_path = tmp_path / "migration.py"
+    migration_path.write_text(MIGRATION_SOURCE)
+    assert read_migration_file(str(migration_path)) == ("rev2", "rev1")
+
+
+def test_read_migration_file_dynamic_revision(tmp_path):
+    migration_path = tmp_path / "migration.py"
+    migration_path.write_text(
+        "revision = 'rev' + str(2)\n"
+        "down_revision = 'None'\n"
+        "def upgrade(): pass\n"
+        "def downgrade(): pass\n"
+    )
+    assert read_migration_file(str(migration_path)) == ("rev2", "None")
+
+
+def test_read_migration_file_missing_downgrade(tmp_path):
+    migration_path = tmp_path / "migration.py"
+    migration_path.write_text(
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "def upgrade(): pass\n"
+    )
+    with pytest.raises(RuntimeError) as exc_info:
+        read_migration_file(str(migration_path))
+    assert str(exc_info.value) == "Migration 'migration.py' is missing 'downgrade' method."
+
+
+def write_migration(directory, name, revision, down_revision):
+    migration_path = directory / f"{name}.py"
+    migration_path.write_text(
+        f"revision = '{revision}'\n"
+        f"down_revision = '{down_revision}'\n"
+        "def upgrade(): pass\n"
+        "def downgrade(): pass\n"
+    )
+    return migration_path
+
+
+def test_manifest_round_trip(tmp_path):
+    write_migration(tmp_path, "first", "rev1", "None")
+    write_migration(tmp_path, "second", "rev2", "rev1")
+    entries = scan_migrations(str(tmp_path))
+    write_manifest(str(tmp_path), entries)
+
+    manifest = load_manifest(str(tmp_path))
+    assert "sequence" not in manifest
+    assert manifest["migrations"]["second.py"]["down_revision"] == "rev1"
+
+
+def test_scan_migrations_reparses_changed_files_only(tmp_path):
+    write_migration(tmp_path, "first", "rev1", "None")
+    second = write_migration(tmp_path, "second", "rev2", "rev1")
+    manifest = {"migrations": scan_migrations(str(tmp_path))}
+
+    write_migration(tmp_path, "second", "rev3", "rev1")
+    os.utime(second, ns=(0, 0))
+    with patch.object(discovery, "read_migration_file", wraps=read_migration_file) as read_mock:
+        entries = scan_migrations(str(tmp_path), manifest)
+
+    read_mock.assert_called_once_with(str(second))
+    assert entries["second.py"]["revision"] == "rev3"
+    assert entries["first.py"]["revision"] == "rev1"
+
+
+def test_load_migration_module_is_released(tmp_path):
+    migration_path = write_migration(tmp_path, "first", "rev1", "None")
+    with migration_path.open("a") as migration_file:
+        migration_file.write(
+            "class Mapping(dict):\n"
+            "    pass\n"
+            "mapping = Mapping(('key-%d' % i, i) for i in range(1000))\n"
+            "def count(): return len(mapping)\n"
+        )
+    gc_enabled = gc.isenabled()
+    # The globals have to be freed without waiting for a collection
+    gc.disable()
+    try:
+        with load_migration_module(str(migration_path)) as migration_module:
+            module_name = migration_module.__name__
+            assert sys.modules[module_name] is migration_module
+            module_reference = weakref.ref(migration_module)
+            mapping_reference = weakref.ref(migration_module.mapping)
+            assert migration_module.revision == "rev1"
+            assert migration_module.count() == 1000
+        del migration_module
+
+        assert module_name not in sys.modules
+        assert module_reference() is None
+        assert mapping_reference() is None
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def test_load_migration_module_isolates_namespaces(tmp_path):
+    first_path = write_migration(tmp_path, "first", "rev1", "None")
+    second_path = write_migration(tmp_path, "second", "rev2", "rev1")
+    with load_migration_module(str(first_path)) as first, \
+            load_migration_module(str(second_path)) as second:
+        assert first.__name__ != second.__name__
+        assert (first.revision, second.revision) == ("rev1", "rev2")
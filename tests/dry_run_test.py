@@ -0,0 +1,145 @@
+import json
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from fhir_migrations import client as client_module
+from fhir_migrations.client import FHIRClient, configure_client
+from fhir_migrations.dry_run import DryRun, LatencyModel
+from fhir_migrations.migration import Migration
+from fhir_migrations.writer import BundleWriter
+
+
+class ReadOnlyAdapter(BaseAdapter):
+    """Answers reads with an empty search Bundle, fails on anything else."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request.method)
+        assert request.method == "GET"
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({"resourceType": "Bundle", "total": 0}).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def client():
+    previous_client = client_module.shared_client
+    client = configure_client(base_url="http://fhir.example/fhir")
+    adapter = ReadOnlyAdapter()
+    client.session.mount("http://", adapter)
+    client.adapter = adapter
+    yield client
+    client_module.shared_client = previous_client
+
+
+def test_dry_run_records_writes(client):
+    with DryRun(client, LatencyModel({"PUT": 0.5}, default=0.1)) as planner:
+        planner.begin_migration("rev1", "upgrade", "first")
+        response = client.put("Patient/1", data=json.dumps({"resourceType": "Patient", "id": "1"}))
+        assert response.json()["id"] == "1"
+        client.get("Patient", params={"identifier": "a|b"})
+        with BundleWriter(client) as writer:
+            writer.update({"resourceType": "Patient", "id": "2"})
+            writer.delete("Observation/3")
+        planner.end_migration("rev1", "upgrade")
+
+    plan = planner.plans[0]
+    assert client.adapter.sent == ["GET"]
+    assert plan.requests == {("PUT", "Patient"): 1, ("GET", "Patient"): 1, ("POST", "Bundle"): 1}
+    assert plan.entries == {("PUT", "Patient"): 1, ("DELETE", "Observation"): 1}
+    assert plan.estimated_seconds == pytest.approx(0.7)
+    assert plan.bytes_sent > 0
+    assert client.session.get_adapter("http://fhir.example") is client.adapter
+
+
+def test_run_migrations_dry_run(client, tmp_path):
+    (tmp_path / "create.py").write_text(
+        "from fhir_migrations.client import get_client\n"
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "def upgrade():\n"
+        "    for id in range(3):\n"
+        "        get_client().put(f'Patient/{id}', json={'resourceType': 'Patient', 'id': str(id)})\n"
+        "def downgrade():\n"
+        "    pass\n"
+    )
+    planner = Migration(str(tmp_path)).run_migrations("upgrade", dry_run=True)
+
+    assert [plan.revision for plan in planner.plans] == ["rev1"]
+    assert planner.plans[0].requests[("PUT", "Patient")] == 3
+    # State is created and updated without reaching the server
+    assert planner.plans[0].requests[("PUT", "Basic")] == 2
+    assert set(client.adapter.sent) == {"GET"}
+
+
+def test_dry_run_intercepts_the_migration_client(client, tmp_path):
+    (tmp_path / "noop.py").write_text(
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "def upgrade():\n"
+        "    pass\n"
+        "def downgrade():\n"
+        "    pass\n"
+    )
+    state_client = FHIRClient(base_url="http://fhir.example/fhir", retries=0)
+    state_adapter = ReadOnlyAdapter()
+    state_client.session.mount("http://", state_adapter)
+
+    planner = Migration(str(tmp_path), client=state_client).run_migrations("upgrade", dry_run=True)
+
+    # The state is read, its creation and update are planned without reaching the server
+    assert set(state_adapter.sent) == {"GET"}
+    assert planner.plans[0].requests[("PUT", "Basic")] == 2
+    assert state_client.session.get_adapter("http://fhir.example") is state_adapter
+
+
+def test_dry_run_intercepts_async_clients(client, tmp_path, monkeypatch):
+    httpx = pytest.importorskip("httpx")
+    helpers = tmp_path / "helpers"
+    helpers.mkdir()
+    (helpers / "async_transport.py").write_text(
+        "import httpx\n"
+        "sent = []\n"
+        "def handle(request):\n"
+        "    sent.append(request.method)\n"
+        "    return httpx.Response(200, json={'resourceType': 'Bundle', 'entry': []})\n"
+        "transport = httpx.MockTransport(handle)\n"
+    )
+    monkeypatch.syspath_prepend(str(helpers))
+    migrations = tmp_path / "migrations"
+    migrations.mkdir()
+    (migrations / "create.py").write_text(
+        "import asyncio\n"
+        "import async_transport\n"
+        "from fhir_migrations.async_client import AsyncFHIRClient\n"
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "async def upgrade():\n"
+        "    async with AsyncFHIRClient('http://fhir.example/fhir', transport=async_transport.transport) as fhir:\n"
+        "        assert [patient async for patient in fhir.search('Patient')] == []\n"
+        "        responses = await asyncio.gather(*(\n"
+        "            fhir.put(f'Patient/{id}', json={'resourceType': 'Patient', 'id': str(id)}) for id in range(3)))\n"
+        "        assert [response.json()['id'] for response in responses] == ['0', '1', '2']\n"
+        "        assert (await fhir.delete('Patient/0')).status_code == 204\n"
+        "async def downgrade():\n"
+        "    pass\n"
+    )
+
+    planner = Migration(str(migrations)).run_migrations("upgrade", dry_run=True)
+
+    import async_transport
+    # Only the search reached the transport
+    assert async_transport.sent == ["GET"]
+    plan = planner.plans[0]
+    assert plan.error is None
+    assert plan.requests[("PUT", "Patient")] == 3
+    assert plan.requests[("DELETE", "Patient")] == 1
+    assert plan.requests[("GET", "Patient")] == 1
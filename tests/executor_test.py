@@ -0,0 +1,54 @@
+import threading
+import time
+import pytest
+
+from fhir_migrations.executor import FatalItemError, MigrationExecutionError, run_concurrently
+
+
+def test_run_concurrently_processes_all_items():
+    processed = []
+    lock = threading.Lock()
+
+    def process(item):
+        with lock:
+            processed.append(item)
+
+    report = run_concurrently(range(50), process, max_workers=4)
+    assert sorted(processed) == list(range(50))
+    assert report.completed == 50
+    assert not report.errors
+
+
+def test_run_concurrently_collects_errors_in_order():
+    def process(item):
+        time.sleep(0.001 * (10 - item))
+        if item % 3 == 0:
+            raise ValueError(f"item {item}")
+
+    with pytest.raises(MigrationExecutionError) as exc_info:
+        run_concurrently(range(10), process, max_workers=5)
+    assert [error.index for error in exc_info.value.errors] == [0, 3, 6, 9]
+    assert not exc_info.value.cancelled
+
+    report = run_concurrently(range(10), process, max_workers=5, raise_errors=False)
+    assert report.completed == 6
+
+
+def test_run_concurrently_cancels_on_fatal_error():
+    consumed = []
+
+    def items():
+        for item in range(1000):
+            consumed.append(item)
+            yield item
+
+    def process(item):
+        if item == 2:
+            raise FatalItemError("duplicate patient")
+        time.sleep(0.001)
+
+    with pytest.raises(MigrationExecutionError) as exc_info:
+        run_concurrently(items(), process, max_workers=2)
+    assert exc_info.value.cancelled
+    assert isinstance(exc_info.value.errors[0].exception, FatalItemError)
+    assert len(consumed) < 1000
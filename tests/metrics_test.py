@@ -0,0 +1,94 @@
+import json
+import os
+import pytest
+from flask import Flask
+
+from fhir_migrations import client as client_module
+from fhir_migrations import commands
+from fhir_migrations.client import configure_client
+from fhir_migrations.metrics import MetricsRecorder, format_prometheus
+from fhir_migrations.migration import Migration
+from fhir_migrations.stub_server import StubFHIRServer
+
+MIGRATIONS = {
+    "create.py": (
+        "import json\n"
+        "from fhir_migrations.client import get_client\n"
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "def upgrade():\n"
+        "    get_client().put('Patient/example', data=json.dumps({'resourceType': 'Patient', 'id': 'example'}))\n"
+        "    get_client().get('Patient/example')\n"
+        "def downgrade():\n"
+        "    pass\n"
+    ),
+    "broken.py": (
+        "from fhir_migrations.client import get_client\n"
+        "revision = 'rev2'\n"
+        "down_revision = 'rev1'\n"
+        "def upgrade():\n"
+        "    get_client().get('Patient/missing').raise_for_status()\n"
+        "def downgrade():\n"
+        "    pass\n"
+    ),
+}
+
+
+@pytest.fixture
+def server():
+    with StubFHIRServer() as server:
+        previous_client = client_module.shared_client
+        configure_client(base_url=server.base_url, retries=0)
+        yield server
+        client_module.shared_client.close()
+        client_module.shared_client = previous_client
+
+
+@pytest.fixture
+def migrations_dir(tmp_path):
+    for file_name, source in MIGRATIONS.items():
+        with open(os.path.join(tmp_path, file_name), "w") as migration_file:
+            migration_file.write(source)
+    return str(tmp_path)
+
+
+def test_metrics_per_migration(server, migrations_dir):
+    migration = Migration(migrations_dir)
+    with MetricsRecorder() as recorder:
+        migration.observers.append(recorder)
+        migration.apply_migrations("upgrade")
+
+    first, second = recorder.migrations
+    assert first.revision == "rev1"
+    assert first.error is None
+    # The migration requests and the state update are accounted to the migration
+    assert first.requests[("PUT", 201)] == 2
+    assert first.requests[("GET", 200)] == 1
+    assert first.bytes_received > 0
+    assert 0 < first.fhir_seconds <= first.wall_seconds
+    assert second.error == "404 Client Error: Not Found for url: " + f"{server.base_url}/Patient/missing"
+    assert recorder.overhead.requests[("GET", 200)] == 1
+    assert recorder.run.wall_seconds >= first.wall_seconds + second.wall_seconds
+
+    report = format_prometheus(recorder)
+    assert 'fhir_migration_succeeded{revision="rev2",direction="upgrade",location="broken"} 0' in report
+    assert ('fhir_migration_http_requests_total{revision="rev1",direction="upgrade",location="create",'
+            'method="GET",status="200"} 1') in report
+
+
+def test_upgrade_metrics_out(server, migrations_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(commands, "migration_manager", Migration(migrations_dir))
+    app = Flask(__name__)
+    app.register_blueprint(commands.migration_blueprint)
+    metrics_path = os.path.join(tmp_path, "metrics.json")
+
+    result = app.test_cli_runner().invoke(args=["upgrade", "--metrics-out", metrics_path])
+    assert result.exit_code == 0
+
+    with open(metrics_path) as metrics_file:
+        report = json.load(metrics_file)
+    assert [migration["succeeded"] for migration in report["migrations"]] == [True, False]
+    assert report["wall_seconds"] > 0
+    # The shared client is restored
+    assert not any(type(adapter).__name__ == "MetricsAdapter"
+                   for adapter in client_module.shared_client.session.adapters.values())
@@ -1,7 +1,16 @@
 import pytest
 from pytest import fixture
 
-from fhir_migrations.utils import Node, LinkedList
+from fhir_migrations.utils import (
+    Node,
+    LinkedList,
+    RevisionGraph,
+    RevisionSequence,
+    SequenceError,
+    is_linear_history,
+    validate_graph,
+    validate_sequence,
+)
 
 @fixture
 def linked_list():
@@ -74,6 +83,27 @@ def test_linked_list_get_sublist(linked_list):
     assert sublist == ["node3", "node4", "node5"]
 
 
+def test_linked_list_get_bounded_sublist(linked_list):
+    sublist = linked_list.get_sublist("node1", "node3")
+    assert sublist == ["node2", "node3"]
+
+
+def test_linked_list_contains(linked_list):
+    assert "node3" in linked_list
+    assert "node6" not in linked_list
+    assert len(linked_list) == 5
+
+
+def test_linked_list_distance(linked_list):
+    assert linked_list.distance("node2", "node5") == 3
+    assert linked_list.distance("node5", "node2") == -3
+
+
+def test_linked_list_add_duplicate(linked_list):
+    with pytest.raises(ValueError):
+        linked_list.add("node3")
+
+
 def test_linked_list_add(linked_list):
     linked_list.add("node6")
     assert linked_list.head.data == "node6"
@@ -90,6 +120,8 @@ def test_linked_list_build_list_from_dictionary():
     ll = LinkedList()
     ll.build_list_from_dictionary(previous_nodes)
     assert ll.head.data == "node5"
+    assert ll.next("node2") == "node3"
+    assert ll.distance("node1", "node5") == 4
 
 
 def test_check_consistency_valid(linked_list):
@@ -156,3 +188,118 @@ def test_check_dictionary_consistency_inconsistent_next(linked_list, nodes_refer
     with pytest.raises(RuntimeError) as exc_info:
         linked_list.check_dictionary_consistency(nodes_references)
     assert str(exc_info.value) == "Consistency error: node references are not consistent"
+
+
+def test_validate_sequence_valid():
+    validation = validate_sequence({"node1": "None", "node2": "node1", "node3": "node2"})
+    assert validation.is_valid
+    assert validation.heads == ["node3"]
+    assert validation.tails == ["node1"]
+
+
+def test_validate_sequence_normalizes_down_revisions():
+    nodes = {"node1": None, "node2": ("node1",), "node3": ["node2"]}
+    assert is_linear_history(nodes)
+    validation = validate_sequence(nodes)
+    assert validation.is_valid
+    assert (validation.tails, validation.heads, validation.dangling) == (["node1"], ["node3"], {})
+
+    linked_list = LinkedList()
+    linked_list.build_list_from_dictionary(nodes)
+    assert linked_list.head.data == "node3"
+
+    validation = validate_sequence({"node1": "None", "node2": "node1", "node3": ("node1", "node2")})
+    assert validation.merges == {"node3": ("node1", "node2")}
+    assert "Revision node3 merges down_revisions node1, node2" in validation.errors
+
+
+def test_validate_sequence_reports_all_errors():
+    validation = validate_sequence([
+        ("node1", "None"),
+        ("node2", "node1"),
+        ("node3", "node1"),
+        ("node3", "node1"),
+        ("node4", "missing"),
+        ("node5", "node6"),
+        ("node6", "node5"),
+        ("node7", "None"),
+    ])
+    assert not validation.is_valid
+    assert validation.duplicates == ["node3"]
+    assert validation.dangling == {"node4": "missing"}
+    assert validation.forks == {"node1": ["node2", "node3"]}
+    assert validation.heads == ["node2", "node3", "node4", "node7"]
+    assert validation.tails == ["node1", "node7"]
+    assert validation.cycles == [["node5", "node6"]]
+    assert len(validation.errors) == 6
+
+
+def test_build_list_from_dictionary_fork():
+    previous_nodes = {"node1": "None", "node2": "node1", "node3": "node1"}
+    with pytest.raises(SequenceError) as exc_info:
+        LinkedList().build_list_from_dictionary(previous_nodes)
+    assert exc_info.value.validation.heads == ["node2", "node3"]
+
+
+def test_revision_sequence_from_linked_list(linked_list):
+    sequence = RevisionSequence.from_linked_list(linked_list, {"node2": "second"})
+    assert list(sequence) == ["node1", "node2", "node3", "node4", "node5"]
+    assert sequence.location("node2") == "second"
+    assert sequence.previous("node1") is None
+    assert sequence.next("node3") == "node4"
+    with pytest.raises(AttributeError):
+        sequence.revisions = ()
+
+
+def test_revision_sequence_slices(linked_list):
+    sequence = RevisionSequence.from_linked_list(linked_list)
+    assert sequence.after("node2") == linked_list.get_sublist("node2")
+    assert sequence.after(None) == linked_list.get_sublist(None)
+    assert len(sequence.after("node5")) == 0
+    assert sequence.between("node1", "node3") == ["node2", "node3"]
+    assert list(reversed(sequence.between("node1", "node3"))) == ["node3", "node2"]
+    assert sequence.between("node1", "node3").sequence is sequence
+
+
+@fixture
+def revision_graph():
+    return RevisionGraph({
+        "node1": "None",
+        "node2": "node1",
+        "node3": "node1",
+        "node4": "node2",
+        "node5": ("node4", "node3"),
+    })
+
+
+def test_revision_graph(revision_graph):
+    assert list(revision_graph) == ["node1", "node2", "node3", "node4", "node5"]
+    assert revision_graph.heads() == ["node5"]
+    assert revision_graph.heads({"node1", "node2", "node3"}) == ["node2", "node3"]
+    assert revision_graph.ancestors(["node4"]) == {"node1", "node2", "node4"}
+    assert revision_graph.descendants(["node3"]) == {"node3", "node5"}
+
+
+def test_revision_graph_paths(revision_graph):
+    applied = {"node1", "node2"}
+    assert revision_graph.upgrade_path(applied) == ["node3", "node4", "node5"]
+    assert revision_graph.upgrade_path(applied, to_revision="node3") == ["node3"]
+    assert revision_graph.upgrade_path(applied, steps=2) == ["node3", "node4"]
+
+    applied = set(revision_graph)
+    assert revision_graph.downgrade_path(applied) == ["node5"]
+    assert revision_graph.downgrade_path(applied, to_revision="node2") == ["node5", "node4"]
+    assert revision_graph.downgrade_path(applied, to_revision="base") == ["node5", "node4", "node3", "node2", "node1"]
+
+
+def test_validate_graph():
+    assert is_linear_history({"node1": "None", "node2": "node1"})
+    assert not is_linear_history({"node1": "None", "node2": "node1", "node3": "node1"})
+    assert validate_graph({"node1": "None", "node2": "node1", "node3": "node1"}).is_valid
+
+    validation = validate_graph({"node1": "None", "node2": ("node1", "missing"), "node3": "node4", "node4": "node3"})
+    assert not validation.is_valid
+    assert validation.dangling == {"node2": "missing"}
+    assert validation.cycles == [["node3", "node4"]]
+    with pytest.raises(SequenceError):
+        RevisionGraph({"node1": "None", "node2": "node3", "node3": "node2"})
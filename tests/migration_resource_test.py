@@ -0,0 +1,65 @@
+import json
+import pytest
+from unittest.mock import MagicMock, patch
+
+from fhir_migrations import migration_resource
+from fhir_migrations.config import FHIR_URL
+from fhir_migrations.migration_resource import ConcurrentMigrationError, MigrationState
+
+
+def basic_resource(code, version):
+    return {
+        "resourceType": "Basic",
+        "id": "state",
+        "meta": {"versionId": version},
+        "identifier": [{"system": "http://fhir.migration.system", "value": "state"}],
+        "code": {"coding": [{"system": "http://our.migration.system", "code": code}]},
+    }
+
+
+def json_response(status_code, body):
+    response = MagicMock(status_code=status_code)
+    response.json.return_value = body
+    return response
+
+
+@pytest.fixture
+def client():
+    client = MagicMock()
+    with patch("fhir_migrations.migration_resource.get_client", return_value=client):
+        yield client
+
+
+def test_state_is_fetched_once(client):
+    client.get.return_value = json_response(200, {
+        "resourceType": "Bundle", "total": 1, "entry": [{"resource": basic_resource("rev1", "1")}]
+    })
+    client.put.side_effect = lambda path, **kwargs: json_response(
+        200, dict(json.loads(kwargs["data"]), meta={"versionId": str(int(kwargs["headers"]["If-Match"][3:-1]) + 1)})
+    )
+
+    state = MigrationState.load()
+    assert state.get_latest_migration() == "rev1"
+    state.update("rev2")
+    state.update("rev3")
+
+    assert client.get.call_count == 1
+    if_match = [call[1]["headers"]["If-Match"] for call in client.put.call_args_list]
+    assert if_match == ['W/"1"', 'W/"2"']
+    assert client.put.call_args_list[0][0] == ("Basic/state",)
+    assert state.get_latest_migration() == "rev3"
+
+
+def test_state_detects_concurrent_update(client):
+    state = MigrationState(None)
+    client.put.side_effect = [
+        json_response(201, basic_resource("updated-code", "1")),
+        json_response(412, {}),
+    ]
+
+    with pytest.raises(ConcurrentMigrationError):
+        state.update("rev1")
+
+
+def test_fhir_url_alias():
+    assert migration_resource.fhir_url == FHIR_URL
@@ -1,8 +1,10 @@
+import os
 import pytest
 from unittest.mock import patch, mock_open
 from pytest import fixture
 
 from fhir_migrations.migration import Migration
+from fhir_migrations.migration_resource import ConcurrentMigrationError
 
 @fixture
 def migration_instance():
@@ -31,10 +33,11 @@ def test_build_migration_sequence_with_dependencies(migration_instance, mock_get
             'migration1': 'None'
         }.get
         migration_instance.build_migration_sequence()
-        assert migration_instance.migration_sequence.head.data == 'migration3'
-        assert migration_instance.migration_sequence.head.prev_node.data == 'migration2'
-        assert migration_instance.migration_sequence.head.prev_node.prev_node.data == 'migration1'
-        assert migration_instance.migration_sequence.head.prev_node.prev_node.prev_node is None
+        assert migration_instance.get_latest_created_migration() == 'migration3'
+        assert migration_instance.get_previous_migration('migration3') == 'migration2'
+        assert migration_instance.get_previous_migration('migration2') == 'migration1'
+        assert migration_instance.get_previous_migration('migration1') is None
+        assert list(migration_instance.revision_sequence) == ['migration1', 'migration2', 'migration3']
 
 def test_get_previous_migration_id_nonexistent_file(migration_instance):
     migration = "nonexistent_migration"
@@ -82,3 +85,162 @@ def test_get_previous_migration_id_empty(migration_instance):
 
     # Perform assertion
     assert prev_migration_id is None
+
+def test_run_migration_async_upgrade(tmp_path):
+    marker = tmp_path / "upgraded"
+    (tmp_path / "async_migration.py").write_text(
+        "import asyncio\n"
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "async def upgrade():\n"
+        "    await asyncio.sleep(0)\n"
+        f"    open({str(marker)!r}, 'w').close()\n"
+        "async def downgrade():\n"
+        "    pass\n"
+    )
+    migration = Migration(str(tmp_path))
+    with patch.object(Migration, 'update_latest_applied_migration_in_fhir') as update_mock:
+        assert migration.run_migration("upgrade", "rev1", "rev1")
+
+    assert marker.exists()
+    update_mock.assert_called_once_with("rev1", False)
+
+
+@fixture
+def linear_migrations(tmp_path):
+    log = tmp_path / "log.txt"
+    migrations_dir = tmp_path / "migrations"
+    migrations_dir.mkdir()
+    previous = "None"
+    for index in range(1, 5):
+        (migrations_dir / f"step{index}.py").write_text(
+            f"revision = 'rev{index}'\n"
+            f"down_revision = '{previous}'\n"
+            "def upgrade():\n"
+            f"    with open({str(log)!r}, 'a') as log_file:\n"
+            f"        log_file.write('up{index} ')\n"
+            "def downgrade():\n"
+            f"    with open({str(log)!r}, 'a') as log_file:\n"
+            f"        log_file.write('down{index} ')\n"
+        )
+        previous = f"rev{index}"
+    return str(migrations_dir), log
+
+
+def test_resolve_path(linear_migrations):
+    migration = Migration(linear_migrations[0])
+
+    assert migration.resolve_path("upgrade", None) == [(f"rev{i}", f"rev{i}") for i in range(1, 5)]
+    assert migration.resolve_path("upgrade", "rev1", to_revision="rev3") == [("rev2", "rev2"), ("rev3", "rev3")]
+    assert migration.resolve_path("upgrade", "rev1", steps=1) == [("rev2", "rev2")]
+    assert migration.resolve_path("upgrade", "rev3", steps=5) == [("rev4", "rev4")]
+    assert migration.resolve_path("upgrade", "rev4") == []
+
+    assert migration.resolve_path("downgrade", "rev4") == [("rev4", "rev3")]
+    assert migration.resolve_path("downgrade", "rev4", to_revision="rev2") == [("rev4", "rev3"), ("rev3", "rev2")]
+    assert migration.resolve_path("downgrade", "rev2", steps=3) == [("rev2", "rev1"), ("rev1", None)]
+    assert migration.resolve_path("downgrade", "rev2", to_revision="base") == [("rev2", "rev1"), ("rev1", None)]
+    assert migration.resolve_path("downgrade", None) == []
+
+    with pytest.raises(ValueError):
+        migration.resolve_path("upgrade", "rev3", to_revision="rev1")
+    with pytest.raises(ValueError):
+        migration.resolve_path("downgrade", "rev1", to_revision="rev3")
+    with pytest.raises(ValueError):
+        migration.resolve_path("upgrade", None, to_revision="unknown")
+    with pytest.raises(ValueError):
+        migration.resolve_path("upgrade", None, to_revision="rev2", steps=1)
+
+
+def test_run_migrations_to_revision(linear_migrations):
+    migrations_dir, log = linear_migrations
+    migration = Migration(migrations_dir)
+    state = {"current": None, "writes": []}
+
+    def update(revision, sharded=False):
+        state["current"] = revision
+        state["writes"].append(revision)
+
+    with patch.object(Migration, 'get_latest_applied_migration_from_fhir', side_effect=lambda: state["current"]), \
+            patch.object(Migration, 'update_latest_applied_migration_in_fhir', side_effect=update):
+        migration.run_migrations("upgrade", to_revision="rev3")
+        migration.run_migrations("downgrade", steps=2)
+        migration.run_migrations("upgrade", steps=1)
+        migration.run_migrations("downgrade", to_revision="base")
+
+    assert log.read_text().split() == ["up1", "up2", "up3", "down3", "down2", "up2", "down2", "down1"]
+    # The state is written after every step
+    assert state["writes"] == ["rev1", "rev2", "rev3", "rev2", "rev1", "rev2", "rev1", None]
+
+
+@fixture
+def branched_migrations(tmp_path):
+    log = tmp_path / "log.txt"
+    migrations_dir = tmp_path / "migrations"
+    migrations_dir.mkdir()
+    migrations = {
+        "base": ("None", "pass"),
+        "left": ("'base'", "raise RuntimeError('left failed')"),
+        "left2": ("'left'", "pass"),
+        "right": ("'base'", "pass"),
+        "merge": ("('left2', 'right')", "pass"),
+    }
+    for name, (down_revision, body) in migrations.items():
+        (migrations_dir / f"{name}.py").write_text(
+            "import time\n"
+            f"revision = '{name}'\n"
+            f"down_revision = {down_revision}\n"
+            "def upgrade():\n"
+            f"    with open({str(log)!r}, 'a') as log_file:\n"
+            f"        log_file.write('up-{name} ')\n"
+            f"    {body}\n"
+            "def downgrade():\n"
+            f"    with open({str(log)!r}, 'a') as log_file:\n"
+            f"        log_file.write('down-{name} ')\n"
+        )
+    return str(migrations_dir), log
+
+
+def test_upgrade_graph_skips_dependents_of_failed_migration(branched_migrations):
+    migrations_dir, log = branched_migrations
+    migration = Migration(migrations_dir)
+    state = {"heads": []}
+
+    def update(heads, sharded=False):
+        state["heads"] = list(heads)
+
+    with patch.object(Migration, 'get_applied_heads_from_fhir', side_effect=lambda: state["heads"]), \
+            patch.object(Migration, 'update_latest_applied_migration_in_fhir', side_effect=update):
+        migration.run_migrations("upgrade")
+        assert state["heads"] == ["right"]
+
+        migration.run_migrations("downgrade", steps=2)
+        assert state["heads"] == []
+
+    assert sorted(log.read_text().split()[:3]) == ["up-base", "up-left", "up-right"]
+    assert log.read_text().split()[3:] == ["down-right", "down-base"]
+
+
+def test_upgrade_graph_records_running_migrations_after_conflict(branched_migrations):
+    migrations_dir, log = branched_migrations
+    migration = Migration(migrations_dir)
+    state = {"heads": ["base", "left"], "writes": []}
+
+    def update(heads, sharded=False):
+        state["writes"].append(list(heads))
+        if len(state["writes"]) == 1:
+            raise ConcurrentMigrationError("changed by another runner")
+        state["heads"] = list(heads)
+
+    # left2 finishes first, its state write conflicts while right is still running
+    log.write_text("")
+    with open(os.path.join(migrations_dir, "right.py"), "a") as right:
+        right.write("time.sleep(0.2)\n")
+    with patch.object(Migration, 'get_applied_heads_from_fhir', side_effect=lambda: state["heads"]), \
+            patch.object(Migration, 'update_latest_applied_migration_in_fhir', side_effect=update), \
+            pytest.raises(ConcurrentMigrationError):
+        migration.run_migrations("upgrade")
+
+    assert sorted(log.read_text().split()) == ["up-left2", "up-right"]
+    # The merge was not started, both finished migrations are recorded
+    assert sorted(state["heads"]) == ["left2", "right"]
@@ -0,0 +1,72 @@
+import cProfile
+import os
+import pstats
+import pytest
+from unittest.mock import patch
+
+from fhir_migrations.migration import Migration
+from fhir_migrations.profiling import MigrationProfiler, collapse_pstats
+
+MIGRATION_SOURCE = (
+    "import json\n"
+    "import time\n"
+    "revision = 'rev1'\n"
+    "down_revision = 'None'\n"
+    "def transform(index):\n"
+    "    return json.dumps({'id': index, 'values': list(range(50))})\n"
+    "def upgrade():\n"
+    "    deadline = time.perf_counter() + 0.1\n"
+    "    while time.perf_counter() < deadline:\n"
+    "        for index in range(100):\n"
+    "            transform(index)\n"
+    "def downgrade():\n"
+    "    pass\n"
+)
+
+
+@pytest.fixture
+def migration(tmp_path):
+    migrations_dir = tmp_path / "migrations"
+    migrations_dir.mkdir()
+    (migrations_dir / "transform.py").write_text(MIGRATION_SOURCE)
+    return Migration(str(migrations_dir))
+
+
+def nested():
+    return sum(range(10000))
+
+
+def caller():
+    return [nested() for _ in range(50)]
+
+
+def test_collapse_pstats():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    caller()
+    profiler.disable()
+
+    stacks = collapse_pstats(pstats.Stats(profiler))
+    nested_stacks = [stack for stack in stacks if stack.endswith(f"nested (profiling_test.py:{nested.__code__.co_firstlineno})")]
+    assert len(nested_stacks) == 1
+    assert f"caller (profiling_test.py:{caller.__code__.co_firstlineno})" in nested_stacks[0]
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sampling"])
+def test_profile_migration(migration, tmp_path, mode):
+    profiles_dir = str(tmp_path / "profiles")
+    profiler = MigrationProfiler(profiles_dir, mode=mode, interval=0.002)
+    migration.observers.append(profiler)
+    with patch.object(Migration, 'update_latest_applied_migration_in_fhir'):
+        assert migration.run_migration("upgrade", "rev1", "rev1")
+
+    with open(os.path.join(profiles_dir, "rev1-upgrade.collapsed")) as collapsed_file:
+        collapsed = collapsed_file.read()
+    assert "upgrade (transform.py:7);transform (transform.py:5)" in collapsed
+
+    if mode == "cprofile":
+        stats = pstats.Stats(os.path.join(profiles_dir, "rev1-upgrade.pstats"))
+        assert any(name == "transform" for (_, _, name) in stats.stats)
+    else:
+        assert not os.path.exists(os.path.join(profiles_dir, "rev1-upgrade.pstats"))
+        assert any(line.startswith("MainThread;") for line in collapsed.splitlines())
@@ -0,0 +1,255 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from fhir_migrations.client import FHIRClient
+from fhir_migrations.dry_run import DryRun
+from fhir_migrations.metrics import MetricsRecorder
+from fhir_migrations.migration import Migration
+from fhir_migrations.migration_resource import ConcurrentMigrationError, MigrationState, RunHandedOverError
+from fhir_migrations.sharding import (
+    HashPartitioner,
+    IdRangePartitioner,
+    LastUpdatedPartitioner,
+    ShardedRun,
+    ShardingError,
+    ran_sharded_step,
+    reset_sharded_step,
+    run_sharded,
+)
+from fhir_migrations.stub_server import StubFHIRServer
+
+OBSERVATION_COUNT = 40
+
+
+@pytest.fixture
+def server():
+    with StubFHIRServer(page_size=7) as server:
+        for index in range(OBSERVATION_COUNT):
+            server.store.write("Observation", {"resourceType": "Observation", "id": f"o{index:02d}", "status": "final"})
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    client = FHIRClient(base_url=server.base_url, retries=0)
+    yield client
+    client.close()
+
+
+def amend(shard):
+    client = shard.run.get_client()
+    for observation in shard.resources():
+        observation["status"] = "amended"
+        client.put(f"Observation/{observation['id']}", data=json.dumps(observation)).raise_for_status()
+
+
+def shard_ids(client, partitioner):
+    return [sorted(resource["id"] for resource in client.search("Observation", partitioner.search_params(index))
+                   if partitioner.contains(index, resource))
+            for index in range(partitioner.count)]
+
+
+@pytest.mark.parametrize("partitioner", [
+    HashPartitioner("Observation", 4),
+    IdRangePartitioner("Observation", ["o10", "o25"]),
+])
+def test_partitions_cover_every_resource_once(client, partitioner):
+    shards = shard_ids(client, partitioner)
+    assert len(shards) == partitioner.count
+    assert sorted(sum(shards, [])) == [f"o{index:02d}" for index in range(OBSERVATION_COUNT)]
+
+
+def test_last_updated_windows(client, server):
+    time.sleep(0.01)
+    start = datetime.now(timezone.utc)
+    server.store.write("Observation", {"resourceType": "Observation", "id": "late"})
+    partitioner = LastUpdatedPartitioner("Observation", start, datetime.now(timezone.utc) + timedelta(seconds=1), 3)
+
+    shards = shard_ids(client, partitioner)
+    assert sum(len(ids) for ids in shards) == 1
+    assert partitioner.search_params(0)["_lastUpdated"][0].startswith("ge")
+    with pytest.raises(ValueError):
+        LastUpdatedPartitioner("Observation", start, start, 3)
+
+
+def test_run_sharded_across_processes(client, server):
+    partitioner = HashPartitioner("Observation", 6)
+    run_sharded("amend", partitioner, amend, processes=3, client=client, poll_interval=0.05)
+
+    assert all(resource["status"] == "amended" for resource in server.store.all("Observation"))
+    run = ShardedRun("amend", partitioner, client=client)
+    leases = run.leases()
+    assert sorted(leases) == list(range(6))
+    assert all(lease.status == "done" for lease in leases.values())
+    # Every shard was processed once
+    assert server.request_counts[("PUT", 200)] == OBSERVATION_COUNT + 6 * 2
+
+    # A later run finds the shards done
+    assert run.work(amend) == 0
+    run.clear()
+    assert server.store.all("Basic") == []
+
+
+def test_dry_run_is_not_forked(client, server):
+    partitioner = HashPartitioner("Observation", 3)
+    with DryRun(client) as planner:
+        planner.begin_migration("rev1", "upgrade", "amend")
+        assert run_sharded("amend", partitioner, amend, processes=3, client=client, poll_interval=0.01) == 3
+        planner.end_migration("rev1", "upgrade")
+
+    # Neither the leases nor the shard writes were sent
+    assert server.store.all("Basic") == []
+    assert all(resource["status"] == "final" for resource in server.store.all("Observation"))
+    assert planner.plans[0].requests[("PUT", "Observation")] == OBSERVATION_COUNT
+
+
+def test_metrics_are_recorded_without_forked_workers(client, server):
+    partitioner = HashPartitioner("Observation", 3)
+    with MetricsRecorder(client) as recorder:
+        recorder.begin_migration("rev1", "upgrade", "amend")
+        run_sharded("amend", partitioner, amend, processes=3, client=client, poll_interval=0.01)
+        recorder.end_migration("rev1", "upgrade")
+
+    assert all(resource["status"] == "amended" for resource in server.store.all("Observation"))
+    # Shard writes, claims and completions were all made by this process
+    assert recorder.migrations[0].requests[("PUT", 200)] == OBSERVATION_COUNT + 3 * 2
+
+
+def test_workers_share_shards(client):
+    partitioner = HashPartitioner("Observation", 8)
+    processed = []
+
+    def worker(name):
+        run = ShardedRun("amend", partitioner, client=client, worker_id=name, poll_interval=0.01)
+        processed.append(run.work(lambda shard: amend(shard)))
+
+    threads = [threading.Thread(target=worker, args=(f"worker-{index}",)) for index in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(processed) == 8
+
+
+def test_failed_shard_is_retried_by_next_run(client, server):
+    partitioner = IdRangePartitioner("Observation", ["o20"])
+    calls = []
+
+    def failing(shard):
+        calls.append(shard.index)
+        if shard.index == 1:
+            raise RuntimeError("boom")
+        amend(shard)
+
+    with pytest.raises(ShardingError, match="boom"):
+        ShardedRun("amend", partitioner, client=client, poll_interval=0.01).work(failing)
+    leases = ShardedRun("amend", partitioner, client=client).leases()
+    assert [leases[0].status, leases[1].status] == ["done", "failed"]
+
+    assert ShardedRun("amend", partitioner, client=client, poll_interval=0.01).work(amend) == 1
+    assert calls == [0, 1]
+    assert all(resource["status"] == "amended" for resource in server.store.all("Observation"))
+
+
+def test_expired_lease_is_taken_over(client):
+    partitioner = HashPartitioner("Observation", 1)
+    first = ShardedRun("amend", partitioner, client=client, worker_id="first", lease_seconds=0)
+    abandoned = first.claim(first.leases()[0])
+    assert abandoned is not None
+
+    second = ShardedRun("amend", partitioner, client=client, worker_id="second", poll_interval=0.01)
+    assert second.work(amend) == 1
+    assert second.leases()[0].owner == "second"
+
+
+def test_state_update_by_another_worker(client):
+    MigrationState(client=client).update("rev1")
+    first = MigrationState.load(client)
+    second = MigrationState.load(client)
+    stale = MigrationState(second.manager, client=client)
+
+    first.update("rev2")
+    # Outside of a sharded step, a second runner applying the same migration is a conflict
+    with pytest.raises(ConcurrentMigrationError):
+        MigrationState(second.manager, client=client).update("rev2")
+    # The other worker of the sharded migration finds the state already advanced and stops
+    with pytest.raises(RunHandedOverError):
+        second.update("rev2", sharded=True)
+    assert second.get_latest_migration() == "rev2"
+    with pytest.raises(ConcurrentMigrationError):
+        stale.update("rev3", sharded=True)
+
+
+def test_run_sharded_marks_the_step(client):
+    reset_sharded_step()
+    assert not ran_sharded_step()
+    run_sharded("amend", HashPartitioner("Observation", 2), amend, client=client, poll_interval=0.01)
+    assert ran_sharded_step()
+    reset_sharded_step()
+    assert not ran_sharded_step()
+
+
+def test_only_one_runner_continues_after_a_sharded_step(client, server, tmp_path, monkeypatch):
+    helpers = tmp_path / "helpers"
+    helpers.mkdir()
+    (helpers / "shard_coordination.py").write_text(
+        "import threading\n"
+        "finished_shards = threading.Barrier(2)\n"
+        "plain_runs = []\n"
+    )
+    monkeypatch.syspath_prepend(str(helpers))
+    migrations = tmp_path / "migrations"
+    migrations.mkdir()
+    (migrations / "amend.py").write_text(
+        "import threading\n"
+        "import shard_coordination\n"
+        "from fhir_migrations.client import FHIRClient\n"
+        "from fhir_migrations.sharding import HashPartitioner, run_sharded\n"
+        "revision = 'amend'\n"
+        "down_revision = 'None'\n"
+        "def amend(shard):\n"
+        "    for observation in shard.resources():\n"
+        "        pass\n"
+        "def upgrade():\n"
+        f"    client = FHIRClient(base_url='{server.base_url}', retries=0)\n"
+        "    run_sharded('amend', HashPartitioner('Observation', 4), amend, client=client,\n"
+        "                worker_id=threading.current_thread().name, poll_interval=0.01)\n"
+        "    # Both runners finish the last shard before either records the step\n"
+        "    shard_coordination.finished_shards.wait(5)\n"
+        "def downgrade():\n"
+        "    pass\n"
+    )
+    (migrations / "plain.py").write_text(
+        "import shard_coordination\n"
+        "revision = 'plain'\n"
+        "down_revision = 'amend'\n"
+        "def upgrade():\n"
+        "    shard_coordination.plain_runs.append(1)\n"
+        "def downgrade():\n"
+        "    pass\n"
+    )
+    MigrationState(client=client).update(None)
+
+    errors = []
+
+    def runner():
+        try:
+            Migration(str(migrations), client=client).run_migrations("upgrade")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=runner, name=f"runner-{index}") for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    import shard_coordination
+    assert errors == []
+    # The runner whose state write lost stopped, the plain migration ran once
+    assert shard_coordination.plain_runs == [1]
+    assert MigrationState.load(client).get_latest_migration() == "plain"
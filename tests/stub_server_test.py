@@ -0,0 +1,182 @@
+import json
+import os
+import pytest
+
+from fhir_migrations import client as client_module
+from fhir_migrations.client import FHIRClient, configure_client
+from fhir_migrations.migration import Migration
+from fhir_migrations.migration_resource import ConcurrentMigrationError, MigrationState
+from fhir_migrations.stub_server import StubFHIRServer
+from fhir_migrations.writer import BundleWriter
+
+
+def patient(identifier):
+    return {"resourceType": "Patient", "identifier": [{"system": "uwDAL_Clarity", "value": identifier}]}
+
+
+@pytest.fixture
+def server():
+    with StubFHIRServer(page_size=3) as server:
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    client = FHIRClient(base_url=server.base_url, retries=0)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def shared_client(server):
+    previous_client = client_module.shared_client
+    yield configure_client(base_url=server.base_url, retries=0)
+    client_module.shared_client.close()
+    client_module.shared_client = previous_client
+
+
+def test_crud_and_versions(client):
+    created = client.post("Patient", data=json.dumps(patient("1")))
+    assert created.status_code == 201
+    resource = created.json()
+    assert resource["meta"]["versionId"] == "1"
+
+    updated = client.put(f"Patient/{resource['id']}", data=json.dumps(resource), headers={"If-Match": 'W/"1"'})
+    assert updated.status_code == 200
+    assert updated.headers["ETag"] == 'W/"2"'
+
+    stale = client.put(f"Patient/{resource['id']}", data=json.dumps(resource), headers={"If-Match": 'W/"1"'})
+    assert stale.status_code == 412
+
+    assert client.delete(f"Patient/{resource['id']}").status_code == 204
+    assert client.get(f"Patient/{resource['id']}").status_code == 404
+
+
+def test_search_pages_by_identifier(client, server):
+    for index in range(7):
+        client.post("Patient", data=json.dumps(patient(str(index % 2))))
+
+    matches = list(client.search("Patient", {"identifier": "uwDAL_Clarity|0"}))
+    assert len(matches) == 4
+    assert server.request_counts[("GET", 200)] == 2
+
+    bundle = client.get("Patient", params={"identifier": "other|0"}).json()
+    assert bundle["total"] == 0
+
+
+def test_patch(client):
+    resource = client.put("Patient/p1", data=json.dumps(dict(patient("1"), id="p1"))).json()
+    operations = [
+        {"op": "add", "path": "/identifier/-", "value": {"system": "mrn", "value": "U1"}},
+        {"op": "replace", "path": "/identifier/0/value", "value": "2"},
+    ]
+    patched = client.patch(f"Patient/{resource['id']}", data=json.dumps(operations),
+                           headers={"Content-Type": "application/json-patch+json"}).json()
+    assert [identifier["value"] for identifier in patched["identifier"]] == ["2", "U1"]
+
+    failing = [{"op": "test", "path": "/gender", "value": "male"}]
+    assert client.patch("Patient/p1", data=json.dumps(failing)).status_code == 422
+
+
+def test_bundles(client, server):
+    client.put("Patient/p1", data=json.dumps(dict(patient("1"), id="p1")))
+    with BundleWriter(client) as writer:
+        writer.create(patient("2"))
+        writer.delete("Patient/p1")
+    assert writer.succeeded == 2
+    assert [resource["identifier"][0]["value"] for resource in server.store.all("Patient")] == ["2"]
+
+    writer = BundleWriter(client, bundle_type="transaction")
+    writer.create(patient("3"))
+    writer.update(dict(patient("4"), id="p2"), if_match='W/"9"')
+    results = writer.flush()
+    assert [result.status_code for result in results] == [404, 404]
+    assert len(server.store.all("Patient")) == 1
+
+
+def test_throttling_is_retried(server):
+    server.throttle_rate = 0.5
+    server.random.seed(1)
+    client = FHIRClient(base_url=server.base_url, retries=10)
+    adapter = client.session.get_adapter(server.base_url)
+    adapter.max_retries = adapter.max_retries.new(backoff_factor=0)
+    for index in range(10):
+        assert client.put(f"Patient/{index}", data=json.dumps(dict(patient(str(index)), id=str(index)))).ok
+    assert server.request_counts[("PUT", 429)] > 0
+    client.close()
+
+
+def test_migration_state(shared_client, server):
+    state = MigrationState.load()
+    assert state.get_latest_migration() is None
+    state.update("rev1")
+    state.update("rev2")
+    assert MigrationState.load().get_latest_migration() == "rev2"
+
+    stale = MigrationState(state.manager)
+    MigrationState.load().update("rev3")
+    with pytest.raises(ConcurrentMigrationError):
+        stale.update("rev4")
+
+
+def test_upgrade_end_to_end(shared_client, server, tmp_path):
+    with open(os.path.join(tmp_path, "create.py"), "w") as migration_file:
+        migration_file.write(
+            "import json\n"
+            "from fhir_migrations.client import get_client\n"
+            "revision = 'rev1'\n"
+            "down_revision = 'None'\n"
+            "def upgrade():\n"
+            "    get_client().put('Patient/example', data=json.dumps({'resourceType': 'Patient', 'id': 'example'}))\n"
+            "def downgrade():\n"
+            "    get_client().delete('Patient/example')\n"
+        )
+
+    migration = Migration(str(tmp_path))
+    migration.run_migrations("upgrade")
+    assert server.store.read("Patient", "example")
+    assert migration.get_latest_applied_migration_from_fhir() == "rev1"
+
+
+def test_upgrade_branches_concurrently(shared_client, server, tmp_path):
+    # Each branch waits for the other one to start, which only succeeds if they run concurrently
+    migrations = {
+        "base": ("None", "pass"),
+        "left": ("'base'", "wait_for('right')"),
+        "right": ("'base'", "wait_for('left')"),
+        "merge": ("('left', 'right')", "pass"),
+    }
+    for name, (down_revision, body) in migrations.items():
+        with open(os.path.join(tmp_path, f"{name}.py"), "w") as migration_file:
+            migration_file.write(
+                "import os, time\n"
+                f"revision = '{name}'\n"
+                f"down_revision = {down_revision}\n"
+                "def wait_for(other):\n"
+                f"    open(os.path.join({str(tmp_path)!r}, '{name}.started'), 'w').close()\n"
+                "    deadline = time.monotonic() + 5\n"
+                f"    while not os.path.exists(os.path.join({str(tmp_path)!r}, other + '.started')):\n"
+                "        assert time.monotonic() < deadline, 'branches did not run concurrently'\n"
+                "        time.sleep(0.01)\n"
+                "def upgrade():\n"
+                f"    {body}\n"
+                "def downgrade():\n"
+                "    pass\n"
+            )
+
+    migration = Migration(str(tmp_path))
+    assert migration.migration_graph is not None
+    migration.run_migrations("upgrade", to_revision="base")
+    assert MigrationState.load().get_applied_heads() == ["base"]
+
+    migration.run_migrations("upgrade")
+    assert migration.get_applied_heads_from_fhir() == ["merge"]
+    assert migration.applied_revisions() == {"base", "left", "right", "merge"}
+
+    migration.run_migrations("downgrade")
+    # The codings of the state hold both heads of the merge
+    codings = MigrationState.load().manager.code.coding
+    assert [coding.code for coding in codings] == ["left", "right"]
+
+    migration.run_migrations("downgrade", to_revision="base")
+    assert migration.get_applied_heads_from_fhir() == []
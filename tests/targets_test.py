@@ -0,0 +1,155 @@
+import pytest
+
+from fhir_migrations.client import FHIRClient
+from fhir_migrations.migration import Migration
+from fhir_migrations.migration_resource import MigrationState
+from fhir_migrations.stub_server import StubFHIRServer
+from fhir_migrations.targets import Target, format_report, read_targets, run_targets
+
+MIGRATIONS = {
+    "first.py": (
+        "import json, os\n"
+        "from fhir_migrations.client import get_client\n"
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "def upgrade():\n"
+        "    patient = {'resourceType': 'Patient', 'id': 'example', 'address': [{'text': os.environ['FHIR_URL']}]}\n"
+        "    get_client().put('Patient/example', data=json.dumps(patient)).raise_for_status()\n"
+        "def downgrade():\n"
+        "    get_client().delete('Patient/example')\n"
+    ),
+    "second.py": (
+        "revision = 'rev2'\n"
+        "down_revision = 'rev1'\n"
+        "def upgrade():\n"
+        "    pass\n"
+        "def downgrade():\n"
+        "    pass\n"
+    ),
+}
+
+
+CLIENTS_MIGRATION = (
+    "import asyncio, json\n"
+    "from fhir_migrations.async_client import AsyncFHIRClient\n"
+    "from fhir_migrations.client import FHIRClient\n"
+    "revision = 'rev1'\n"
+    "down_revision = 'None'\n"
+    "async def put_async(patient):\n"
+    "    async with AsyncFHIRClient() as client:\n"
+    "        (await client.put(f'Patient/{patient[\"id\"]}', json=patient)).raise_for_status()\n"
+    "def upgrade():\n"
+    "    client = FHIRClient()\n"
+    "    patient = {'resourceType': 'Patient', 'id': 'sync', 'address': [{'text': client.base_url}]}\n"
+    "    client.put('Patient/sync', data=json.dumps(patient)).raise_for_status()\n"
+    "    client.close()\n"
+    "    asyncio.run(put_async({'resourceType': 'Patient', 'id': 'async'}))\n"
+    "def downgrade():\n"
+    "    pass\n"
+)
+
+
+@pytest.fixture
+def migrations_dir(tmp_path):
+    for file_name, source in MIGRATIONS.items():
+        (tmp_path / file_name).write_text(source)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def servers():
+    with StubFHIRServer() as first, StubFHIRServer() as second, StubFHIRServer() as third:
+        yield [first, second, third]
+
+
+def test_targets_are_migrated_in_parallel(servers, migrations_dir):
+    targets = [Target(server.base_url, name=f"tenant-{index}") for index, server in enumerate(servers)]
+    results = run_targets(targets, "upgrade", migrations_dir, max_workers=2)
+
+    assert [result.target.name for result in results] == ["tenant-0", "tenant-1", "tenant-2"]
+    for server, result in zip(servers, results):
+        assert result.ok
+        assert [revision for revision, _ in result.applied] == ["rev1", "rev2"]
+        assert (result.previous, result.current) == (None, "rev2")
+        # Every target got its own writes and migration state
+        assert server.store.read("Patient", "example")["address"][0]["text"] == server.base_url
+        client = FHIRClient(base_url=server.base_url, retries=0)
+        assert MigrationState.load(client).get_latest_migration() == "rev2"
+        client.close()
+
+    report = format_report(results, 1.0)
+    assert report.splitlines()[-1].startswith("3 targets: 3 succeeded, 0 failed in 1.00s")
+
+
+def test_clients_created_in_migrations_address_the_target(servers, tmp_path):
+    (tmp_path / "clients.py").write_text(CLIENTS_MIGRATION)
+    targets = [Target(server.base_url) for server in servers[:2]]
+    results = run_targets(targets, "upgrade", str(tmp_path), max_workers=2)
+
+    assert [result.ok for result in results] == [True, True]
+    for server in servers[:2]:
+        assert server.store.read("Patient", "sync")["address"][0]["text"] == server.base_url
+        assert server.store.read("Patient", "async")
+
+
+def test_helper_modules_are_imported_for_every_target(servers, tmp_path, monkeypatch):
+    helpers = tmp_path / "helpers"
+    helpers.mkdir()
+    (helpers / "tenant_helper.py").write_text(
+        "from fhir_migrations.client import get_client\n"
+        "from fhir_migrations.config import FHIR_URL\n"
+        "client = get_client()\n"
+    )
+    monkeypatch.syspath_prepend(str(helpers))
+    (tmp_path / "helper.py").write_text(
+        "import json\n"
+        "import tenant_helper\n"
+        "revision = 'rev1'\n"
+        "down_revision = 'None'\n"
+        "def upgrade():\n"
+        "    patient = {'resourceType': 'Patient', 'id': 'helper', 'address': [{'text': tenant_helper.FHIR_URL}]}\n"
+        "    tenant_helper.client.put('Patient/helper', data=json.dumps(patient)).raise_for_status()\n"
+        "def downgrade():\n"
+        "    pass\n"
+    )
+    # One worker at a time, so a reused worker would keep the first target of its imports
+    targets = [Target(server.base_url) for server in servers[:2]]
+    results = run_targets(targets, "upgrade", str(tmp_path), max_workers=1)
+
+    assert [result.ok for result in results] == [True, True]
+    for server in servers[:2]:
+        assert server.store.read("Patient", "helper")["address"][0]["text"] == server.base_url
+
+
+def test_failing_target_does_not_stop_others(servers, migrations_dir):
+    servers[1].error_rate = 1.0
+    targets = [Target(server.base_url) for server in servers]
+    results = run_targets(targets, "upgrade", migrations_dir, max_workers=3)
+
+    assert [result.ok for result in results] == [True, False, True]
+    assert "HTTPError" in results[1].error
+    assert "FAILED" in format_report(results)
+
+
+def test_state_per_resource_id(servers, migrations_dir):
+    client = FHIRClient(base_url=servers[0].base_url, retries=0)
+    Migration(migrations_dir, client=client, resource_id="tenant-a").get_migration_state().update("rev1")
+    Migration(migrations_dir, client=client, resource_id="tenant-b").get_migration_state().update("rev2")
+
+    assert MigrationState.load(client, "tenant-a").get_latest_migration() == "rev1"
+    assert MigrationState.load(client, "tenant-b").get_latest_migration() == "rev2"
+    assert MigrationState.load(client).get_latest_migration() is None
+    client.close()
+
+
+def test_parse_targets(tmp_path):
+    target = Target.parse("tenant-a=http://tenant-a/fhir")
+    assert (target.name, target.url) == ("tenant-a", "http://tenant-a/fhir")
+    target = Target.parse("http://tenant-b/fhir?a=b")
+    assert (target.name, target.url) == ("http://tenant-b/fhir?a=b", "http://tenant-b/fhir?a=b")
+    with pytest.raises(ValueError):
+        Target.parse("tenant-c=")
+
+    targets_file = tmp_path / "targets.txt"
+    targets_file.write_text("# tenants\ntenant-a=http://tenant-a/fhir\n\nhttp://tenant-b/fhir\n")
+    assert [target.name for target in read_targets(str(targets_file))] == ["tenant-a", "http://tenant-b/fhir"]
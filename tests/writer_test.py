@@ -0,0 +1,123 @@
+import json
+import pytest
+from unittest.mock import MagicMock
+
+from fhir_migrations.writer import BundleWriter
+
+
+def echo_response(path, data):
+    bundle = json.loads(data)
+    response = MagicMock(status_code=200)
+    response.json.return_value = {
+        "resourceType": "Bundle",
+        "type": f"{bundle['type']}-response",
+        "entry": [
+            {"response": {"status": "404 Not Found" if entry["request"]["url"] == "Patient/missing" else "200 OK"}}
+            for entry in bundle["entry"]
+        ],
+    }
+    return response
+
+
+@pytest.fixture
+def client():
+    client = MagicMock()
+    client.post.side_effect = echo_response
+    return client
+
+
+def patient(id):
+    return {"resourceType": "Patient", "id": id}
+
+
+def test_writer_flushes_on_entry_count(client):
+    writer = BundleWriter(client, max_entries=2)
+    assert writer.update(patient("1")) == []
+    results = writer.update(patient("2"))
+
+    assert [result.url for result in results] == ["Patient/1", "Patient/2"]
+    bundle = json.loads(client.post.call_args[1]["data"])
+    assert bundle["type"] == "batch"
+    assert bundle["entry"][1]["request"] == {"method": "PUT", "url": "Patient/2"}
+
+
+def test_writer_flushes_on_byte_size(client):
+    writer = BundleWriter(client, max_entries=100, max_bytes=120)
+    writer.create(patient("1"))
+    results = writer.create(patient("2"))
+
+    assert len(results) == 1
+    assert client.post.call_count == 1
+    assert len(writer.close()) == 1
+
+
+def test_writer_reports_entry_results(client):
+    reported = []
+    with BundleWriter(client, bundle_type="transaction", on_result=reported.append) as writer:
+        writer.update(patient("1"), record={"PAT_ID": "1"})
+        writer.delete("Patient/missing", record={"PAT_ID": "missing"})
+
+    assert [(result.record["PAT_ID"], result.ok) for result in reported] == [("1", True), ("missing", False)]
+    assert (writer.succeeded, writer.failed) == (1, 1)
+    assert json.loads(client.post.call_args[1]["data"])["type"] == "transaction"
+
+
+def test_writer_rejected_transaction(client):
+    client.post.side_effect = None
+    client.post.return_value = MagicMock(status_code=400, content=b"{}")
+    client.post.return_value.json.return_value = {"resourceType": "OperationOutcome"}
+    writer = BundleWriter(client, bundle_type="transaction")
+    writer.update(patient("1"))
+    writer.update(patient("2"))
+
+    results = writer.flush()
+    assert [result.status_code for result in results] == [400, 400]
+    assert writer.failed == 2
+
+
+@pytest.mark.parametrize("bundle_type", ["batch", "transaction"])
+def test_writer_failed_bundle(client, bundle_type):
+    client.post.side_effect = None
+    client.post.return_value = MagicMock(status_code=503, content=b"unavailable")
+    client.post.return_value.json.side_effect = ValueError
+    writer = BundleWriter(client, bundle_type=bundle_type)
+    writer.update(patient("1"))
+    writer.update(patient("2"))
+
+    results = writer.flush()
+    assert [(result.url, result.status_code) for result in results] == [("Patient/1", 503), ("Patient/2", 503)]
+    assert writer.failed == 2
+
+
+def test_writer_entry_count_mismatch(client):
+    client.post.side_effect = None
+    client.post.return_value = MagicMock(status_code=200)
+    client.post.return_value.json.return_value = {"resourceType": "Bundle", "entry": [{"response": {"status": "200"}}]}
+    writer = BundleWriter(client)
+    writer.update(patient("1"))
+    writer.update(patient("2"))
+
+    results = writer.flush()
+    assert [result.ok for result in results] == [False, False]
+    assert (writer.succeeded, writer.failed) == (0, 2)
+
+
+def test_writer_keeps_operations_when_request_raises(client):
+    client.post.side_effect = ConnectionError
+    writer = BundleWriter(client)
+    writer.update(patient("1"))
+    with pytest.raises(ConnectionError):
+        writer.flush()
+
+    client.post.side_effect = echo_response
+    assert [result.url for result in writer.flush()] == ["Patient/1"]
+
+
+def test_writer_logs_discarded_operations(client, caplog):
+    with pytest.raises(RuntimeError):
+        with BundleWriter(client) as writer:
+            writer.update(patient("1"))
+            raise RuntimeError("migration failed")
+
+    assert client.post.call_count == 0
+    assert "Discarding 1 buffered operations after RuntimeError: PUT Patient/1" in caplog.text